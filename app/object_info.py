@@ -0,0 +1,125 @@
+import json
+import uuid
+import logging
+import threading
+import traceback
+
+import nodes
+import folder_paths
+
+def node_info(node_class):
+    obj_class = nodes.NODE_CLASS_MAPPINGS[node_class]
+    info = {}
+    info['input'] = obj_class.INPUT_TYPES()
+    info['output'] = obj_class.RETURN_TYPES
+    info['output_is_list'] = obj_class.OUTPUT_IS_LIST if hasattr(obj_class, 'OUTPUT_IS_LIST') else [False] * len(obj_class.RETURN_TYPES)
+    info['output_name'] = obj_class.RETURN_NAMES if hasattr(obj_class, 'RETURN_NAMES') else info['output']
+    info['name'] = node_class
+    info['display_name'] = nodes.NODE_DISPLAY_NAME_MAPPINGS[node_class] if node_class in nodes.NODE_DISPLAY_NAME_MAPPINGS.keys() else node_class
+    info['description'] = obj_class.DESCRIPTION if hasattr(obj_class,'DESCRIPTION') else ''
+    info['category'] = 'sd'
+    if hasattr(obj_class, 'OUTPUT_NODE') and obj_class.OUTPUT_NODE == True:
+        info['output_node'] = True
+    else:
+        info['output_node'] = False
+
+    if hasattr(obj_class, 'CATEGORY'):
+        info['category'] = obj_class.CATEGORY
+    return info
+
+class CacheEntry:
+    def __init__(self, registration, deps, info, version):
+        self.registration = registration
+        self.deps = deps
+        self.info = info
+        self.version = version
+
+class ObjectInfoCache:
+    """
+    The /object_info document. The info of a node is only generated again when
+    it's registered again or one of the folder listings its INPUT_TYPES read
+    changed, every change bumps the version so clients can ask for what changed
+    since the version they have.
+
+    Nodes that list files themselves instead of going through folder_paths only
+    get updated on a refresh.
+    """
+    def __init__(self):
+        self.instance = uuid.uuid4().hex[:8]
+        self.version = 0
+        self.entries = {}
+        self.removed = {}
+        self.body = None
+        self.lock = threading.RLock()
+
+    def get_etag(self):
+        return '"{}-{}"'.format(self.instance, self.version)
+
+    def parse_etag(self, etag):
+        instance, _, version = etag.strip('"').partition("-")
+        if instance != self.instance or not version.isdigit() or int(version) > self.version:
+            return None
+        return int(version)
+
+    def update(self, refresh=False):
+        with self.lock:
+            new_version = self.version + 1
+            changed = False
+            versions = {}
+            current = set()
+            for name, obj_class in list(nodes.NODE_CLASS_MAPPINGS.items()):
+                registration = (obj_class, nodes.NODE_DISPLAY_NAME_MAPPINGS.get(name, None))
+                entry = self.entries.get(name, None)
+                if entry is not None and not refresh and entry.registration == registration and not folder_paths.dependencies_changed(entry.deps, versions):
+                    current.add(name)
+                    continue
+                try:
+                    with folder_paths.track_dependencies() as deps:
+                        info = node_info(name)
+                except Exception:
+                    logging.error(f"[ERROR] An error occurred while retrieving information for the '{name}' node.")
+                    logging.error(traceback.format_exc())
+                    continue
+                current.add(name)
+                if entry is not None and entry.info == info:
+                    entry.registration = registration
+                    entry.deps = deps
+                    continue
+                self.entries[name] = CacheEntry(registration, deps, info, new_version)
+                self.removed.pop(name, None)
+                changed = True
+
+            for name in [x for x in self.entries if x not in current]:
+                del self.entries[name]
+                self.removed[name] = new_version
+                changed = True
+
+            if changed:
+                self.version = new_version
+                self.body = None
+            return self.version
+
+    def get_body(self):
+        with self.lock:
+            if self.body is None:
+                out = {x: self.entries[x].info for x in nodes.NODE_CLASS_MAPPINGS if x in self.entries}
+                self.body = json.dumps(out).encode("utf-8")
+            return self.body
+
+    def get_node(self, name):
+        with self.lock:
+            entry = self.entries.get(name, None)
+            return entry.info if entry is not None else None
+
+    def get_delta(self, etag):
+        """The nodes added, changed or removed since the version etag, everything if it's unknown."""
+        with self.lock:
+            since = self.parse_etag(etag)
+            if since is None:
+                return {"version": self.get_etag(), "full": True, "changed": {x: e.info for x, e in self.entries.items()}, "removed": []}
+            return {
+                "version": self.get_etag(),
+                "full": False,
+                "changed": {x: e.info for x, e in self.entries.items() if e.version > since},
+                "removed": [x for x, v in self.removed.items() if v > since],
+            }
@@ -87,6 +87,7 @@ class LatentPreviewMethod(enum.Enum):
     TAESD = "taesd"
 
 parser.add_argument("--preview-method", type=LatentPreviewMethod, default=LatentPreviewMethod.NoPreviews, help="Default preview method for sampler nodes.", action=EnumAction)
+parser.add_argument("--preview-max-fps", type=float, default=10.0, metavar="FPS", help="Send at most FPS previews per second for each sampler, the previews are decoded on their own thread and the steps in between are skipped. 0 sends one for every step.")
 
 attn_group = parser.add_mutually_exclusive_group()
 attn_group.add_argument("--use-split-cross-attention", action="store_true", help="Use the split cross attention optimization. Ignored when xformers is used.")
@@ -109,6 +110,48 @@ vram_group.add_argument("--novram", action="store_true", help="When lowvram isn'
 vram_group.add_argument("--cpu", action="store_true", help="To use the CPU for everything (slow).")
 
 
+parser.add_argument("--cache-lru", type=int, default=0, metavar="SIZE", help="Use LRU caching with a maximum of SIZE node results cached across prompts. May use more RAM/VRAM. The default only keeps the results of the last prompt.")
+parser.add_argument("--release-intermediates", action="store_true", help="Free the outputs of nodes as soon as every node that uses them ran instead of keeping them all until the next prompt, lowers the peak RAM of workflows with many big intermediate images or videos. The outputs of output nodes and expensive nodes like loaders and samplers are still cached.")
+parser.add_argument("--cache-spill-ram", type=float, default=0.0, metavar="GB", help="When the cached IMAGE, LATENT, MASK... node outputs take more than GB gigabytes of RAM, write the least recently used ones to memory mapped files in the temp directory. Disabled by default.")
+parser.add_argument("--cache-spill-disk", type=float, default=20.0, metavar="GB", help="Maximum size of the spilled node outputs, the least recently used ones are dropped from the cache past it.")
+
+parser.add_argument("--parallel-node-workers", type=int, default=0, metavar="WORKERS", help="Run nodes that are marked as thread safe (image loading, resizing, mask ops, saving...) on a pool of WORKERS threads so independent branches of a prompt can run at the same time. Other nodes are still executed one at a time.")
+
+parser.add_argument("--batch-prompts", type=int, default=1, metavar="MAX_BATCH", help="Execute up to MAX_BATCH queued prompts with the same graph together, sampling compatible KSampler nodes in a single batch. Only prompts that differ in their widget values (seed, prompt text...) are grouped.")
+parser.add_argument("--batch-wait", type=float, default=0.0, metavar="SECONDS", help="How long to wait for more compatible prompts to arrive before executing a batch (default 0, only batch prompts that are already queued).")
+
+parser.add_argument("--text-encoder-cache-size", type=int, default=0, metavar="SIZE", help="Keep the outputs of the last SIZE text encoder calls in memory so prompts that were already encoded don't need the text encoder. Disabled by default, the first encode with a newly loaded text encoder hashes all its weights.")
+parser.add_argument("--text-encoder-cache-dir", type=str, default=None, metavar="PATH", help="Also store text encoder outputs in this directory so they survive restarts.")
+
+class ModelEvictionPolicy(enum.Enum):
+    Default = "default"
+    LRU = "lru"
+    LFU = "lfu"
+    Cost = "cost"
+
+parser.add_argument("--model-cache-disk", type=float, default=0.0, metavar="GB", help="Instead of dropping the models that don't fit in --model-cache-ram, write their converted weights to up to GB gigabytes of files in the temp directory and memory map them, so using them again doesn't load the checkpoint again. Works without --model-cache-ram too.")
+parser.add_argument("--model-eviction", type=ModelEvictionPolicy, default=ModelEvictionPolicy.Default, help="How to pick the models to unload when a device runs out of memory. default: the least referenced then smallest ones. lru, lfu: least recently or least frequently used. cost: the cheapest to load again for their size based on the measured load times, weighted by use. All but default keep the models the running and queued prompts use.", action=EnumAction)
+parser.add_argument("--prefetch-models-ram", type=float, default=0.0, metavar="GB", help="While a prompt runs, read the safetensors model files of the next queued prompts into up to GB gigabytes of RAM so loading them doesn't wait for the disk. Disabled by default.")
+parser.add_argument("--model-cache-ram", type=float, default=0.0, metavar="GB", help="Keep up to GB gigabytes of loaded checkpoints, VAEs, controlnets, etc... in RAM so loader nodes in any workflow can reuse them without reading them from disk again. Disabled by default.")
+parser.add_argument("--patched-weight-cache-ram", type=float, default=0.0, metavar="GB", help="Keep up to GB gigabytes of lora patched weights per model so switching back to a previously used set of loras doesn't need to calculate them again.")
+parser.add_argument("--watch-input-directory", action="store_true", help="Watch the input directory for changes (needs the watchdog package) so the loader nodes don't need to check the files of every prompt to know if they changed.")
+parser.add_argument("--model-index-rescan-interval", type=float, default=1.0, metavar="SECONDS", help="Check the model folders for new or removed files at most once every SECONDS instead of every time a list of models is needed.")
+parser.add_argument("--model-index-file", type=str, default=None, metavar="PATH", help="Where to save the index of the model folders so they don't have to be walked again after a restart. Defaults to model_index.json in the user directory.")
+parser.add_argument("--disable-mmap", action="store_true", help="Read whole safetensors files into memory when loading them instead of memory mapping them and only reading the tensors that are used.")
+
+parser.add_argument("--queue-database", type=str, default=None, metavar="PATH", help="Store the queue and history in this SQLite database so they survive restarts.")
+parser.add_argument("--queue-fair-share", action="store_true", help="Take queued prompts of the same priority round robin between clients instead of in the order they were queued.")
+
+parser.add_argument("--worker-devices", type=str, default=None, metavar="DEVICES", help="Run one prompt worker per device sharing the queue, a comma separated list of torch devices like cuda:0,cuda:1. A device can be repeated, cpu,cpu runs two workers on the cpu.")
+parser.add_argument("--worker-affinity-wait", type=float, default=5.0, metavar="SECONDS", help="How long a prompt waits for a busy worker that already has its models loaded before it goes to an idle one.")
+
+parser.add_argument("--enable-remote-workers", action="store_true", help="Let other ComfyUI instances started with --remote-worker lease and run prompts from this queue.")
+parser.add_argument("--coordinator-only", action="store_true", help="With --enable-remote-workers, don't execute prompts locally and leave them all to the remote workers.")
+parser.add_argument("--remote-worker-lease-timeout", type=float, default=30.0, metavar="SECONDS", help="Prompts of remote workers that didn't send a heartbeat for this long are queued again.")
+parser.add_argument("--remote-worker", type=str, default=None, metavar="URL", help="Run headless and execute the prompts leased from the ComfyUI server at URL instead of a local queue. loopback runs the local queue through the remote worker protocol.")
+parser.add_argument("--remote-worker-token", type=str, default=None, metavar="TOKEN", help="Shared secret the remote workers send to the coordinator. The coordinator rejects the /worker requests that don't have it, without a token no remote worker can connect.")
+parser.add_argument("--remote-worker-id", type=str, default=None, metavar="ID", help="The name of this remote worker on the coordinator, the host name and process id by default.")
+
 parser.add_argument("--disable-smart-memory", action="store_true", help="Force ComfyUI to agressively offload to regular ram instead of keeping models in vram when it can.")
 parser.add_argument("--deterministic", action="store_true", help="Make pytorch use slower deterministic algorithms when it can. Note that this might not make images deterministic in all cases.")
 
@@ -116,6 +159,9 @@ parser.add_argument("--dont-print-server", action="store_true", help="Don't prin
 parser.add_argument("--quick-test-for-ci", action="store_true", help="Quick test for CI.")
 parser.add_argument("--windows-standalone-build", action="store_true", help="Windows standalone build: Enable convenient things that most people using the standalone windows build will probably enjoy (like auto opening the page on startup).")
 
+parser.add_argument("--save-image-threads", type=int, default=2, metavar="THREADS", help="Number of background threads used to encode and write saved images. Set to 0 to save them on the execution thread.")
+parser.add_argument("--save-image-queue-size", type=int, default=16, metavar="IMAGES", help="Maximum number of images waiting to be written before saving blocks execution.")
+
 parser.add_argument("--disable-metadata", action="store_true", help="Disable saving prompt metadata in files.")
 
 parser.add_argument("--multi-user", action="store_true", help="Enables per-user storage.")
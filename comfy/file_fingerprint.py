@@ -0,0 +1,128 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+CHUNK_SIZE = 1024 * 1024
+#files modified this close to the time they were hashed can change again without a visible mtime change
+RACY_NS = 2 * 1000 * 1000 * 1000
+
+def stat_key(stat):
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_dev)
+
+def hash_file(path):
+    m = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if len(chunk) == 0:
+                break
+            m.update(chunk)
+    return m.digest().hex()
+
+class FileFingerprints:
+    """
+    SHA-256 of files that only reads a file again when its size, mtime or inode
+    changed. Files under a watched directory are trusted until the watcher reports
+    a change so they don't even need to be stat'ed.
+    """
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.watched = []
+        self.observer = None
+        self.invalidations = 0
+        self.hits = 0
+        self.misses = 0
+
+    def is_watched(self, path):
+        return any(path.startswith(x) for x in self.watched)
+
+    def get(self, path):
+        path = os.path.abspath(path)
+        with self.lock:
+            entry = self.entries.get(path, None)
+            if entry is not None and entry[2] and self.is_watched(path):
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+
+        key = stat_key(os.stat(path))
+        with self.lock:
+            entry = self.entries.get(path, None)
+            if entry is not None and entry[0] == key and entry[2]:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            invalidations = self.invalidations
+
+        start = time.time_ns()
+        digest = hash_file(path)
+        new_key = stat_key(os.stat(path))
+        trusted = new_key == key and start - key[1] > RACY_NS
+        with self.lock:
+            #changed while it was being hashed
+            trusted = trusted and invalidations == self.invalidations
+            self.entries[path] = (new_key, digest, trusted)
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return digest
+
+    def invalidate(self, path=None):
+        with self.lock:
+            self.invalidations += 1
+            if path is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(os.path.abspath(path), None)
+
+    def watch(self, directory):
+        try:
+            import watchdog.observers
+            import watchdog.events
+        except ImportError:
+            logging.warning("Install the watchdog package to watch {} for changes, falling back to checking the file stats.".format(directory))
+            return False
+
+        fingerprints = self
+        class Handler(watchdog.events.FileSystemEventHandler):
+            def on_any_event(self, event):
+                fingerprints.invalidate(event.src_path)
+                dest_path = getattr(event, "dest_path", None)
+                if dest_path:
+                    fingerprints.invalidate(dest_path)
+
+        directory = os.path.join(os.path.abspath(directory), "")
+        with self.lock:
+            if self.observer is None:
+                self.observer = watchdog.observers.Observer()
+                self.observer.daemon = True
+                self.observer.start()
+            self.observer.schedule(Handler(), directory, recursive=True)
+            self.watched.append(directory)
+        return True
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "watched": list(self.watched),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+file_fingerprints = FileFingerprints()
+
+def get_fingerprint(path):
+    return file_fingerprints.get(path)
+
+def invalidate(path=None):
+    file_fingerprints.invalidate(path)
+
+def watch(directory):
+    return file_fingerprints.watch(directory)
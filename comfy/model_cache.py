@@ -0,0 +1,410 @@
+import os
+import uuid
+import queue
+import logging
+import threading
+from collections import OrderedDict
+
+import torch
+
+from comfy.cli_args import args
+import comfy.model_management
+import comfy.model_patcher
+import comfy.model_eviction
+
+def file_key(path):
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    return (path, stat.st_mtime_ns, stat.st_size)
+
+def object_size(obj):
+    if obj is None:
+        return 0
+    if isinstance(obj, (tuple, list)):
+        return sum(object_size(x) for x in obj)
+    if isinstance(obj, comfy.model_patcher.ModelPatcher):
+        return obj.model_size()
+    if isinstance(obj, torch.nn.Module):
+        return comfy.model_management.module_size(obj)
+    patcher = getattr(obj, "patcher", None)
+    if isinstance(patcher, comfy.model_patcher.ModelPatcher):
+        return patcher.model_size()
+    return sum(comfy.model_management.module_size(x) for x in vars(obj).values() if isinstance(x, torch.nn.Module))
+
+def clone_object(obj):
+    if isinstance(obj, tuple):
+        return tuple(clone_object(x) for x in obj)
+    if isinstance(obj, list):
+        return [clone_object(x) for x in obj]
+    # Patchable objects get cloned so patches applied downstream don't leak into the
+    # cached copy, the others (VAE, controlnets, clip vision) are never modified in place.
+    if hasattr(obj, "clone"):
+        return obj.clone()
+    return obj
+
+def get_modules(obj):
+    if isinstance(obj, (tuple, list)):
+        return [m for x in obj for m in get_modules(x)]
+    if isinstance(obj, comfy.model_patcher.ModelPatcher):
+        return [obj.model]
+    patcher = getattr(obj, "patcher", None)
+    if isinstance(patcher, comfy.model_patcher.ModelPatcher):
+        return [patcher.model]
+    return []
+
+def get_weight_modules(obj):
+    if isinstance(obj, (tuple, list)):
+        return [m for x in obj for m in get_weight_modules(x)]
+    modules = get_modules(obj)
+    if len(modules) == 0 and obj is not None:
+        modules = [x for x in vars(obj).values() if isinstance(x, torch.nn.Module)]
+    return modules
+
+def get_data_ptrs(module):
+    return tuple(x.data_ptr() for x in module.state_dict().values())
+
+def write_module(module, path):
+    """Writes the weights of module to path, returns them and the memory mapped copies."""
+    sd = module.state_dict(keep_vars=True)
+    torch.save({k: v.detach() for k, v in sd.items()}, path)
+    return sd, torch.load(path, mmap=True, weights_only=True)
+
+def map_module(module, sd, mapped):
+    """Swaps the weights for the copy on write mapped ones so they can be paged out, returns their data pointers."""
+    # Replacing the data keeps the parameters and the weights tied to them
+    for k, v in sd.items():
+        v.data = mapped[k]
+    return get_data_ptrs(module)
+
+def spill_module(module, path):
+    """
+    Writes the weights of module to path and swaps them for copy on write memory mapped
+    views of it so they can be paged out. Returns the data pointers of the mapped weights.
+    """
+    sd, mapped = write_module(module, path)
+    return map_module(module, sd, mapped)
+
+def write_spill(entry, directory):
+    """
+    Writes the weights of the entry to files in directory. Returns (module, path,
+    weights, mapped weights, data pointers) for each module, None if the model is
+    loaded on a device.
+    """
+    modules = get_weight_modules(entry.value)
+    if len(modules) == 0:
+        raise ValueError("no weights to write")
+    for module in modules:
+        # Models that are still loaded on a device can't be written from RAM
+        if any(x.device.type != "cpu" for x in module.state_dict().values()):
+            return None
+
+    written = []
+    paths = []
+    try:
+        os.makedirs(directory, exist_ok=True)
+        for module in modules:
+            path = os.path.join(directory, "{}.pt".format(uuid.uuid4().hex))
+            paths.append(path)
+            ptrs = get_data_ptrs(module)
+            written.append((module, path) + write_module(module, path) + (ptrs,))
+    except:
+        for path in paths:
+            delete_file(path)
+        raise
+    return written
+
+def delete_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        # Windows doesn't delete files that are still mapped
+        logging.debug("Failed to delete {}: {}".format(path, e))
+        return False
+    return True
+
+def get_model_files(patcher):
+    # The files each loaded model came from, used by the prompt workers to find which device
+    # has the models of a prompt and by the eviction policies to keep the ones queued prompts need
+    return comfy.model_eviction.get_model_stats(patcher.model).files
+
+class CacheEntry:
+    def __init__(self, kind, files, value):
+        self.kind = kind
+        self.files = files
+        self.value = value
+        self.size = object_size(value)
+        self.hits = 0
+        #(module, path, data pointers) of the weights written to the disk tier
+        self.spilled = []
+        #queued to be written to the disk tier
+        self.spilling = False
+
+    def is_spilled(self):
+        # Loading the model on a device and back replaces the mapped weights
+        return len(self.spilled) > 0 and all(get_data_ptrs(module) == ptrs for module, path, ptrs in self.spilled)
+
+class ModelCache:
+    """
+    Keeps loaded models around so loader nodes in any workflow get the same weights
+    without reading them again. Entries are keyed by the files they were loaded from
+    (path, mtime and size) and the load options, the least recently used ones are
+    dropped once their total size goes over ram_budget bytes.
+
+    With a disk_budget the entries dropped from RAM go to a disk tier instead: their
+    weights, already converted and cast, are written to files in directory and
+    replaced by memory mapped views so the OS can page them out. Getting one of them
+    back only maps the pages in again instead of loading the checkpoint again. The
+    files are written by a background thread, the entries stay in RAM and can be hit
+    until they are written. The entry used last is never moved, even without a RAM
+    budget, since a prompt is using it.
+    """
+    def __init__(self, ram_budget=0, disk_budget=0, directory=None):
+        self.ram_budget = ram_budget
+        self.disk_budget = disk_budget
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.disk_entries = OrderedDict()
+        self.loading = {}
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.spill_queue = queue.Queue()
+        self.spill_thread = None
+        #files of the disk tier that couldn't be deleted yet
+        self.pending_deletes = []
+
+    def enabled(self):
+        return self.ram_budget > 0 or self.disk_budget > 0
+
+    def load(self, kind, paths, load_function, options=()):
+        if not self.enabled():
+            return self.load_uncached(paths, load_function)
+
+        files = tuple(file_key(x) for x in paths)
+        # Models are created for the device of the prompt worker loading them
+        key = (kind, files, options, str(comfy.model_management.get_torch_device()))
+        while True:
+            with self.lock:
+                entry = self.entries.get(key, None)
+                if entry is not None:
+                    self.entries.move_to_end(key)
+                    entry.hits += 1
+                    self.hits += 1
+                    return clone_object(entry.value)
+
+                entry = self.disk_entries.pop(key, None)
+                if entry is not None:
+                    entry.hits += 1
+                    self.disk_hits += 1
+                    self.entries[key] = entry
+                    self.evict()
+                    return clone_object(entry.value)
+
+                # The lock isn't held while reading the files so loads of other models,
+                # for other devices too, don't wait for this one. The same model is only
+                # loaded once at a time.
+                loading = self.loading.get(key, None)
+                if loading is None:
+                    loading = threading.Event()
+                    self.loading[key] = loading
+                    self.misses += 1
+                    break
+            loading.wait()
+
+        try:
+            value = self.load_uncached(paths, load_function)
+            entry = CacheEntry(kind, files, value)
+        except:
+            with self.lock:
+                self.loading.pop(key).set()
+            raise
+
+        with self.lock:
+            # The ones waiting check the entries again once they get the lock
+            self.loading.pop(key).set()
+            self.remove_stale(files)
+            if entry.size > max(self.ram_budget, self.disk_budget):
+                logging.debug("{} is bigger than the model cache, not caching it".format(paths))
+                return value
+            self.entries[key] = entry
+            self.evict()
+            return clone_object(value)
+
+    def load_uncached(self, paths, load_function):
+        value = load_function()
+        paths = tuple(os.path.abspath(x) for x in paths)
+        for module in get_modules(value):
+            comfy.model_eviction.get_model_stats(module).files = paths
+        return value
+
+    def remove_stale(self, files):
+        # Entries for older versions of files that were just loaded again can never be hit
+        paths = set(x[0] for x in files)
+        for entries in (self.entries, self.disk_entries):
+            for key in list(entries.keys()):
+                entry = entries[key]
+                if any(x[0] in paths and x not in files for x in entry.files):
+                    self.delete_files(entries.pop(key))
+
+    def evict(self):
+        self.retry_deletes()
+        ram_used = self.ram_used()
+        # The entry used last stays in RAM, it's the one a prompt is about to use
+        for key, entry in list(self.entries.items())[:-1]:
+            if ram_used <= self.ram_budget:
+                break
+            ram_used -= entry.size
+            if self.disk_budget > 0 and self.directory is not None and entry.size <= self.disk_budget:
+                if entry.is_spilled():
+                    # Its weights are still mapped from the file written before
+                    del self.entries[key]
+                    self.disk_entries[key] = entry
+                elif not entry.spilling:
+                    entry.spilling = True
+                    self.queue_spill(key, entry)
+            else:
+                logging.debug("Dropping {} from the model cache".format(key[1][0][0]))
+                self.delete_files(self.entries.pop(key))
+
+        while self.disk_used() > self.disk_budget and len(self.disk_entries) > 0:
+            key, entry = self.disk_entries.popitem(last=False)
+            logging.debug("Dropping {} from the disk tier of the model cache".format(key[1][0][0]))
+            self.delete_files(entry)
+
+    def queue_spill(self, key, entry):
+        if self.spill_thread is None:
+            self.spill_thread = threading.Thread(target=self.spill_loop, name="model_cache_spill", daemon=True)
+            self.spill_thread.start()
+        self.spill_queue.put((key, entry))
+
+    def spill_loop(self):
+        while True:
+            key, entry = self.spill_queue.get()
+            try:
+                self.spill(key, entry)
+            except Exception as e:
+                logging.warning("Failed to move {} to the disk tier of the model cache: {}".format(key[1][0][0], e))
+            finally:
+                self.spill_queue.task_done()
+
+    def spill(self, key, entry):
+        # The weights are written without the lock, the entry can be hit in the meantime
+        spilled = None
+        failed = False
+        try:
+            written = write_spill(entry, self.directory)
+        except Exception as e:
+            logging.warning("Failed to move {} to the disk tier of the model cache: {}".format(key[1][0][0], e))
+            written = None
+            failed = True
+        if written is not None:
+            # The model can't move to or from its device while its weights are swapped,
+            # the ones that moved while they were written are left alone
+            with comfy.model_management.get_device_lock(key[3]):
+                if all(get_data_ptrs(module) == ptrs for module, path, sd, mapped, ptrs in written):
+                    spilled = [(module, path, map_module(module, sd, mapped)) for module, path, sd, mapped, ptrs in written]
+            if spilled is None:
+                for x in written:
+                    self.delete_file(x[1])
+
+        with self.lock:
+            entry.spilling = False
+            if self.entries.get(key, None) is not entry:
+                # Dropped or cleared while it was written
+                for module, path, ptrs in spilled or []:
+                    self.delete_file(path)
+                return
+            if spilled is None:
+                if failed:
+                    logging.debug("Dropping {} from the model cache".format(key[1][0][0]))
+                    self.delete_files(self.entries.pop(key))
+                # Otherwise it's in use on a device, it's tried again on the next eviction
+                return
+            logging.debug("Moving {} to the disk tier of the model cache".format(key[1][0][0]))
+            self.delete_files(entry)
+            entry.spilled = spilled
+            del self.entries[key]
+            self.disk_entries[key] = entry
+            self.evict()
+
+    def flush(self):
+        """Waits for the entries that are being moved to the disk tier."""
+        self.spill_queue.join()
+
+    def delete_files(self, entry):
+        for module, path, ptrs in entry.spilled:
+            self.delete_file(path)
+        entry.spilled = []
+
+    def delete_file(self, path):
+        # Clones that are still used keep the mapping of a deleted file alive, where that
+        # stops the file from being deleted it's tried again on the next eviction
+        if not delete_file(path):
+            with self.lock:
+                self.pending_deletes.append(path)
+
+    def retry_deletes(self):
+        with self.lock:
+            if len(self.pending_deletes) > 0:
+                self.pending_deletes = [x for x in self.pending_deletes if not delete_file(x)]
+
+    def ram_used(self):
+        return sum(x.size for x in self.entries.values())
+
+    def disk_used(self):
+        return sum(x.size for x in self.disk_entries.values())
+
+    def clear(self):
+        with self.lock:
+            for entry in list(self.entries.values()) + list(self.disk_entries.values()):
+                self.delete_files(entry)
+            self.entries.clear()
+            self.disk_entries.clear()
+            self.retry_deletes()
+            if len(self.pending_deletes) > 0:
+                logging.warning("{} files of the disk tier of the model cache are still in use and couldn't be deleted".format(len(self.pending_deletes)))
+
+    def get_files(self):
+        with self.lock:
+            return set(f[0] for x in self.entries.values() for f in x.files)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "ram_budget": self.ram_budget,
+                "ram_used": self.ram_used(),
+                "disk_budget": self.disk_budget,
+                "disk_used": self.disk_used(),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "models": [{"type": x.kind, "files": [f[0] for f in x.files], "size": x.size, "hits": x.hits, "tier": tier}
+                           for tier, entries in (("ram", self.entries), ("disk", self.disk_entries)) for x in entries.values()],
+            }
+
+model_cache = ModelCache(ram_budget=int(args.model_cache_ram * (1024 ** 3)))
+
+def set_disk_tier(directory, disk_budget):
+    with model_cache.lock:
+        model_cache.directory = directory
+        model_cache.disk_budget = disk_budget
+
+def load(kind, paths, load_function, options=()):
+    return model_cache.load(kind, paths, load_function, options)
+
+def clear():
+    model_cache.clear()
+
+def get_stats():
+    return model_cache.get_stats()
+
+def get_loaded_files():
+    """Paths of the models that are in the cache or loaded on a device, they usually don't get read again."""
+    out = model_cache.get_files()
+    with comfy.model_management.models_lock:
+        for loaded in comfy.model_management.current_loaded_models:
+            out.update(get_model_files(loaded.model))
+    return out
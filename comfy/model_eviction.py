@@ -0,0 +1,158 @@
+import time
+import threading
+import weakref
+
+class ModelStats:
+    """What the eviction policies know about the weights of a model, shared by its clones."""
+    def __init__(self):
+        self.files = ()
+        self.uses = 0
+        self.last_used = 0.0
+        #measured time to move one byte of the model to its device, None until it was loaded once
+        self.seconds_per_byte = None
+
+model_stats = weakref.WeakKeyDictionary()
+stats_lock = threading.Lock()
+
+def get_model_stats(module):
+    with stats_lock:
+        stats = model_stats.get(module, None)
+        if stats is None:
+            stats = ModelStats()
+            model_stats[module] = stats
+        return stats
+
+class Candidate:
+    def __init__(self, index, size, refcount, stats, distance=None):
+        self.index = index
+        self.size = size
+        self.refcount = refcount
+        self.stats = stats
+        #how many prompts ahead the model is needed, 0 for the running prompts, None if it isn't
+        self.distance = distance
+
+class EvictionPolicy:
+    """Orders the models that can be unloaded from a device, the first ones are unloaded first."""
+    use_lookahead = True
+
+    def key(self, candidate, counters, now):
+        raise NotImplementedError
+
+    def order(self, candidates, counters, now=None):
+        if now is None:
+            now = time.perf_counter()
+        def sort_key(candidate):
+            key = self.key(candidate, counters, now)
+            if not self.use_lookahead:
+                return key
+            # Models no queued prompt needs go first, then the ones needed the furthest ahead
+            if candidate.distance is None:
+                return (0, 0, key)
+            return (1, -candidate.distance, key)
+        return sorted(candidates, key=sort_key)
+
+class DefaultPolicy(EvictionPolicy):
+    """The models with the fewest references go first, then the smallest ones."""
+    use_lookahead = False
+
+    def key(self, candidate, counters, now):
+        return (candidate.refcount, candidate.size, candidate.index)
+
+class LRUPolicy(EvictionPolicy):
+    def key(self, candidate, counters, now):
+        return (candidate.stats.last_used, candidate.index)
+
+class LFUPolicy(EvictionPolicy):
+    def key(self, candidate, counters, now):
+        return (candidate.stats.uses, candidate.stats.last_used, candidate.index)
+
+class CostPolicy(EvictionPolicy):
+    """
+    Unloads the models whose reload costs the fewest seconds for each byte it frees,
+    weighted by how often they are used and how recently. Freeing memory this way
+    costs the least reload time for the memory freed. The reload seconds of a model
+    are its size times its measured transfer rate, so the key is the transfer rate:
+    when all the models move at the same rate this is an LFU with decay, models that
+    load slower per byte (read from the disk again, cast or patched on the way) are
+    kept longer. Models that were never timed use the rate measured for all the loads.
+    """
+    def __init__(self, half_life=300.0):
+        self.half_life = half_life
+
+    def key(self, candidate, counters, now):
+        seconds_per_byte = candidate.stats.seconds_per_byte
+        if seconds_per_byte is None:
+            seconds_per_byte = counters.get_seconds_per_byte()
+        idle = max(now - candidate.stats.last_used, 0.0)
+        weight = (1 + candidate.stats.uses) * 0.5 ** (idle / self.half_life)
+        return (seconds_per_byte * weight, candidate.index)
+
+POLICIES = {
+    "default": DefaultPolicy,
+    "lru": LRUPolicy,
+    "lfu": LFUPolicy,
+    "cost": CostPolicy,
+}
+
+def get_policy(name):
+    return POLICIES[name]()
+
+class EvictionCounters:
+    #transfer rate assumed before any load was timed
+    DEFAULT_SECONDS_PER_BYTE = 1.0 / (4 * 1024 ** 3)
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_loaded = 0
+        self.bytes_evicted = 0
+        self.load_seconds = 0.0
+        # Its own lock so the stats can be read while models are loaded
+        self.lock = threading.Lock()
+
+    def record_hit(self):
+        with self.lock:
+            self.hits += 1
+
+    def record_load(self, stats, size, seconds):
+        with self.lock:
+            self.misses += 1
+            if size <= 0:
+                return
+            self.bytes_loaded += size
+            self.load_seconds += seconds
+        stats.seconds_per_byte = seconds / size
+
+    def record_eviction(self, size):
+        with self.lock:
+            self.evictions += 1
+            self.bytes_evicted += size
+
+    def get_seconds_per_byte(self):
+        with self.lock:
+            if self.bytes_loaded == 0 or self.load_seconds <= 0:
+                return self.DEFAULT_SECONDS_PER_BYTE
+            return self.load_seconds / self.bytes_loaded
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "bytes_loaded": self.bytes_loaded,
+                "bytes_evicted": self.bytes_evicted,
+                "load_seconds": self.load_seconds,
+            }
+
+#model file -> how many prompts ahead it's needed, updated by the prompt workers
+upcoming_files = {}
+
+def set_upcoming_files(files):
+    global upcoming_files
+    upcoming_files = files
+
+def get_distance(stats):
+    distances = [upcoming_files[x] for x in stats.files if x in upcoming_files]
+    return min(distances, default=None)
@@ -5,6 +5,11 @@ from comfy.cli_args import args
 import torch
 import sys
 import platform
+import functools
+import threading
+import contextlib
+import time
+import comfy.model_eviction
 
 class VRAMState(Enum):
     DISABLED = 0    #No vram present: no need to move models to vram
@@ -71,9 +76,20 @@ def is_intel_xpu():
             return True
     return False
 
+#per thread device set by the prompt workers when running with several devices
+thread_device = threading.local()
+
+def set_thread_torch_device(device):
+    thread_device.device = device
+    if device is not None and device.type == "cuda":
+        torch.cuda.set_device(device)
+
 def get_torch_device():
     global directml_enabled
     global cpu_state
+    device = getattr(thread_device, "device", None)
+    if device is not None:
+        return device
     if directml_enabled:
         global directml_device
         return directml_device
@@ -262,6 +278,36 @@ logging.info("VAE dtype: {}".format(VAE_DTYPE))
 
 current_loaded_models = []
 
+#the prompt workers of different devices share current_loaded_models, models_lock is only
+#held while the list is read or changed. Moving weights to or from a device happens under the
+#lock of that device so the workers of the other devices aren't blocked by it. A device lock
+#is never taken while holding models_lock.
+models_lock = threading.RLock()
+device_locks = {}
+
+def with_models_lock(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with models_lock:
+            return func(*args, **kwargs)
+    return wrapper
+
+def get_device_lock(device):
+    with models_lock:
+        lock = device_locks.get(str(device), None)
+        if lock is None:
+            lock = threading.RLock()
+            device_locks[str(device)] = lock
+        return lock
+
+def remove_loaded_model(loaded):
+    with models_lock:
+        for i in range(len(current_loaded_models)):
+            if current_loaded_models[i] is loaded:
+                current_loaded_models.pop(i)
+                return True
+    return False
+
 def module_size(module):
     module_mem = 0
     sd = module.state_dict()
@@ -270,6 +316,15 @@ def module_size(module):
         module_mem += t.nelement() * t.element_size()
     return module_mem
 
+#bytes of model weights moved between devices by loading and unloading models, used for profiling
+model_bytes_moved = 0
+
+eviction_policy = comfy.model_eviction.get_policy(args.model_eviction.value)
+eviction_counters = comfy.model_eviction.EvictionCounters()
+
+def get_model_stats(model):
+    return comfy.model_eviction.get_model_stats(getattr(model, "model", model))
+
 class LoadedModel:
     def __init__(self, model):
         self.model = model
@@ -288,7 +343,11 @@ class LoadedModel:
             return self.model_memory()
 
     def model_load(self, lowvram_model_memory=0, force_patch_weights=False):
+        global model_bytes_moved
         patch_model_to = self.device
+        bytes_to_move = self.model_memory_required(patch_model_to)
+        model_bytes_moved += bytes_to_move
+        load_start = time.perf_counter()
 
         self.model.model_patches_to(self.device)
         self.model.model_patches_to(self.model.model_dtype())
@@ -309,6 +368,7 @@ class LoadedModel:
             self.real_model = ipex.optimize(self.real_model.eval(), graph_mode=True, concat_linear=True)
 
         self.weights_loaded = True
+        eviction_counters.record_load(get_model_stats(self.model), bytes_to_move, time.perf_counter() - load_start)
         return self.real_model
 
     def should_reload_model(self, force_patch_weights=False):
@@ -317,6 +377,9 @@ class LoadedModel:
         return False
 
     def model_unload(self, unpatch_weights=True):
+        global model_bytes_moved
+        if unpatch_weights and self.model.current_device != self.model.offload_device:
+            model_bytes_moved += self.model_memory()
         self.model.unpatch_model(self.model.offload_device, unpatch_weights=unpatch_weights)
         self.model.model_patches_to(self.model.offload_device)
         self.weights_loaded = self.weights_loaded and not unpatch_weights
@@ -328,18 +391,20 @@ class LoadedModel:
 def minimum_inference_memory():
     return (1024 * 1024 * 1024)
 
-def unload_model_clones(model, unload_weights_only=True, force_unload=True):
-    to_unload = []
-    for i in range(len(current_loaded_models)):
-        if model.is_clone(current_loaded_models[i].model):
-            to_unload = [i] + to_unload
+def unload_model_clones(model, unload_weights_only=True, force_unload=True, keep_patched_weights=False):
+    with get_device_lock(model.load_device):
+        return unload_model_clones_locked(model, unload_weights_only, force_unload, keep_patched_weights)
+
+def unload_model_clones_locked(model, unload_weights_only, force_unload, keep_patched_weights):
+    with models_lock:
+        to_unload = [x for x in current_loaded_models if model.is_clone(x.model)]
 
     if len(to_unload) == 0:
         return True
 
     same_weights = 0
-    for i in to_unload:
-        if model.clone_has_same_weights(current_loaded_models[i].model):
+    for loaded in to_unload:
+        if model.clone_has_same_weights(loaded.model):
             same_weights += 1
 
     if same_weights == len(to_unload):
@@ -351,33 +416,47 @@ def unload_model_clones(model, unload_weights_only=True, force_unload=True):
         if unload_weights_only and unload_weight == False:
             return None
 
-    for i in to_unload:
-        logging.debug("unload clone {} {}".format(i, unload_weight))
-        current_loaded_models.pop(i).model_unload(unpatch_weights=unload_weight)
+    for loaded in to_unload:
+        logging.debug("unload clone {} {}".format(loaded.model, unload_weight))
+        if not remove_loaded_model(loaded):
+            continue
+        if unload_weight and keep_patched_weights and not loaded.model.model_lowvram:
+            #the weights stay where they are, model will only repatch the keys with different patches
+            loaded.model_unload(unpatch_weights=False)
+            model.current_device = loaded.model.current_device
+        else:
+            loaded.model_unload(unpatch_weights=unload_weight)
 
     return unload_weight
 
 def free_memory(memory_required, device, keep_loaded=[]):
+    with get_device_lock(device):
+        free_memory_locked(memory_required, device, keep_loaded)
+
+def free_memory_locked(memory_required, device, keep_loaded):
     unloaded_model = []
     can_unload = []
 
-    for i in range(len(current_loaded_models) -1, -1, -1):
-        shift_model = current_loaded_models[i]
+    with models_lock:
+        loaded = list(current_loaded_models)
+    for i in range(len(loaded) -1, -1, -1):
+        shift_model = loaded[i]
         if shift_model.device == device:
             if shift_model not in keep_loaded:
-                can_unload.append((sys.getrefcount(shift_model.model), shift_model.model_memory(), i))
+                stats = get_model_stats(shift_model.model)
+                can_unload.append(comfy.model_eviction.Candidate(i, shift_model.model_memory(), sys.getrefcount(shift_model.model), stats, comfy.model_eviction.get_distance(stats)))
                 shift_model.currently_used = False
 
-    for x in sorted(can_unload):
-        i = x[-1]
+    for x in eviction_policy.order(can_unload, eviction_counters):
         if not DISABLE_SMART_MEMORY:
             if get_free_memory(device) > memory_required:
                 break
-        current_loaded_models[i].model_unload()
-        unloaded_model.append(i)
-
-    for i in sorted(unloaded_model, reverse=True):
-        current_loaded_models.pop(i)
+        # Out of the list first so the other workers never see a model that's half unloaded
+        if not remove_loaded_model(loaded[x.index]):
+            continue
+        loaded[x.index].model_unload()
+        eviction_counters.record_eviction(x.size)
+        unloaded_model.append(x.index)
 
     if len(unloaded_model) > 0:
         soft_empty_cache()
@@ -388,32 +467,48 @@ def free_memory(memory_required, device, keep_loaded=[]):
                 soft_empty_cache()
 
 def load_models_gpu(models, memory_required=0, force_patch_weights=False):
+    models = set(models)
+    devices = sorted(set(str(x.load_device) for x in models))
+    with contextlib.ExitStack() as stack:
+        for device in devices:
+            stack.enter_context(get_device_lock(device))
+        return load_models_gpu_locked(models, memory_required, force_patch_weights)
+
+def load_models_gpu_locked(models, memory_required, force_patch_weights):
     global vram_state
 
     inference_memory = minimum_inference_memory()
     extra_mem = max(inference_memory, memory_required)
 
-    models = set(models)
-
     models_to_load = []
     models_already_loaded = []
+    now = time.perf_counter()
     for x in models:
+        stats = get_model_stats(x)
+        stats.uses += 1
+        stats.last_used = now
         loaded_model = LoadedModel(x)
         loaded = None
+        reload = None
 
-        try:
-            loaded_model_index = current_loaded_models.index(loaded_model)
-        except:
-            loaded_model_index = None
+        with models_lock:
+            try:
+                loaded_model_index = current_loaded_models.index(loaded_model)
+            except:
+                loaded_model_index = None
 
-        if loaded_model_index is not None:
-            loaded = current_loaded_models[loaded_model_index]
-            if loaded.should_reload_model(force_patch_weights=force_patch_weights): #TODO: cleanup this model reload logic
-                current_loaded_models.pop(loaded_model_index).model_unload(unpatch_weights=True)
-                loaded = None
-            else:
-                loaded.currently_used = True
-                models_already_loaded.append(loaded)
+            if loaded_model_index is not None:
+                loaded = current_loaded_models[loaded_model_index]
+                if loaded.should_reload_model(force_patch_weights=force_patch_weights): #TODO: cleanup this model reload logic
+                    reload = current_loaded_models.pop(loaded_model_index)
+                    loaded = None
+                else:
+                    loaded.currently_used = True
+                    eviction_counters.record_hit()
+                    models_already_loaded.append(loaded)
+
+        if reload is not None:
+            reload.model_unload(unpatch_weights=True)
 
         if loaded is None:
             if hasattr(x, "model"):
@@ -431,7 +526,7 @@ def load_models_gpu(models, memory_required=0, force_patch_weights=False):
 
     total_memory_required = {}
     for loaded_model in models_to_load:
-        if unload_model_clones(loaded_model.model, unload_weights_only=True, force_unload=False) == True:#unload clones where the weights are different
+        if unload_model_clones(loaded_model.model, unload_weights_only=True, force_unload=False, keep_patched_weights=True) == True:#unload clones where the weights are different
             total_memory_required[loaded_model.device] = total_memory_required.get(loaded_model.device, 0) + loaded_model.model_memory_required(loaded_model.device)
 
     for device in total_memory_required:
@@ -462,13 +557,21 @@ def load_models_gpu(models, memory_required=0, force_patch_weights=False):
             lowvram_model_memory = 64 * 1024 * 1024
 
         cur_loaded_model = loaded_model.model_load(lowvram_model_memory, force_patch_weights=force_patch_weights)
-        current_loaded_models.insert(0, loaded_model)
+        with models_lock:
+            current_loaded_models.insert(0, loaded_model)
     return
 
 
 def load_model_gpu(model):
     return load_models_gpu([model])
 
+def get_eviction_stats():
+    out = eviction_counters.get_stats()
+    out["policy"] = args.model_eviction.value
+    out["bytes_moved"] = model_bytes_moved
+    return out
+
+@with_models_lock
 def loaded_models(only_currently_used=False):
     output = []
     for m in current_loaded_models:
@@ -481,18 +584,19 @@ def loaded_models(only_currently_used=False):
 
 def cleanup_models(keep_clone_weights_loaded=False):
     to_delete = []
-    for i in range(len(current_loaded_models)):
-        if sys.getrefcount(current_loaded_models[i].model) <= 2:
-            if not keep_clone_weights_loaded:
-                to_delete = [i] + to_delete
-            #TODO: find a less fragile way to do this.
-            elif sys.getrefcount(current_loaded_models[i].real_model) <= 3: #references from .real_model + the .model
-                to_delete = [i] + to_delete
-
-    for i in to_delete:
-        x = current_loaded_models.pop(i)
-        x.model_unload()
-        del x
+    with models_lock:
+        for i in range(len(current_loaded_models)):
+            if sys.getrefcount(current_loaded_models[i].model) <= 2:
+                if not keep_clone_weights_loaded:
+                    to_delete = [i] + to_delete
+                #TODO: find a less fragile way to do this.
+                elif sys.getrefcount(current_loaded_models[i].real_model) <= 3: #references from .real_model + the .model
+                    to_delete = [i] + to_delete
+        to_delete = [current_loaded_models.pop(i) for i in to_delete]
+
+    for x in to_delete:
+        with get_device_lock(x.device):
+            x.model_unload()
 
 def dtype_size(dtype):
     dtype_size = 4
@@ -889,8 +993,13 @@ def soft_empty_cache(force=False):
             torch.cuda.empty_cache()
             torch.cuda.ipc_collect()
 
+#called by unload_all_models to drop the models that are kept outside of current_loaded_models
+unload_all_callbacks = []
+
 def unload_all_models():
     free_memory(1e30, get_torch_device())
+    for callback in unload_all_callbacks:
+        callback()
 
 
 def resolve_lowvram_weight(weight, model, key): #TODO: remove
@@ -3,10 +3,12 @@ import copy
 import inspect
 import logging
 import uuid
+from collections import OrderedDict
 
 import comfy.utils
 import comfy.model_management
 from comfy.types import UnetWrapperFunction
+from comfy.cli_args import args
 
 
 def weight_decompose(dora_scale, weight, lora_diff, alpha, strength):
@@ -30,6 +32,54 @@ def weight_decompose(dora_scale, weight, lora_diff, alpha, strength):
     return weight
 
 
+def patch_value_key(v):
+    if isinstance(v, torch.Tensor):
+        return ("tensor", id(v))
+    if isinstance(v, (list, tuple)):
+        return tuple(patch_value_key(x) for x in v)
+    return v
+
+def patches_fingerprint(patches):
+    # Tensors are compared by identity, whoever keeps the fingerprint must also keep
+    # the patches so the ids can't be reused.
+    return tuple((p[0], patch_value_key(p[1]), p[2]) for p in patches)
+
+class PatchedWeightCache:
+    """
+    Patched weights of one model keyed by (weight key, patches fingerprint), kept on
+    the offload device up to max_size bytes so switching back to a previous set of
+    loras doesn't need to calculate them again.
+    """
+    def __init__(self, max_size=0):
+        self.max_size = max_size
+        self.size = 0
+        self.cache = OrderedDict()
+
+    def get(self, key, patches):
+        if self.max_size <= 0:
+            return None
+        cache_key = (key, patches_fingerprint(patches))
+        entry = self.cache.get(cache_key, None)
+        if entry is None:
+            return None
+        self.cache.move_to_end(cache_key)
+        return entry[1]
+
+    def set(self, key, patches, weight, device):
+        if self.max_size <= 0:
+            return
+        weight_size = weight.nelement() * weight.element_size()
+        if weight_size > self.max_size:
+            return
+        cache_key = (key, patches_fingerprint(patches))
+        if cache_key in self.cache:
+            return
+        self.cache[cache_key] = (list(patches), weight.to(device, copy=True))
+        self.size += weight_size
+        while self.size > self.max_size:
+            _, (_, w) = self.cache.popitem(last=False)
+            self.size -= w.nelement() * w.element_size()
+
 def set_model_options_patch_replace(model_options, patch, name, block_name, number, transformer_index=None):
     to = model_options["transformer_options"].copy()
 
@@ -57,6 +107,8 @@ class ModelPatcher:
         self.model = model
         self.patches = {}
         self.backup = {}
+        self.applied_patches = {}
+        self.weight_cache = PatchedWeightCache(int(args.patched_weight_cache_ram * (1024 ** 3)))
         self.object_patches = {}
         self.object_patches_backup = {}
         self.model_options = {"transformer_options":{}}
@@ -89,6 +141,8 @@ class ModelPatcher:
         n.object_patches = self.object_patches.copy()
         n.model_options = copy.deepcopy(self.model_options)
         n.backup = self.backup
+        n.applied_patches = self.applied_patches
+        n.weight_cache = self.weight_cache
         n.object_patches_backup = self.object_patches_backup
         return n
 
@@ -252,11 +306,20 @@ class ModelPatcher:
         if key not in self.backup:
             self.backup[key] = weight.to(device=self.offload_device, copy=inplace_update)
 
-        if device_to is not None:
-            temp_weight = comfy.model_management.cast_to_device(weight, device_to, torch.float32, copy=True)
+        out_weight = self.weight_cache.get(key, self.patches[key])
+        if out_weight is not None:
+            if device_to is None:
+                device_to = weight.device
+            out_weight = out_weight.to(device_to, copy=True)
         else:
-            temp_weight = weight.to(torch.float32, copy=True)
-        out_weight = self.calculate_weight(self.patches[key], temp_weight, key).to(weight.dtype)
+            if device_to is not None:
+                temp_weight = comfy.model_management.cast_to_device(weight, device_to, torch.float32, copy=True)
+            else:
+                temp_weight = weight.to(torch.float32, copy=True)
+            out_weight = self.calculate_weight(self.patches[key], temp_weight, key).to(weight.dtype)
+            self.weight_cache.set(key, self.patches[key], out_weight, self.offload_device)
+
+        self.applied_patches[key] = (patches_fingerprint(self.patches[key]), self.patches[key])
         if inplace_update:
             comfy.utils.copy_to_param(self.model, key, out_weight)
         else:
@@ -269,11 +332,16 @@ class ModelPatcher:
                 self.object_patches_backup[k] = old
 
         if patch_weights:
+            # Another clone might have left its patched weights, only the keys that
+            # are patched differently need to be calculated again.
+            self.restore_weights(keep_applied=True)
             model_sd = self.model_state_dict()
             for key in self.patches:
                 if key not in model_sd:
                     logging.warning("could not patch. key doesn't exist in model: {}".format(key))
                     continue
+                if key in self.backup:
+                    continue
 
                 self.patch_weight_to_device(key, device_to)
 
@@ -284,6 +352,7 @@ class ModelPatcher:
         return self.model
 
     def patch_model_lowvram(self, device_to=None, lowvram_model_memory=0, force_patch_weights=False):
+        self.restore_weights()
         self.patch_model(device_to, patch_weights=False)
 
         logging.info("loading in lowvram mode {}".format(lowvram_model_memory/(1024 * 1024)))
@@ -490,6 +559,22 @@ class ModelPatcher:
 
         return weight
 
+    def has_applied_patches(self, key):
+        if key not in self.applied_patches or key not in self.patches:
+            return False
+        return self.applied_patches[key][0] == patches_fingerprint(self.patches[key])
+
+    def restore_weights(self, keep_applied=False):
+        for k in list(self.backup.keys()):
+            if keep_applied and self.has_applied_patches(k):
+                continue
+            if self.weight_inplace_update:
+                comfy.utils.copy_to_param(self.model, k, self.backup[k])
+            else:
+                comfy.utils.set_attr_param(self.model, k, self.backup[k])
+            del self.backup[k]
+            self.applied_patches.pop(k, None)
+
     def unpatch_model(self, device_to=None, unpatch_weights=True):
         if unpatch_weights:
             if self.model_lowvram:
@@ -503,16 +588,7 @@ class ModelPatcher:
                 self.model_lowvram = False
                 self.lowvram_patch_counter = 0
 
-            keys = list(self.backup.keys())
-
-            if self.weight_inplace_update:
-                for k in keys:
-                    comfy.utils.copy_to_param(self.model, k, self.backup[k])
-            else:
-                for k in keys:
-                    comfy.utils.set_attr_param(self.model, k, self.backup[k])
-
-            self.backup.clear()
+            self.restore_weights()
 
             if device_to is not None:
                 self.model.to(device_to)
@@ -0,0 +1,148 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+
+import safetensors.torch
+
+def file_key(path):
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+class ModelPrefetcher:
+    """
+    Reads the model files the queued prompts will need into RAM on a background
+    thread so loading them overlaps the prompt that's running. get_wanted returns
+    the paths in the order they will be loaded, they are staged in that order as
+    long as they fit in ram_budget bytes, and the paths the running prompts still
+    need. Staged files that are in neither are dropped.
+
+    load_torch_file takes the staged state dict of a file instead of reading it,
+    each one is only handed out once. Only safetensors files are prefetched.
+    """
+    def __init__(self, ram_budget, get_wanted, interval=1.0):
+        self.ram_budget = ram_budget
+        self.get_wanted = get_wanted
+        self.interval = interval
+        self.staged = OrderedDict()
+        self.loading = None
+        self.lock = threading.Lock()
+        self.loaded = threading.Condition(self.lock)
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.hits = 0
+        self.prefetched = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="model_prefetch", daemon=True)
+        self.thread.start()
+
+    def update(self):
+        """The queue changed, look at what the prompts want now instead of waiting for the next check."""
+        self.wakeup.set()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(timeout=self.interval)
+            self.wakeup.clear()
+            try:
+                self.prefetch(*self.get_wanted())
+            except Exception as e:
+                logging.warning("Failed to prefetch the models of the queued prompts: {}".format(e))
+
+    def ram_used(self):
+        return sum(x[2] for x in self.staged.values())
+
+    def prefetch(self, wanted, keep=()):
+        wanted = [os.path.abspath(x) for x in wanted if x.lower().endswith(".safetensors")]
+        # A prompt that started running takes its files once it gets to its loaders
+        keep = set(os.path.abspath(x) for x in keep)
+        with self.lock:
+            for path in [x for x in self.staged if x not in wanted and x not in keep]:
+                del self.staged[path]
+
+        for path in wanted:
+            try:
+                key = file_key(path)
+            except OSError:
+                continue
+            with self.lock:
+                entry = self.staged.get(path, None)
+                if entry is not None and entry[0] == key:
+                    continue
+                self.staged.pop(path, None)
+                if self.ram_used() + key[1] > self.ram_budget:
+                    continue
+                self.loading = path
+
+            sd = None
+            try:
+                sd = safetensors.torch.load_file(path, device="cpu")
+            except Exception as e:
+                logging.warning("Failed to prefetch {}: {}".format(path, e))
+            with self.loaded:
+                self.loading = None
+                if sd is not None:
+                    self.staged[path] = (key, sd, key[1])
+                    self.prefetched += 1
+                self.loaded.notify_all()
+
+            if self.wakeup.is_set():
+                # Start over with the new list
+                return
+
+    def take(self, path):
+        path = os.path.abspath(path)
+        with self.loaded:
+            # Waiting for a file that's half read is faster than reading it again
+            while self.loading == path:
+                self.loaded.wait()
+            entry = self.staged.pop(path, None)
+        if entry is None:
+            return None
+        try:
+            if file_key(path) != entry[0]:
+                return None
+        except OSError:
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def clear(self):
+        with self.lock:
+            self.staged.clear()
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "ram_budget": self.ram_budget,
+                "ram_used": self.ram_used(),
+                "staged": list(self.staged.keys()),
+                "loading": self.loading,
+                "prefetched": self.prefetched,
+                "hits": self.hits,
+            }
+
+prefetcher = None
+
+def set_prefetcher(new_prefetcher):
+    global prefetcher
+    prefetcher = new_prefetcher
+
+def take(path):
+    if prefetcher is None:
+        return None
+    return prefetcher.take(path)
+
+def clear():
+    if prefetcher is not None:
+        prefetcher.clear()
+
+def update():
+    if prefetcher is not None:
+        prefetcher.update()
+
+def get_stats():
+    if prefetcher is None:
+        return None
+    return prefetcher.get_stats()
@@ -25,6 +25,7 @@ import comfy.lora
 import comfy.t2i_adapter.adapter
 import comfy.supported_models_base
 import comfy.taesd.taesd
+import comfy.text_encoder_cache
 
 def load_model_weights(model, sd):
     m, u = model.load_state_dict(sd, strict=False)
@@ -104,6 +105,7 @@ class CLIP:
         self.tokenizer = tokenizer(embedding_directory=embedding_directory)
         self.patcher = comfy.model_patcher.ModelPatcher(self.cond_stage_model, load_device=load_device, offload_device=offload_device)
         self.layer_idx = None
+        self.weights_hash = None
 
     def clone(self):
         n = CLIP(no_init=True)
@@ -111,6 +113,7 @@ class CLIP:
         n.cond_stage_model = self.cond_stage_model
         n.tokenizer = self.tokenizer
         n.layer_idx = self.layer_idx
+        n.weights_hash = self.weights_hash
         return n
 
     def add_patches(self, patches, strength_patch=1.0, strength_model=1.0):
@@ -122,7 +125,35 @@ class CLIP:
     def tokenize(self, text, return_word_ids=False):
         return self.tokenizer.tokenize_with_weights(text, return_word_ids)
 
+    def get_weights_hash(self):
+        if self.weights_hash is None:
+            sd = self.cond_stage_model.state_dict()
+            # The weights might currently be patched by another clone
+            for k, w in self.patcher.backup.items():
+                if k in sd:
+                    sd[k] = w
+            self.weights_hash = comfy.text_encoder_cache.weights_fingerprint(sd)
+        return self.weights_hash
+
+    def get_cache_key(self, cache, tokens, return_pooled):
+        if len(self.patcher.object_patches) > 0:
+            return None
+        options = [type(self.cond_stage_model).__name__, self.layer_idx, return_pooled == "unprojected"]
+        return cache.get_key(self.get_weights_hash(), cache.get_patches_fingerprint(self.patcher), tokens, options)
+
     def encode_from_tokens(self, tokens, return_pooled=False):
+        cache = comfy.text_encoder_cache.get_cache()
+        cache_key = None
+        if cache.enabled():
+            cache_key = self.get_cache_key(cache, tokens, return_pooled)
+        if cache_key is not None:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                cond, pooled = cached
+                if return_pooled:
+                    return cond, pooled
+                return cond
+
         self.cond_stage_model.reset_clip_options()
 
         if self.layer_idx is not None:
@@ -133,6 +164,8 @@ class CLIP:
 
         self.load_model()
         cond, pooled = self.cond_stage_model.encode_token_weights(tokens)
+        if cache_key is not None:
+            cache.set(cache_key, (cond, pooled))
         if return_pooled:
             return cond, pooled
         return cond
@@ -142,6 +175,7 @@ class CLIP:
         return self.encode_from_tokens(tokens)
 
     def load_sd(self, sd, full_model=False):
+        self.weights_hash = None
         if full_model:
             return self.cond_stage_model.load_state_dict(sd, strict=False)
         else:
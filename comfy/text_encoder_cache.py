@@ -0,0 +1,156 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import torch
+import safetensors.torch
+
+from comfy.cli_args import args
+import comfy.model_management
+
+def update_hash(h, obj):
+    if isinstance(obj, torch.Tensor):
+        h.update("tensor:{}:{}".format(obj.dtype, tuple(obj.shape)).encode("utf-8"))
+        h.update(tensor_bytes(obj))
+    elif isinstance(obj, dict):
+        h.update(b"{")
+        for k in sorted(obj.keys(), key=str):
+            update_hash(h, k)
+            update_hash(h, obj[k])
+        h.update(b"}")
+    elif isinstance(obj, (list, tuple)):
+        h.update(b"[")
+        for x in obj:
+            update_hash(h, x)
+        h.update(b"]")
+    else:
+        h.update("{}:{!r}".format(type(obj).__name__, obj).encode("utf-8"))
+
+def tensor_bytes(tensor):
+    tensor = tensor.detach().flatten().to(device="cpu")
+    if tensor.dtype not in (torch.float32, torch.float16, torch.int64, torch.int32, torch.uint8):
+        tensor = tensor.to(torch.float32)
+    return tensor.numpy().tobytes()
+
+def weights_fingerprint(state_dict):
+    # Every weight is hashed, a sample can't tell apart merges that only differ in a few
+    # values. The CLIP object keeps the result so this runs once per loaded text encoder.
+    h = hashlib.sha256()
+    for k in sorted(state_dict.keys()):
+        w = state_dict[k]
+        h.update("{}:{}:{}".format(k, w.dtype, tuple(w.shape)).encode("utf-8"))
+        h.update(tensor_bytes(w))
+    return h.hexdigest()
+
+def patches_fingerprint(patches):
+    h = hashlib.sha256()
+    for k in sorted(patches.keys()):
+        h.update(k.encode("utf-8"))
+        for strength_patch, value, strength_model in patches[k]:
+            h.update("{!r}:{!r}".format(strength_patch, strength_model).encode("utf-8"))
+            update_hash(h, value)
+    return h.hexdigest()
+
+class TextEncoderCache:
+    """
+    Content addressed cache for text encoder outputs. Results are kept in a small in
+    memory LRU and, if a directory is set, written to it as safetensors files so they
+    survive restarts.
+    """
+    def __init__(self, max_size=64, directory=None):
+        self.max_size = max_size
+        self.directory = directory
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.patches_fingerprints = OrderedDict()
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def enabled(self):
+        return self.max_size > 0 or self.directory is not None
+
+    def get_patches_fingerprint(self, patcher):
+        if len(patcher.patches) == 0:
+            return None
+        with self.lock:
+            out = self.patches_fingerprints.get(patcher.patches_uuid, None)
+        if out is None:
+            out = patches_fingerprint(patcher.patches)
+            with self.lock:
+                self.patches_fingerprints[patcher.patches_uuid] = out
+                while len(self.patches_fingerprints) > 64:
+                    self.patches_fingerprints.popitem(last=False)
+        return out
+
+    def get_key(self, weights_hash, patches_hash, tokens, options):
+        h = hashlib.sha256()
+        update_hash(h, [weights_hash, patches_hash, options])
+        update_hash(h, tokens)
+        return h.hexdigest()
+
+    def file_path(self, key):
+        return os.path.join(self.directory, key[:2], "{}.safetensors".format(key))
+
+    def get(self, key):
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        if self.directory is None:
+            return None
+
+        path = self.file_path(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            sd = safetensors.torch.load_file(path, device="cpu")
+        except Exception as e:
+            logging.warning("Failed to load cached text encoder output {}: {}".format(path, e))
+            return None
+        device = comfy.model_management.intermediate_device()
+        value = (sd["cond"].to(device), sd["pooled"].to(device) if "pooled" in sd else None)
+        self.add(key, value)
+        return value
+
+    def add(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.cache[key] = value
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+    def set(self, key, value):
+        self.add(key, value)
+        if self.directory is None:
+            return
+
+        cond, pooled = value
+        sd = {"cond": cond.detach().to("cpu").contiguous()}
+        if pooled is not None:
+            sd["pooled"] = pooled.detach().to("cpu").contiguous()
+        path = self.file_path(key)
+        temp_path = path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            safetensors.torch.save_file(sd, temp_path)
+            os.replace(temp_path, path)
+        except Exception as e:
+            logging.warning("Failed to save text encoder output to the cache {}: {}".format(path, e))
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+cache = None
+cache_lock = threading.Lock()
+
+def get_cache():
+    global cache
+    with cache_lock:
+        if cache is None:
+            cache = TextEncoderCache(max_size=args.text_encoder_cache_size, directory=args.text_encoder_cache_dir)
+        return cache
@@ -1,16 +1,77 @@
 import torch
 import math
 import struct
+import json
+import mmap
 import comfy.checkpoint_pickle
+import comfy.model_prefetch
 import safetensors.torch
 import numpy as np
 from PIL import Image
 import logging
+from comfy.cli_args import args
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+if hasattr(torch, "float8_e4m3fn"):
+    SAFETENSORS_DTYPES["F8_E4M3"] = torch.float8_e4m3fn
+    SAFETENSORS_DTYPES["F8_E5M2"] = torch.float8_e5m2
+
+def load_safetensors_mmap(ckpt):
+    """
+    Returns the tensors of a safetensors file as views of a copy on write memory map
+    of it. Nothing is read from the disk until a tensor is actually used so the parts
+    of a checkpoint that don't get loaded never take up any memory.
+    """
+    with open(ckpt, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+        if len(header) - int("__metadata__" in header) == 0:
+            return {}
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    data_start = 8 + header_size
+    sd = {}
+    for k, info in header.items():
+        if k == "__metadata__":
+            continue
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        offset = data_start + begin
+        itemsize = torch.empty((), dtype=dtype).element_size()
+        count = (end - begin) // itemsize
+        if count == 0:
+            sd[k] = torch.empty(info["shape"], dtype=dtype)
+        elif offset % itemsize == 0:
+            sd[k] = torch.frombuffer(mm, dtype=dtype, count=count, offset=offset).reshape(info["shape"])
+        else:
+            # Unaligned data can't be viewed in place
+            sd[k] = torch.frombuffer(mm, dtype=torch.uint8, count=end - begin, offset=offset).clone().view(dtype).reshape(info["shape"])
+    return sd
 
 def load_torch_file(ckpt, safe_load=False, device=None):
     if device is None:
         device = torch.device("cpu")
     if ckpt.lower().endswith(".safetensors"):
+        if device.type == "cpu":
+            sd = comfy.model_prefetch.take(ckpt)
+            if sd is not None:
+                return sd
+        if device.type == "cpu" and not args.disable_mmap:
+            try:
+                return load_safetensors_mmap(ckpt)
+            except Exception as e:
+                logging.warning("Failed to memory map {}, loading it normally: {}".format(ckpt, e))
         sd = safetensors.torch.load_file(ckpt, device=device.type)
     else:
         if safe_load:
@@ -463,6 +524,12 @@ def set_progress_bar_global_hook(function):
     global PROGRESS_BAR_HOOK
     PROGRESS_BAR_HOOK = function
 
+#called when a sampler starts, returns the function that sends its encoded previews from the preview thread
+PREVIEW_HOOK = None
+def set_preview_global_hook(function):
+    global PREVIEW_HOOK
+    PREVIEW_HOOK = function
+
 class ProgressBar:
     def __init__(self, total):
         global PROGRESS_BAR_HOOK
@@ -0,0 +1,321 @@
+import hashlib
+import itertools
+import math
+from collections import OrderedDict
+
+import nodes
+from comfy_execution.graph import get_input_node_ids
+
+def to_hashable(obj):
+    if isinstance(obj, (int, float, str, bool, type(None))):
+        return obj
+    elif isinstance(obj, dict):
+        return tuple(sorted((str(k), to_hashable(v)) for k, v in obj.items()))
+    elif isinstance(obj, (list, tuple)):
+        return tuple(to_hashable(x) for x in obj)
+    elif isinstance(obj, (set, frozenset)):
+        return tuple(sorted(repr(to_hashable(x)) for x in obj))
+    else:
+        return repr(obj)
+
+def is_volatile(value):
+    # IS_CHANGED returning NaN means the node should always be executed again
+    if isinstance(value, float):
+        return math.isnan(value)
+    elif isinstance(value, (list, tuple)):
+        return any(is_volatile(x) for x in value)
+    return False
+
+def get_linked_input(input_data):
+    if isinstance(input_data, list) and len(input_data) == 2:
+        return input_data[0], input_data[1]
+    return None
+
+_unique_counter = itertools.count()
+
+def volatile_key():
+    # Unique to the prompt that made it, no other prompt can hit it
+    return "volatile:{}".format(next(_unique_counter))
+
+def is_volatile_key(key):
+    return isinstance(key, str) and key.startswith("volatile:")
+
+class CacheKeySet:
+    def __init__(self, prompt, node_ids, is_changed_cache):
+        self.prompt = prompt
+        self.is_changed_cache = is_changed_cache
+        self.keys = {}
+
+    def add_keys(self, node_ids):
+        raise NotImplementedError()
+
+    def all_node_ids(self):
+        return set(self.keys.keys())
+
+    def get_used_keys(self):
+        return self.keys.values()
+
+    def get_data_key(self, node_id):
+        return self.keys.get(node_id, None)
+
+class CacheKeySetID(CacheKeySet):
+    def __init__(self, prompt, node_ids, is_changed_cache):
+        super().__init__(prompt, node_ids, is_changed_cache)
+        self.add_keys(node_ids)
+
+    def add_keys(self, node_ids):
+        for node_id in node_ids:
+            if node_id in self.keys or node_id not in self.prompt:
+                continue
+            self.keys[node_id] = (node_id, self.prompt[node_id]["class_type"])
+
+class CacheKeySetInputSignature(CacheKeySet):
+    """
+    Keys every node by a digest of its class, IS_CHANGED result, literal inputs
+    and the keys of the nodes it is linked to. The key does not depend on node ids,
+    so the same subgraph hits the cache even when it comes from a different workflow.
+    """
+    def __init__(self, prompt, node_ids, is_changed_cache):
+        super().__init__(prompt, node_ids, is_changed_cache)
+        self.include_unique_id = {}
+        self.add_keys(node_ids)
+
+    def include_unique_id_in_input(self, class_type):
+        if class_type not in self.include_unique_id:
+            class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
+            if getattr(class_def, "NOT_IDEMPOTENT", False):
+                self.include_unique_id[class_type] = True
+            else:
+                hidden = class_def.INPUT_TYPES().get("hidden", {})
+                self.include_unique_id[class_type] = "UNIQUE_ID" in hidden.values()
+        return self.include_unique_id[class_type]
+
+    def get_input_node_ids(self, node_id):
+        out = []
+        for input_data in self.prompt[node_id]["inputs"].values():
+            link = get_linked_input(input_data)
+            if link is not None and link[0] in self.prompt:
+                out.append(link[0])
+        return out
+
+    def add_keys(self, node_ids):
+        # Iterative post-order walk so long chains don't hit the recursion limit
+        for node_id in node_ids:
+            if node_id in self.keys or node_id not in self.prompt:
+                continue
+            stack = [node_id]
+            visiting = set()
+            while len(stack) > 0:
+                current = stack[-1]
+                if current in self.keys:
+                    stack.pop()
+                    continue
+                if current not in visiting:
+                    visiting.add(current)
+                    missing = [x for x in self.get_input_node_ids(current) if x not in self.keys and x not in visiting]
+                    if len(missing) > 0:
+                        stack.extend(reversed(missing))
+                        continue
+                self.keys[current] = self.get_node_signature(current)
+                stack.pop()
+
+    def get_node_signature(self, node_id):
+        node = self.prompt[node_id]
+        class_type = node["class_type"]
+        is_changed = self.is_changed_cache.get(node_id)
+        if is_volatile(is_changed):
+            return volatile_key()
+
+        signature = [class_type, to_hashable(is_changed)]
+        if self.include_unique_id_in_input(class_type):
+            signature.append(("UNIQUE_ID", node_id))
+
+        inputs = []
+        for name in sorted(node["inputs"].keys()):
+            input_data = node["inputs"][name]
+            link = get_linked_input(input_data)
+            if link is not None:
+                upstream_key = self.keys.get(link[0], None)
+                if upstream_key is None:
+                    # Missing node or a cycle, neither can be safely reused
+                    return volatile_key()
+                inputs.append((name, ("LINK", upstream_key, link[1])))
+            else:
+                inputs.append((name, to_hashable(input_data)))
+        signature.append(tuple(inputs))
+        return hashlib.sha256(repr(signature).encode("utf-8")).hexdigest()
+
+class BasicCache:
+    def __init__(self, key_class, spill=None):
+        self.key_class = key_class
+        self.initialized = False
+        self.prompt = {}
+        self.cache_key_set = None
+        self.cache = {}
+        self.spill = spill
+
+    def set_prompt(self, prompt, node_ids, is_changed_cache):
+        self.prompt = prompt
+        self.cache_key_set = self.key_class(prompt, node_ids, is_changed_cache)
+        self.initialized = True
+
+    def all_node_ids(self):
+        assert self.initialized
+        return self.cache_key_set.all_node_ids()
+
+    def clean_unused(self):
+        raise NotImplementedError()
+
+    def get(self, node_id):
+        assert self.initialized
+        cache_key = self.cache_key_set.get_data_key(node_id)
+        if cache_key is None:
+            return None
+        return self._load(cache_key)
+
+    def set(self, node_id, value):
+        assert self.initialized
+        cache_key = self.cache_key_set.get_data_key(node_id)
+        if cache_key is None:
+            return
+        self._store(cache_key, value)
+
+    def _load(self, cache_key):
+        value = self.cache.get(cache_key, None)
+        if self.spill is not None and value is not None:
+            value = self.spill.load(cache_key, value)
+        return value
+
+    def _store(self, cache_key, value):
+        self.cache[cache_key] = value
+        if self.spill is not None:
+            self.spill.stored(self.cache, cache_key, value)
+
+    def _remove(self, cache_key):
+        self.cache.pop(cache_key, None)
+        if self.spill is not None:
+            self.spill.removed(cache_key)
+
+    def cached_node_ids(self):
+        assert self.initialized
+        return [x for x in self.prompt if self.cache_key_set.get_data_key(x) in self.cache]
+
+    def get_data_key(self, node_id):
+        assert self.initialized
+        return self.cache_key_set.get_data_key(node_id)
+
+    def release(self, node_id):
+        assert self.initialized
+        self._remove(self.cache_key_set.get_data_key(node_id))
+
+    def __len__(self):
+        return len(self.cache)
+
+class ClassicCache(BasicCache):
+    """Only keeps the results of the nodes in the current prompt."""
+    def clean_unused(self):
+        preserve_keys = set(self.cache_key_set.get_used_keys())
+        to_remove = [key for key in self.cache if key not in preserve_keys]
+        for key in to_remove:
+            self._remove(key)
+        if self.spill is not None:
+            self.spill.evict(self.cache, preserve_keys)
+
+class LRUCache(BasicCache):
+    """
+    Keeps up to max_size results across prompts, evicting the least recently used
+    ones. Results used by the current prompt are never evicted.
+    """
+    def __init__(self, key_class, max_size=100, spill=None):
+        super().__init__(key_class, spill)
+        self.max_size = max_size
+        self.generation = 0
+        self.cache = OrderedDict()
+        self.used_generation = {}
+        self.volatile_keys = set()
+
+    def set_prompt(self, prompt, node_ids, is_changed_cache):
+        super().set_prompt(prompt, node_ids, is_changed_cache)
+        self.generation += 1
+        for key in self.cache_key_set.get_used_keys():
+            if key in self.cache:
+                self._mark_used(key)
+
+    def _mark_used(self, cache_key):
+        self.used_generation[cache_key] = self.generation
+        self.cache.move_to_end(cache_key)
+
+    def clean_unused(self):
+        # The volatile results of the previous prompts would only push out the ones that can be hit
+        for key in self.volatile_keys:
+            self._remove(key)
+            self.used_generation.pop(key, None)
+        self.volatile_keys.clear()
+        while len(self.cache) > self.max_size:
+            key = next(iter(self.cache))
+            if self.used_generation.get(key, 0) >= self.generation:
+                break
+            self._remove(key)
+            self.used_generation.pop(key, None)
+        if self.spill is not None:
+            self.spill.evict(self.cache, set(k for k, v in self.used_generation.items() if v >= self.generation))
+
+    def release(self, node_id):
+        cache_key = self.cache_key_set.get_data_key(node_id)
+        super().release(node_id)
+        self.used_generation.pop(cache_key, None)
+
+    def get(self, node_id):
+        assert self.initialized
+        cache_key = self.cache_key_set.get_data_key(node_id)
+        if cache_key is None or cache_key not in self.cache:
+            return None
+        self._mark_used(cache_key)
+        return self._load(cache_key)
+
+    def set(self, node_id, value):
+        assert self.initialized
+        cache_key = self.cache_key_set.get_data_key(node_id)
+        if cache_key is None:
+            return
+        self._store(cache_key, value)
+        self._mark_used(cache_key)
+        if is_volatile_key(cache_key):
+            self.volatile_keys.add(cache_key)
+
+class IntermediateReleaser:
+    """
+    Drops outputs from the cache once every node of the prompt that could read them
+    was executed, so a prompt only needs memory for the intermediates that are still
+    going to be used instead of all of them. Nodes with the same cache key share a
+    count. The outputs of the nodes in keep stay cached for the next prompts.
+    """
+    def __init__(self, prompt, output_ids, cache, keep):
+        self.prompt = prompt
+        self.cache = cache
+        self.keep_keys = set(cache.get_data_key(x) for x in keep)
+        self.consumers = {}
+        # Lazy inputs are counted too, a node can ask for them at any point
+        to_visit = list(dict.fromkeys(output_ids))
+        visited = set(to_visit)
+        while len(to_visit) > 0:
+            node_id = to_visit.pop()
+            if node_id not in prompt or cache.get(node_id) is not None:
+                continue
+            for input_id in get_input_node_ids(prompt, node_id):
+                key = cache.get_data_key(input_id)
+                self.consumers[key] = self.consumers.get(key, 0) + 1
+                if input_id not in visited:
+                    visited.add(input_id)
+                    to_visit.append(input_id)
+
+    def node_executed(self, node_id):
+        for input_id in get_input_node_ids(self.prompt, node_id):
+            key = self.cache.get_data_key(input_id)
+            if key not in self.consumers:
+                continue
+            self.consumers[key] -= 1
+            if self.consumers[key] == 0:
+                del self.consumers[key]
+                if key not in self.keep_keys:
+                    self.cache.release(input_id)
@@ -0,0 +1,198 @@
+import heapq
+
+class DependencyCycleError(Exception):
+    def __init__(self, node_id):
+        super().__init__("Dependency cycle detected at node {}".format(node_id))
+        self.node_id = node_id
+
+def get_input_node_ids(prompt, node_id, skip=()):
+    out = []
+    for name, input_data in prompt[node_id]["inputs"].items():
+        if name in skip:
+            continue
+        if isinstance(input_data, list) and len(input_data) == 2 and input_data[0] in prompt:
+            if input_data[0] not in out:
+                out.append(input_data[0])
+    return out
+
+class ExecutionList:
+    """
+    Precomputed execution plan for the uncached nodes the requested outputs depend on.
+
+    The order is the same one the old recursive executor produced: the output that
+    depends on the least amount of unexecuted nodes goes first and its dependencies are
+    executed depth first in input order. Nodes are handed out through a ready queue
+    keyed by that order, every node becoming ready once all its dependencies completed.
+
+    Inputs returned by lazy_inputs(node_id) are not dependencies until the node asks
+    for them with add_lazy_dependencies.
+    """
+    def __init__(self, prompt, output_cache, lazy_inputs=None):
+        self.prompt = prompt
+        self.output_cache = output_cache
+        self.lazy_inputs = lazy_inputs
+        self.dependencies = {}
+        self.dependents = {}
+        self.pending = {}
+        self.rank = {}
+        self.ready = []
+        self.staged = set()
+        self.completed = set()
+
+    def is_cached(self, node_id):
+        return self.output_cache.get(node_id) is not None
+
+    def add_outputs(self, output_ids):
+        output_ids = [x for x in dict.fromkeys(output_ids) if x not in self.rank]
+        for node_id in output_ids:
+            self._add_dependencies(node_id)
+
+        # Which of the requested outputs every needed node contributes to
+        remaining = {}
+        members = {}
+        for output_id in output_ids:
+            ancestors = self._ancestors(output_id)
+            remaining[output_id] = len(ancestors)
+            for node_id in ancestors:
+                members.setdefault(node_id, []).append(output_id)
+
+        plan = []
+        planned = set(self.rank.keys())
+        while len(remaining) > 0:
+            #always execute the output that depends on the least amount of unexecuted nodes first
+            output_id = min(remaining.keys(), key=lambda a: (remaining[a], a))
+            del remaining[output_id]
+            for node_id in self._post_order(output_id, planned):
+                planned.add(node_id)
+                plan.append(node_id)
+                for o in members.get(node_id, []):
+                    if o in remaining:
+                        remaining[o] -= 1
+
+        offset = len(self.rank)
+        self._schedule(plan, [(offset + i,) for i in range(len(plan))])
+
+    def _schedule(self, plan, ranks):
+        for node_id, rank in zip(plan, ranks):
+            self.rank[node_id] = rank
+            self.pending[node_id] = len([x for x in self.dependencies[node_id] if x not in self.completed])
+            if self.pending[node_id] == 0:
+                heapq.heappush(self.ready, (self.rank[node_id], node_id))
+
+    def add_lazy_dependencies(self, node_id, input_ids):
+        """
+        Makes the staged node_id wait for the nodes linked to the lazy inputs it needs,
+        they are executed before anything that comes after node_id. Returns False if
+        they are all already executed.
+        """
+        new = []
+        for input_id in dict.fromkeys(input_ids):
+            if self.is_cached(input_id) or input_id in self.completed or input_id in self.dependencies[node_id]:
+                continue
+            self._add_dependencies(input_id)
+            if node_id in self._ancestors(input_id):
+                raise DependencyCycleError(input_id)
+            self.dependencies[node_id].append(input_id)
+            self.dependents[input_id].append(node_id)
+            new.append(input_id)
+        if len(new) == 0:
+            return False
+
+        plan = []
+        planned = set(self.rank.keys())
+        for input_id in new:
+            for x in self._post_order(input_id, planned):
+                planned.add(x)
+                plan.append(x)
+        # Ranks are tuples so these sort right after node_id
+        self._schedule(plan, [self.rank[node_id] + (i,) for i in range(len(plan))])
+        self.staged.discard(node_id)
+        self.pending[node_id] = len([x for x in self.dependencies[node_id] if x not in self.completed])
+        return True
+
+    def _add_dependencies(self, node_id):
+        if node_id in self.dependencies or self.is_cached(node_id):
+            return
+        self.dependencies[node_id] = []
+        self.dependents.setdefault(node_id, [])
+        to_visit = [node_id]
+        while len(to_visit) > 0:
+            current = to_visit.pop()
+            skip = self.lazy_inputs(current) if self.lazy_inputs is not None else ()
+            for input_id in get_input_node_ids(self.prompt, current, skip):
+                if self.is_cached(input_id):
+                    continue
+                self.dependencies[current].append(input_id)
+                self.dependents.setdefault(input_id, []).append(current)
+                if input_id not in self.dependencies:
+                    self.dependencies[input_id] = []
+                    to_visit.append(input_id)
+
+    def _ancestors(self, node_id):
+        if node_id not in self.dependencies:
+            return set()
+        out = set([node_id])
+        to_visit = [node_id]
+        while len(to_visit) > 0:
+            current = to_visit.pop()
+            for input_id in self.dependencies[current]:
+                if input_id not in out:
+                    out.add(input_id)
+                    to_visit.append(input_id)
+        return out
+
+    def _post_order(self, node_id, planned):
+        if node_id not in self.dependencies or node_id in planned:
+            return []
+        out = []
+        emitted = set()
+        on_stack = set([node_id])
+        stack = [(node_id, iter(self.dependencies[node_id]))]
+        while len(stack) > 0:
+            current, inputs = stack[-1]
+            for input_id in inputs:
+                if input_id in on_stack:
+                    raise DependencyCycleError(input_id)
+                if input_id not in planned and input_id not in emitted:
+                    on_stack.add(input_id)
+                    stack.append((input_id, iter(self.dependencies[input_id])))
+                    break
+            else:
+                stack.pop()
+                on_stack.discard(current)
+                emitted.add(current)
+                out.append(current)
+        return out
+
+    def is_empty(self):
+        return len(self.ready) == 0 and len(self.staged) == 0
+
+    def has_ready_nodes(self):
+        return len(self.ready) > 0
+
+    def get_ready_nodes(self):
+        return [x[1] for x in sorted(self.ready)]
+
+    def stage_node_execution(self, node_id=None):
+        if len(self.ready) == 0:
+            return None
+        if node_id is None:
+            _, node_id = heapq.heappop(self.ready)
+        else:
+            self.ready.remove((self.rank[node_id], node_id))
+            heapq.heapify(self.ready)
+        self.staged.add(node_id)
+        return node_id
+
+    def complete_node_execution(self, node_id):
+        if node_id not in self.staged:
+            # Went back to waiting for its lazy inputs
+            return
+        self.staged.discard(node_id)
+        self.completed.add(node_id)
+        for dependent in self.dependents.get(node_id, []):
+            if dependent not in self.pending:
+                continue
+            self.pending[dependent] -= 1
+            if self.pending[dependent] == 0:
+                heapq.heappush(self.ready, (self.rank[dependent], dependent))
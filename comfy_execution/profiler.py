@@ -0,0 +1,108 @@
+import time
+import threading
+import contextlib
+
+import torch
+
+import comfy.model_management
+
+class PromptProfiler:
+    """
+    Collects per node timings for one prompt: wall and thread CPU time, CUDA time and
+    peak allocated memory when running on a CUDA device, the bytes load_models_gpu
+    moved between devices and whether the result came from the cache.
+
+    Memory and bytes moved are process wide counters so they are only approximate
+    when nodes run in parallel.
+    """
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.start_timestamp = time.time()
+        self.nodes = []
+        self.pending_events = []
+        self.lock = threading.Lock()
+        self.device = comfy.model_management.get_torch_device()
+        self.cuda = hasattr(self.device, "type") and self.device.type == "cuda" and torch.cuda.is_available()
+
+    def add_cached(self, node_id, class_type):
+        with self.lock:
+            self.nodes.append({
+                "node_id": node_id,
+                "class_type": class_type,
+                "cached": True,
+                "start": time.perf_counter() - self.start_time,
+                "wall_time": 0.0,
+                "thread": threading.current_thread().name,
+            })
+
+    @contextlib.contextmanager
+    def node(self, node_id, class_type):
+        record = {
+            "node_id": node_id,
+            "class_type": class_type,
+            "cached": False,
+            "success": False,
+            "thread": threading.current_thread().name,
+        }
+        events = None
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+            events = (torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True))
+            events[0].record()
+        bytes_moved = comfy.model_management.model_bytes_moved
+        cpu_start = time.thread_time()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            end = time.perf_counter()
+            record["start"] = start - self.start_time
+            record["wall_time"] = end - start
+            record["cpu_time"] = time.thread_time() - cpu_start
+            record["bytes_moved"] = comfy.model_management.model_bytes_moved - bytes_moved
+            if events is not None:
+                events[1].record()
+                record["peak_memory_allocated"] = torch.cuda.max_memory_allocated(self.device)
+            with self.lock:
+                self.nodes.append(record)
+                if events is not None:
+                    self.pending_events.append((record, events))
+
+    def add_record(self, record):
+        with self.lock:
+            self.nodes.append(record)
+
+    def get_profile(self):
+        with self.lock:
+            for record, (start, end) in self.pending_events:
+                end.synchronize()
+                record["cuda_time"] = start.elapsed_time(end) / 1000.0
+            self.pending_events = []
+            return {
+                "start_timestamp": self.start_timestamp,
+                "total_time": time.perf_counter() - self.start_time,
+                "nodes": list(self.nodes),
+            }
+
+def to_chrome_trace(prompt_id, profile):
+    """Converts a profile from the history to the Chrome trace event format (chrome://tracing, Perfetto)."""
+    threads = {}
+    events = []
+    base = profile["start_timestamp"] * 1e6
+    for record in profile["nodes"]:
+        tid = threads.setdefault(record.get("thread", ""), len(threads))
+        args = {k: v for k, v in record.items() if k not in ("start", "wall_time", "thread")}
+        events.append({
+            "name": "{} ({})".format(record["class_type"], record["node_id"]),
+            "cat": "cached" if record["cached"] else "node",
+            "ph": "X",
+            "ts": base + record["start"] * 1e6,
+            "dur": record["wall_time"] * 1e6,
+            "pid": 0,
+            "tid": tid,
+            "args": args,
+        })
+    for name, tid in threads.items():
+        events.append({"name": "thread_name", "ph": "M", "pid": 0, "tid": tid, "args": {"name": name}})
+    events.append({"name": "process_name", "ph": "M", "pid": 0, "tid": 0, "args": {"name": "prompt {}".format(prompt_id)}})
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
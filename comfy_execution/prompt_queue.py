@@ -0,0 +1,397 @@
+import os
+import json
+import time
+import bisect
+import heapq
+import logging
+import sqlite3
+import threading
+
+def get_priority(item):
+    try:
+        return int(item[3].get("priority", 0))
+    except (TypeError, ValueError):
+        return 0
+
+def get_client(item):
+    return item[3].get("client_id", None)
+
+class PendingQueue:
+    """
+    Queued prompts, the ones with the highest priority go first. With fair_share prompts
+    of the same priority are taken round robin between clients, otherwise (and between
+    the prompts of one client) the lowest number goes first like the old heap.
+
+    Every operation is O(log n), entries that become stale are skipped when popped.
+    """
+    def __init__(self, fair_share=False):
+        self.fair_share = fair_share
+        self.items = {}
+        self.groups = {}
+        self.client_groups = {}
+        self.served = {}
+        self.virtual_time = 0
+        self.order = []
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, prompt_id):
+        return prompt_id in self.items
+
+    def get_group(self, item):
+        return (get_priority(item), get_client(item) if self.fair_share else None)
+
+    def push(self, item):
+        prompt_id = item[1]
+        group = self.get_group(item)
+        client = group[1]
+        if self.fair_share and len(self.client_groups.get(client, ())) == 0:
+            # Clients that had nothing queued don't get to catch up on the time they were idle
+            self.served[client] = max(self.served.get(client, 0), self.virtual_time)
+        self.items[prompt_id] = item
+        heapq.heappush(self.groups.setdefault(group, []), (item[0], prompt_id))
+        self.client_groups.setdefault(client, set()).add(group)
+        self.update_group(group)
+
+    def update_group(self, group):
+        heap = self.groups.get(group, None)
+        if heap is None:
+            return
+        while len(heap) > 0 and heap[0][1] not in self.items:
+            heapq.heappop(heap)
+        if len(heap) == 0:
+            del self.groups[group]
+            self.client_groups[group[1]].discard(group)
+            if len(self.client_groups[group[1]]) == 0:
+                del self.client_groups[group[1]]
+            return
+        served = self.served.get(group[1], 0) if self.fair_share else 0
+        heapq.heappush(self.order, (-group[0], served, heap[0][0], heap[0][1], group))
+
+    def is_current(self, entry):
+        _, served, _, prompt_id, group = entry
+        heap = self.groups.get(group, None)
+        if heap is None or heap[0][1] != prompt_id or prompt_id not in self.items:
+            return False
+        return not self.fair_share or served == self.served.get(group[1], 0)
+
+    def peek(self):
+        while len(self.order) > 0:
+            if self.is_current(self.order[0]):
+                return self.items[self.order[0][3]]
+            heapq.heappop(self.order)
+        return None
+
+    def pop(self):
+        while len(self.order) > 0:
+            entry = heapq.heappop(self.order)
+            if not self.is_current(entry):
+                continue
+            served, prompt_id, group = entry[1], entry[3], entry[4]
+            heapq.heappop(self.groups[group])
+            item = self.items.pop(prompt_id)
+            if self.fair_share:
+                self.virtual_time = max(self.virtual_time, served)
+                self.served[group[1]] = served + 1
+                for g in list(self.client_groups.get(group[1], ())):
+                    self.update_group(g)
+            else:
+                self.update_group(group)
+            return item
+        return None
+
+    def remove(self, prompt_id):
+        item = self.items.pop(prompt_id, None)
+        if item is not None:
+            self.update_group(self.get_group(item))
+        return item
+
+    def clear(self):
+        self.__init__(self.fair_share)
+
+    def get_items(self):
+        return sorted(self.items.values(), key=lambda a: (-get_priority(a), a[0], a[1]))
+
+class QueueStore:
+    """Keeps the queue and history in memory only, they are lost on restart."""
+    def load_queue(self):
+        return []
+
+    def load_history(self, max_items):
+        return []
+
+    def add_queued(self, item):
+        pass
+
+    def remove_queued(self, prompt_ids):
+        pass
+
+    def add_history(self, prompt_id, entry):
+        pass
+
+    def remove_history(self, prompt_ids):
+        pass
+
+    def clear_history(self):
+        pass
+
+class SQLiteQueueStore(QueueStore):
+    """
+    Persists queued prompts and history in a SQLite database so they survive restarts.
+    Prompts that were running when the server stopped are queued again.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS queue (prompt_id TEXT PRIMARY KEY, item TEXT NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS history (seq INTEGER PRIMARY KEY AUTOINCREMENT, prompt_id TEXT UNIQUE NOT NULL, entry TEXT NOT NULL)")
+        self.db.commit()
+
+    def execute(self, query, params=()):
+        with self.lock:
+            self.db.execute(query, params)
+            self.db.commit()
+
+    def executemany(self, query, params):
+        with self.lock:
+            self.db.executemany(query, params)
+            self.db.commit()
+
+    def load_queue(self):
+        with self.lock:
+            rows = self.db.execute("SELECT item FROM queue").fetchall()
+        return [tuple(json.loads(x[0])) for x in rows]
+
+    def load_history(self, max_items):
+        with self.lock:
+            rows = self.db.execute("SELECT prompt_id, entry FROM (SELECT seq, prompt_id, entry FROM history ORDER BY seq DESC LIMIT ?) ORDER BY seq", (max_items,)).fetchall()
+        return [(x[0], json.loads(x[1])) for x in rows]
+
+    def add_queued(self, item):
+        try:
+            data = json.dumps(item)
+        except (TypeError, ValueError) as e:
+            logging.warning("Prompt {} can't be persisted: {}".format(item[1], e))
+            return
+        self.execute("INSERT OR REPLACE INTO queue (prompt_id, item) VALUES (?, ?)", (item[1], data))
+
+    def remove_queued(self, prompt_ids):
+        self.executemany("DELETE FROM queue WHERE prompt_id = ?", [(x,) for x in prompt_ids])
+
+    def add_history(self, prompt_id, entry):
+        try:
+            data = json.dumps(entry)
+        except (TypeError, ValueError) as e:
+            logging.warning("History of prompt {} can't be persisted: {}".format(prompt_id, e))
+            data = None
+        with self.lock:
+            self.db.execute("DELETE FROM queue WHERE prompt_id = ?", (prompt_id,))
+            if data is not None:
+                self.db.execute("INSERT OR REPLACE INTO history (prompt_id, entry) VALUES (?, ?)", (prompt_id, data))
+            self.db.commit()
+
+    def remove_history(self, prompt_ids):
+        self.executemany("DELETE FROM history WHERE prompt_id = ?", [(x,) for x in prompt_ids])
+
+    def clear_history(self):
+        self.execute("DELETE FROM history")
+
+def get_history_keys(entry):
+    prompt = entry["prompt"]
+    keys = []
+    status = entry.get("status", None)
+    if status is not None:
+        keys.append(("status", status.get("status_str", None)))
+    keys.append(("client_id", prompt[3].get("client_id", None)))
+    for node_type in set(prompt[2][x]["class_type"] for x in prompt[4] if x in prompt[2]):
+        keys.append(("node_type", node_type))
+    return keys
+
+def history_summary(entry):
+    prompt = entry["prompt"]
+    status = entry.get("status", None) or {}
+    return {
+        "number": prompt[0],
+        "client_id": prompt[3].get("client_id", None),
+        "status": status.get("status_str", None),
+        "completed": status.get("completed", None),
+        "output_node_types": sorted(set(prompt[2][x]["class_type"] for x in prompt[4] if x in prompt[2])),
+        "outputs": entry.get("outputs", {}),
+    }
+
+class HistoryIndex:
+    """
+    Insertion ordered index over the history with secondary indexes per status,
+    client_id and output node type. Removed entries are skipped lazily and the lists
+    compacted once they are mostly dead, so reading a page only touches the entries
+    in it.
+    """
+    def __init__(self):
+        self.next_seq = 0
+        self.live = {}
+        self.keys = {}
+        self.order = ([], [])
+        self.start = 0
+        self.by_key = {}
+        self.dead = 0
+
+    def add(self, prompt_id, keys):
+        if prompt_id in self.live:
+            self.remove(prompt_id)
+        seq = self.next_seq
+        self.next_seq += 1
+        self.live[prompt_id] = seq
+        self.keys[prompt_id] = set(keys)
+        self.order[0].append(seq)
+        self.order[1].append(prompt_id)
+        for key in keys:
+            index = self.by_key.setdefault(key, ([], []))
+            index[0].append(seq)
+            index[1].append(prompt_id)
+
+    def remove(self, prompt_id):
+        if self.live.pop(prompt_id, None) is None:
+            return
+        del self.keys[prompt_id]
+        self.dead += 1
+        if self.dead > 1024 and self.dead > len(self.live):
+            self.compact()
+
+    def clear(self):
+        self.__init__()
+
+    def is_live(self, index, i):
+        return self.live.get(index[1][i], None) == index[0][i]
+
+    def oldest(self):
+        while self.start < len(self.order[0]) and not self.is_live(self.order, self.start):
+            self.start += 1
+        if self.start < len(self.order[0]):
+            return self.order[1][self.start]
+        return None
+
+    def compact(self):
+        def compact_index(index):
+            keep = [i for i in range(len(index[0])) if self.is_live(index, i)]
+            return ([index[0][i] for i in keep], [index[1][i] for i in keep])
+        self.order = compact_index(self.order)
+        self.start = 0
+        for key in list(self.by_key.keys()):
+            self.by_key[key] = compact_index(self.by_key[key])
+            if len(self.by_key[key][0]) == 0:
+                del self.by_key[key]
+        self.dead = 0
+
+    def page(self, max_items=None, before=None, filters=None):
+        """Returns the ids of the newest max_items entries older than the before id matching all filters, oldest first."""
+        filters = set((filters or {}).items())
+        index = self.order
+        for key in filters:
+            candidate = self.by_key.get(key, ([], []))
+            if len(candidate[0]) < len(index[0]):
+                index = candidate
+
+        end = len(index[0])
+        if before is not None:
+            if before not in self.live:
+                raise KeyError(before)
+            end = bisect.bisect_left(index[0], self.live[before])
+
+        out = []
+        for i in range(end - 1, -1, -1):
+            if max_items is not None and len(out) >= max_items:
+                break
+            if self.is_live(index, i) and filters.issubset(self.keys[index[1][i]]):
+                out.append(index[1][i])
+        out.reverse()
+        return out
+
+    def slice(self, offset, max_items=None):
+        if self.dead == 0:
+            end = None if max_items is None else offset + max_items
+            return self.order[1][offset:end]
+        # remove compacts once the dead entries outnumber the live ones, until then
+        # they are skipped instead of compacting on every page
+        out = []
+        for i in range(self.start, len(self.order[0])):
+            if max_items is not None and len(out) >= max_items:
+                break
+            if not self.is_live(self.order, i):
+                continue
+            if offset > 0:
+                offset -= 1
+            else:
+                out.append(self.order[1][i])
+        return out
+
+def get_prompt_model_names(prompt):
+    # Loader inputs are all named like ckpt_name, unet_name or lora_name
+    names = set()
+    for node in prompt.values():
+        for name, value in node.get("inputs", {}).items():
+            if name.endswith("_name") and isinstance(value, str):
+                names.add(os.path.normpath(value))
+    return names
+
+def file_matches(path, name):
+    return path == name or path.endswith(os.sep + name)
+
+class AffinityScheduler:
+    """
+    Decides which idle worker runs the prompt at the head of the queue. The prompt
+    goes to the idle worker with the most bytes of its models already loaded on its
+    device. If a busy worker has more of them the prompt waits up to max_wait seconds
+    for it before going to an idle one, so the queue order is kept and nothing waits
+    forever for a device.
+
+    get_resident_models(device) returns the files and size of each model loaded on
+    device, the workers only need an index and a device so they can be faked in tests.
+    """
+    def __init__(self, workers, get_resident_models, max_wait=5.0):
+        self.workers = workers
+        self.max_wait = max_wait
+        self.get_resident_models = get_resident_models
+        self.idle = set()
+        self.waiting_since = {}
+        self.model_names = {}
+
+    def set_idle(self, worker):
+        self.idle.add(worker)
+
+    def set_busy(self, worker):
+        self.idle.discard(worker)
+
+    def score(self, worker, names):
+        out = 0
+        for files, size in self.get_resident_models(worker.device):
+            if any(file_matches(path, name) for path in files for name in names):
+                out += size
+        return out
+
+    def pick(self, item):
+        """Returns the worker that should take item now or None and how long to wait before asking again."""
+        prompt_id = item[1]
+        if prompt_id not in self.model_names:
+            self.model_names[prompt_id] = get_prompt_model_names(item[2])
+            self.waiting_since[prompt_id] = time.perf_counter()
+        if len(self.idle) == 0:
+            return None, None
+
+        names = self.model_names[prompt_id]
+        scores = {}
+        if len(names) > 0:
+            scores = {w: self.score(w, names) for w in self.workers}
+        best = max(sorted(self.idle, key=lambda w: w.index), key=lambda w: scores.get(w, 0))
+        best_busy = max([scores.get(w, 0) for w in self.workers if w not in self.idle], default=0)
+        if best_busy > scores.get(best, 0):
+            remaining = self.max_wait - (time.perf_counter() - self.waiting_since[prompt_id])
+            if remaining > 0:
+                return None, remaining
+        return best, None
+
+    def forget(self, prompt_id):
+        self.model_names.pop(prompt_id, None)
+        self.waiting_since.pop(prompt_id, None)
@@ -0,0 +1,431 @@
+import os
+import hmac
+import json
+import time
+import queue
+import base64
+import logging
+import threading
+import urllib.parse
+import urllib.request
+import urllib.error
+from io import BytesIO
+from collections import OrderedDict
+
+from PIL import Image
+
+import folder_paths
+
+# server.BinaryEventTypes, server.py imports this module
+PREVIEW_IMAGE = 1
+UNENCODED_PREVIEW_IMAGE = 2
+
+# The shared secret of --remote-worker-token goes in this header
+TOKEN_HEADER = "Comfy-Worker-Token"
+
+def check_token(token, given):
+    """Remote workers are only let in when the coordinator has a token and they send the same one."""
+    if token is None or given is None:
+        return False
+    return hmac.compare_digest(token.encode("utf-8"), given.encode("utf-8"))
+
+class LeaseLost(Exception):
+    pass
+
+class Lease:
+    def __init__(self, worker_id, item, item_id, timeout):
+        self.worker_id = worker_id
+        self.item = item
+        self.item_id = item_id
+        self.timeout = timeout
+        self.interrupted = False
+        self.renew()
+
+    def renew(self):
+        self.deadline = time.perf_counter() + self.timeout
+
+    def client_id(self):
+        return self.item[3].get("client_id", None)
+
+class LeaseManager:
+    """
+    Coordinator side of the remote worker protocol. Remote workers lease prompts from
+    the PromptQueue, keep the leases alive with heartbeats, stream their messages and
+    upload their outputs to this server before completing the prompt. Prompts whose
+    lease runs out because the worker stopped sending heartbeats are queued again.
+    """
+    def __init__(self, prompt_queue, server, lease_timeout=30.0):
+        self.prompt_queue = prompt_queue
+        self.server = server
+        self.lease_timeout = lease_timeout
+        self.leases = {}
+        self.workers = {}
+        # Messages sent after the prompt completed still go to its client
+        self.finished = OrderedDict()
+        self.lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self.expire_loop, daemon=True, name="lease_expiry").start()
+
+    def expire_loop(self):
+        while True:
+            time.sleep(min(1.0, self.lease_timeout / 4))
+            self.expire()
+
+    def expire(self):
+        now = time.perf_counter()
+        with self.lock:
+            expired = [x for x in self.leases.values() if x.deadline < now]
+            for lease in expired:
+                del self.leases[lease.item[1]]
+        for lease in expired:
+            logging.warning("Lease of prompt {} by worker {} expired, queueing it again".format(lease.item[1], lease.worker_id))
+            self.prompt_queue.requeue(lease.item_id)
+
+    def release(self, worker_id, prompt_id):
+        with self.lock:
+            lease = self.get_lease(worker_id, prompt_id)
+            del self.leases[prompt_id]
+        self.prompt_queue.requeue(lease.item_id)
+
+    def get_lease(self, worker_id, prompt_id):
+        lease = self.leases.get(prompt_id, None)
+        if lease is None or lease.worker_id != worker_id:
+            raise LeaseLost(prompt_id)
+        return lease
+
+    def lease(self, worker_id, wait=0.0):
+        with self.lock:
+            self.workers[worker_id] = time.time()
+        task = self.prompt_queue.get(timeout=wait)
+        if task is None:
+            return None
+        item, item_id = task
+        with self.lock:
+            self.leases[item[1]] = Lease(worker_id, item, item_id, self.lease_timeout)
+        return {
+            "number": item[0],
+            "prompt_id": item[1],
+            "prompt": item[2],
+            "extra_data": item[3],
+            "outputs_to_execute": item[4],
+            "lease_timeout": self.lease_timeout,
+        }
+
+    def heartbeat(self, worker_id, prompt_ids):
+        lost = []
+        interrupt = False
+        with self.lock:
+            self.workers[worker_id] = time.time()
+            for prompt_id in prompt_ids:
+                try:
+                    lease = self.get_lease(worker_id, prompt_id)
+                except LeaseLost:
+                    lost.append(prompt_id)
+                    continue
+                lease.renew()
+                interrupt = interrupt or lease.interrupted
+                lease.interrupted = False
+        return {"lost": lost, "interrupt": interrupt}
+
+    def interrupt(self):
+        with self.lock:
+            for lease in self.leases.values():
+                lease.interrupted = True
+
+    def send_events(self, worker_id, prompt_id, events):
+        with self.lock:
+            try:
+                client_id = self.get_lease(worker_id, prompt_id).client_id()
+            except LeaseLost:
+                if prompt_id not in self.finished:
+                    raise
+                client_id = self.finished[prompt_id]
+
+        for event, data, broadcast in events:
+            sid = None if broadcast else client_id
+            if sid is None and not broadcast:
+                continue
+            if event == "preview_image":
+                image = Image.open(BytesIO(base64.b64decode(data["image"])))
+                self.server.send_sync(UNENCODED_PREVIEW_IMAGE, (data["format"], image, data["max_size"]), sid)
+            elif event == "preview_bytes":
+                self.server.send_sync(PREVIEW_IMAGE, base64.b64decode(data["data"]), sid)
+            else:
+                self.server.send_sync(event, data, sid)
+
+    def store_file(self, worker_id, prompt_id, type, subfolder, filename, data):
+        with self.lock:
+            self.get_lease(worker_id, prompt_id)
+        if type not in ("output", "temp"):
+            raise ValueError("can't upload to {}".format(type))
+        directory = os.path.abspath(folder_paths.get_directory_by_type(type))
+        path = os.path.abspath(os.path.join(directory, subfolder, filename))
+        if os.path.commonpath((directory, path)) != directory:
+            raise ValueError("invalid path {}".format(os.path.join(subfolder, filename)))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + ".part"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def complete(self, worker_id, prompt_id, outputs, status, profile=None):
+        with self.lock:
+            lease = self.get_lease(worker_id, prompt_id)
+            del self.leases[prompt_id]
+            self.finished[prompt_id] = lease.client_id()
+            while len(self.finished) > 1000:
+                self.finished.popitem(last=False)
+        if status is not None:
+            status = self.prompt_queue.ExecutionStatus(**status)
+        self.prompt_queue.task_done(lease.item_id, outputs, status=status, profile=profile)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "workers": dict(self.workers),
+                "leases": {k: {"worker_id": v.worker_id, "expires_in": v.deadline - time.perf_counter()} for k, v in self.leases.items()},
+            }
+
+class LoopbackCoordinator:
+    """The worker side interface to a LeaseManager in the same process, to run and test remote workers on one box."""
+    def __init__(self, lease_manager, worker_id):
+        self.lease_manager = lease_manager
+        self.worker_id = worker_id
+
+    def lease(self, wait):
+        return self.lease_manager.lease(self.worker_id, wait)
+
+    def heartbeat(self, prompt_ids):
+        return self.lease_manager.heartbeat(self.worker_id, prompt_ids)
+
+    def send_events(self, prompt_id, events):
+        # Go through json like the http coordinator so both see the same data
+        self.lease_manager.send_events(self.worker_id, prompt_id, json.loads(json.dumps(events)))
+
+    def upload(self, prompt_id, type, subfolder, filename, data):
+        self.lease_manager.store_file(self.worker_id, prompt_id, type, subfolder, filename, data)
+
+    def complete(self, prompt_id, outputs, status, profile=None):
+        self.lease_manager.complete(self.worker_id, prompt_id, json.loads(json.dumps(outputs)), status, profile)
+
+class HTTPCoordinator:
+    """The worker side interface to a ComfyUI server started with --enable-remote-workers."""
+    def __init__(self, url, worker_id, token=None):
+        self.url = url.rstrip("/")
+        self.worker_id = worker_id
+        self.token = token
+
+    def request(self, path, data=None, body=None, query=None, timeout=60.0):
+        query = dict(query or {}, worker_id=self.worker_id)
+        headers = {"Content-Type": "application/octet-stream"}
+        if data is not None:
+            body = json.dumps(data).encode("utf-8")
+            headers = {"Content-Type": "application/json"}
+        if self.token is not None:
+            headers[TOKEN_HEADER] = self.token
+        request = urllib.request.Request("{}{}?{}".format(self.url, path, urllib.parse.urlencode(query)), data=body, headers=headers, method="POST")
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                if response.status == 204:
+                    return None
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            if e.code == 409:
+                raise LeaseLost(e.read().decode("utf-8", errors="replace"))
+            raise
+
+    def lease(self, wait):
+        return self.request("/worker/lease", {"wait": wait}, timeout=wait + 30.0)
+
+    def heartbeat(self, prompt_ids):
+        return self.request("/worker/heartbeat", {"prompt_ids": prompt_ids})
+
+    def send_events(self, prompt_id, events):
+        self.request("/worker/events", {"prompt_id": prompt_id, "events": events})
+
+    def upload(self, prompt_id, type, subfolder, filename, data):
+        self.request("/worker/upload", body=data, query={"prompt_id": prompt_id, "type": type, "subfolder": subfolder, "filename": filename})
+
+    def complete(self, prompt_id, outputs, status, profile=None):
+        self.request("/worker/complete", {"prompt_id": prompt_id, "outputs": outputs, "status": status, "profile": profile})
+
+def encode_preview(image_data):
+    image_type, image, max_size = image_data
+    out = BytesIO()
+    image.save(out, format=image_type, quality=95, compress_level=1)
+    return {"format": image_type, "max_size": max_size, "image": base64.b64encode(out.getvalue()).decode("ascii")}
+
+def get_output_files(outputs):
+    out = []
+    for node_output in outputs.values():
+        for values in node_output.values():
+            if not isinstance(values, list):
+                continue
+            for x in values:
+                if isinstance(x, dict) and "filename" in x and x.get("type", "output") in ("output", "temp"):
+                    out.append((x.get("type", "output"), x.get("subfolder", ""), x["filename"]))
+    return out
+
+class RemoteServer:
+    """
+    Stands in for the PromptServer on a remote worker: the messages meant for clients
+    go to the coordinator, everything else goes to the local server.
+    """
+    def __init__(self, server, worker):
+        self.server = server
+        self.worker = worker
+        self.client_id = None
+        self.last_node_id = None
+        self.last_prompt_id = None
+
+    def send_sync(self, event, data, sid=None, prompt_id=None):
+        # Messages sent after the next prompt started still belong to their own prompt
+        if prompt_id is None and isinstance(data, dict):
+            prompt_id = data.get("prompt_id", None)
+        if prompt_id is None:
+            prompt_id = self.last_prompt_id
+        self.worker.add_event(prompt_id, event, data, sid is None)
+
+    def queue_updated(self):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self.server, name)
+
+class RemoteWorker:
+    """
+    Worker side of the remote worker protocol. Messages, output uploads and the
+    completion of each prompt are sent in order by one thread, another one keeps the
+    leases of the prompts that are running or still sending alive.
+
+    It is used as the queue of the prompt worker: get leases a prompt and task_done
+    completes it on the coordinator once its messages and outputs are sent.
+    """
+    def __init__(self, coordinator, heartbeat_interval=5.0, on_interrupt=None):
+        self.coordinator = coordinator
+        self.heartbeat_interval = heartbeat_interval
+        self.on_interrupt = on_interrupt
+        self.outbox = queue.Queue()
+        self.active = set()
+        self.lost = set()
+        self.lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self.send_loop, daemon=True, name="remote_worker_send").start()
+        threading.Thread(target=self.heartbeat_loop, daemon=True, name="remote_worker_heartbeat").start()
+
+    def get(self, timeout=None, worker=None):
+        """Leases the next prompt like PromptQueue.get, the item id is the prompt id."""
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            wait = 10.0
+            if deadline is not None:
+                wait = min(wait, max(deadline - time.perf_counter(), 0.0))
+            try:
+                lease = self.coordinator.lease(wait)
+            except LeaseLost:
+                lease = None
+            except Exception as e:
+                logging.warning("Can't lease a prompt from the coordinator: {}".format(e))
+                time.sleep(min(wait, 5.0))
+                lease = None
+            if lease is not None:
+                with self.lock:
+                    self.active.add(lease["prompt_id"])
+                item = (lease["number"], lease["prompt_id"], lease["prompt"], lease["extra_data"], lease["outputs_to_execute"])
+                return (item, lease["prompt_id"])
+            if deadline is not None and time.perf_counter() >= deadline:
+                return None
+
+    def get_batch(self, batch_key, max_items, max_wait=0.0, timeout=None, worker=None):
+        task = self.get(timeout=timeout)
+        return [task] if task is not None else None
+
+    def get_flags(self, reset=True, worker=None):
+        return {}
+
+    def add_event(self, prompt_id, event, data, broadcast):
+        if prompt_id is None:
+            return
+        if event == UNENCODED_PREVIEW_IMAGE:
+            event, data = "preview_image", encode_preview(data)
+        elif event == PREVIEW_IMAGE:
+            event, data = "preview_bytes", {"data": base64.b64encode(data).decode("ascii")}
+        elif not isinstance(event, str) or isinstance(data, (bytes, bytearray)):
+            return
+        self.outbox.put(("event", prompt_id, (event, data, broadcast)))
+
+    def task_done(self, prompt_id, outputs, status, profile=None):
+        self.outbox.put(("complete", prompt_id, (outputs, status._asdict() if status is not None else None, profile)))
+
+    def heartbeat_loop(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            with self.lock:
+                prompt_ids = list(self.active)
+            if len(prompt_ids) == 0:
+                continue
+            try:
+                result = self.coordinator.heartbeat(prompt_ids)
+            except Exception as e:
+                logging.warning("Remote worker heartbeat failed: {}".format(e))
+                continue
+            with self.lock:
+                self.lost.update(result["lost"])
+            if (result["interrupt"] or len(result["lost"]) > 0) and self.on_interrupt is not None:
+                self.on_interrupt()
+
+    def send_loop(self):
+        next_message = None
+        while True:
+            kind, prompt_id, data = next_message if next_message is not None else self.outbox.get()
+            next_message = None
+            if kind == "event":
+                events = [data]
+                # Send the messages that piled up together, only the last preview matters
+                while len(events) < 256:
+                    try:
+                        message = self.outbox.get_nowait()
+                    except queue.Empty:
+                        break
+                    if message[0] != "event" or message[1] != prompt_id:
+                        next_message = message
+                        break
+                    events.append(message[2])
+                previews = [i for i, x in enumerate(events) if x[0] in ("preview_image", "preview_bytes")]
+                events = [x for i, x in enumerate(events) if i not in previews[:-1]]
+                self.send(prompt_id, self.coordinator.send_events, prompt_id, events)
+            elif kind == "complete":
+                outputs, status, profile = data
+                for type, subfolder, filename in get_output_files(outputs):
+                    path = os.path.join(folder_paths.get_directory_by_type(type), subfolder, filename)
+                    try:
+                        with open(path, "rb") as f:
+                            file_data = f.read()
+                    except OSError as e:
+                        logging.warning("Can't upload {}: {}".format(path, e))
+                        continue
+                    self.send(prompt_id, self.coordinator.upload, prompt_id, type, subfolder, filename, file_data)
+                self.send(prompt_id, self.coordinator.complete, prompt_id, outputs, status, profile)
+                with self.lock:
+                    self.active.discard(prompt_id)
+                    self.lost.discard(prompt_id)
+
+    def send(self, prompt_id, function, *args, retries=5):
+        for i in range(retries):
+            with self.lock:
+                if prompt_id in self.lost:
+                    return False
+            try:
+                function(*args)
+                return True
+            except LeaseLost:
+                logging.warning("Lease of prompt {} was lost, dropping its results".format(prompt_id))
+                with self.lock:
+                    self.lost.add(prompt_id)
+                return False
+            except Exception as e:
+                logging.warning("Sending to the coordinator failed ({}), retrying: {}".format(i + 1, e))
+                time.sleep(min(2 ** i, 10))
+        return False
@@ -0,0 +1,165 @@
+import os
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+
+import torch
+
+class SpilledOutput:
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.value = None
+
+def get_tensor_size(value):
+    """Bytes of the tensors in value, None if it has something that can't go to a spill file."""
+    if isinstance(value, torch.Tensor):
+        if value.device.type != "cpu":
+            return None
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        total = 0
+        for x in value:
+            size = get_tensor_size(x)
+            if size is None:
+                return None
+            total += size
+        return total
+    if isinstance(value, dict):
+        if not all(isinstance(k, str) for k in value):
+            return None
+        return get_tensor_size(list(value.values()))
+    if isinstance(value, (int, float, str, bool, type(None))):
+        return 0
+    return None
+
+def delete_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logging.debug("Failed to delete {}: {}".format(path, e))
+        return False
+    return True
+
+class SpillTier:
+    """
+    Disk tier for cached node outputs. Once the outputs made of only tensors (IMAGE,
+    LATENT, MASK...) take more than ram_budget bytes, the least recently used ones
+    are written to files and replaced in the cache by a SpilledOutput. Getting one
+    maps its file back instead of reading it.
+
+    Spilled outputs past disk_budget bytes are dropped from the cache between
+    prompts, least recently used first, the ones the current prompt uses are kept.
+    """
+    MIN_SIZE = 1024 * 1024
+
+    def __init__(self, directory, ram_budget, disk_budget):
+        self.directory = os.path.join(directory, uuid.uuid4().hex)
+        self.ram_budget = ram_budget
+        self.disk_budget = disk_budget
+        self.ram = OrderedDict()
+        self.disk = OrderedDict()
+        self.ram_used = 0
+        self.disk_used = 0
+        self.lock = threading.RLock()
+        #spill files that couldn't be deleted yet
+        self.pending_deletes = []
+
+    def stored(self, store, key, value):
+        with self.lock:
+            self.removed(key)
+            size = get_tensor_size(value)
+            if size is None or size < self.MIN_SIZE:
+                return
+            self.ram[key] = size
+            self.ram_used += size
+            # The newest output is about to be used so it always stays
+            while self.ram_used > self.ram_budget and len(self.ram) > 1:
+                old_key, old_size = self.ram.popitem(last=False)
+                self.ram_used -= old_size
+                self.spill(store, old_key, old_size)
+
+    def spill(self, store, key, size):
+        path = os.path.join(self.directory, "{}.pt".format(uuid.uuid4().hex))
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            torch.save(store[key], path)
+        except Exception as e:
+            logging.warning("Failed to spill a cached output to {}: {}".format(path, e))
+            self.delete(path)
+            return
+        spilled = SpilledOutput(path, size)
+        store[key] = spilled
+        self.disk[key] = spilled
+        self.disk_used += size
+
+    def load(self, key, value):
+        with self.lock:
+            if not isinstance(value, SpilledOutput):
+                if key in self.ram:
+                    self.ram.move_to_end(key)
+                return value
+            if key in self.disk:
+                self.disk.move_to_end(key)
+            if value.value is None:
+                value.value = torch.load(value.path, mmap=True, weights_only=True)
+            return value.value
+
+    def removed(self, key):
+        with self.lock:
+            if key in self.ram:
+                self.ram_used -= self.ram.pop(key)
+            if key in self.disk:
+                spilled = self.disk.pop(key)
+                self.disk_used -= spilled.size
+                # Drop the mapping first, Windows can't delete a file that is still mapped
+                spilled.value = None
+                self.delete(spilled.path)
+
+    def evict(self, store, preserve_keys):
+        with self.lock:
+            self.retry_deletes()
+            for key in list(self.disk.keys()):
+                if self.disk_used <= self.disk_budget:
+                    break
+                if key in preserve_keys:
+                    continue
+                store.pop(key, None)
+                self.removed(key)
+
+    def clear(self):
+        with self.lock:
+            for spilled in self.disk.values():
+                spilled.value = None
+                self.delete(spilled.path)
+            self.ram.clear()
+            self.disk.clear()
+            self.ram_used = 0
+            self.disk_used = 0
+            self.retry_deletes()
+            if len(self.pending_deletes) > 0:
+                logging.warning("{} spilled outputs are still in use and couldn't be deleted".format(len(self.pending_deletes)))
+                return
+            try:
+                os.rmdir(self.directory)
+            except OSError:
+                pass
+
+    def delete(self, path):
+        # Outputs that are still used by a node keep the mapping alive, where that stops
+        # the file from being deleted it's tried again before the next eviction
+        if not delete_file(path):
+            with self.lock:
+                self.pending_deletes.append(path)
+
+    def retry_deletes(self):
+        with self.lock:
+            if len(self.pending_deletes) > 0:
+                self.pending_deletes = [x for x in self.pending_deletes if not delete_file(x)]
+
+    def get_stats(self):
+        with self.lock:
+            return {"ram_used": self.ram_used, "disk_used": self.disk_used, "spilled": len(self.disk)}
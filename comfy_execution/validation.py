@@ -0,0 +1,127 @@
+import inspect
+import hashlib
+import threading
+from collections import OrderedDict
+
+import nodes
+import folder_paths
+
+class NodeSchema:
+    """The INPUT_TYPES of a node class with the combo lists turned into sets for validation."""
+    def __init__(self, obj_class, serial):
+        self.obj_class = obj_class
+        self.serial = serial
+        with folder_paths.track_dependencies() as deps:
+            self.class_inputs = obj_class.INPUT_TYPES()
+        self.deps = deps
+        self.required = self.class_inputs['required']
+        self.validate_function_inputs = []
+        if hasattr(obj_class, "VALIDATE_INPUTS"):
+            self.validate_function_inputs = inspect.getfullargspec(obj_class.VALIDATE_INPUTS).args
+        self.choices = {}
+        for x, info in self.required.items():
+            if isinstance(info[0], list):
+                try:
+                    self.choices[x] = frozenset(info[0])
+                except TypeError:
+                    self.choices[x] = info[0]
+
+    def is_choice(self, input_name, value):
+        try:
+            return value in self.choices[input_name]
+        except TypeError:
+            return value in self.required[input_name][0]
+
+class ValidationCache:
+    """
+    Compiled schemas of the node classes, rebuilt when the class is registered
+    again or a folder listing its INPUT_TYPES read changed, and the signatures of
+    the sub-graphs that were already found valid.
+    """
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.schemas = {}
+        self.valid = OrderedDict()
+        self.serial = 0
+        self.lock = threading.RLock()
+
+    def get_schema(self, class_type, versions, rebuild=False):
+        obj_class = nodes.NODE_CLASS_MAPPINGS[class_type]
+        with self.lock:
+            schema = self.schemas.get(class_type, None)
+            if rebuild or schema is None or schema.obj_class is not obj_class or folder_paths.dependencies_changed(schema.deps, versions):
+                self.serial += 1
+                schema = NodeSchema(obj_class, self.serial)
+                self.schemas[class_type] = schema
+            return schema
+
+    def is_valid(self, signature):
+        with self.lock:
+            if signature in self.valid:
+                self.valid.move_to_end(signature)
+                return True
+            return False
+
+    def set_valid(self, signature):
+        with self.lock:
+            self.valid[signature] = True
+            while len(self.valid) > self.max_size:
+                self.valid.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.schemas.clear()
+            self.valid.clear()
+
+class ValidationContext:
+    """State shared by the validation of the nodes of one prompt."""
+    def __init__(self, prompt, cache):
+        self.prompt = prompt
+        self.cache = cache
+        self.versions = {}
+        self.signatures = {}
+        self.rebuilt = {}
+        #nodes whose whole sub-graph passed validation without any input being converted
+        self.cacheable = {}
+
+    def get_schema(self, class_type):
+        return self.cache.get_schema(class_type, self.versions)
+
+    def rebuild_schema(self, class_type):
+        """
+        Nodes that list files without folder_paths aren't tracked, a value missing
+        from their lists might have been added since the schema was made. The
+        schema of a class is made again at most once per prompt.
+        """
+        if class_type not in self.rebuilt:
+            self.rebuilt[class_type] = self.cache.get_schema(class_type, self.versions, rebuild=True)
+        return self.rebuilt[class_type]
+
+    def get_signature(self, node_id):
+        """
+        Hash of the node, its inputs and the signatures of the nodes linked to it.
+        None if the sub-graph has a node with a VALIDATE_INPUTS function, those
+        check things like files existing so they have to run every time.
+        """
+        if node_id in self.signatures:
+            return self.signatures[node_id]
+        self.signatures[node_id] = None
+        node = self.prompt[node_id]
+        schema = self.get_schema(node['class_type'])
+        if len(schema.validate_function_inputs) > 0:
+            return None
+        parts = [node['class_type'], schema.serial]
+        for x in sorted(node['inputs']):
+            val = node['inputs'][x]
+            if isinstance(val, list) and len(val) == 2 and isinstance(val[0], str) and val[0] in self.prompt:
+                linked = self.get_signature(val[0])
+                if linked is None:
+                    return None
+                parts.append((x, linked, val[1]))
+            else:
+                parts.append((x, val))
+        signature = hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()
+        self.signatures[node_id] = signature
+        return signature
+
+validation_cache = ValidationCache()
@@ -0,0 +1,60 @@
+import threading
+
+import torch
+
+import comfy.model_management
+import comfy.model_cache
+
+class WorkerServer:
+    """
+    The server as seen by one prompt worker: the client, prompt and node that are
+    running are kept per worker so concurrent prompts don't send their messages to
+    each other's clients, everything else goes to the real server.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.client_id = None
+        self.last_node_id = None
+        self.last_prompt_id = None
+
+    def __getattr__(self, name):
+        return getattr(self.server, name)
+
+class Worker:
+    def __init__(self, index, device, server=None):
+        self.index = index
+        self.device = device
+        self.name = "prompt_worker_{}".format(index)
+        self.server = WorkerServer(server) if server is not None else None
+
+    def __repr__(self):
+        return "{}({})".format(self.name, self.device)
+
+current = threading.local()
+
+def get_worker():
+    return getattr(current, "worker", None)
+
+def set_worker(worker):
+    current.worker = worker
+    comfy.model_management.set_thread_torch_device(worker.device if worker is not None else None)
+
+def get_server(server):
+    worker = get_worker()
+    if worker is None or worker.server is None:
+        return server
+    return worker.server
+
+def parse_devices(devices):
+    return [torch.device(x.strip()) for x in devices.split(",") if len(x.strip()) > 0]
+
+def get_resident_models(device):
+    """(files, size) of the models loaded on device."""
+    out = []
+    with comfy.model_management.models_lock:
+        for loaded in comfy.model_management.current_loaded_models:
+            if loaded.device == device:
+                files = comfy.model_cache.get_model_files(loaded.model)
+                if len(files) > 0:
+                    out.append((files, loaded.model_memory()))
+    return out
@@ -374,6 +374,7 @@ class SamplerCustom:
     RETURN_NAMES = ("output", "denoised_output")
 
     FUNCTION = "sample"
+    EXPENSIVE = True
 
     CATEGORY = "sampling/custom_sampling"
 
@@ -533,6 +534,7 @@ class SamplerCustomAdvanced:
     RETURN_NAMES = ("output", "denoised_output")
 
     FUNCTION = "sample"
+    EXPENSIVE = True
 
     CATEGORY = "sampling/custom_sampling"
 
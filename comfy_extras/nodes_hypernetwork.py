@@ -103,6 +103,7 @@ class HypernetworkLoader:
                               }}
     RETURN_TYPES = ("MODEL",)
     FUNCTION = "load_hypernetwork"
+    EXPENSIVE = True
 
     CATEGORY = "loaders"
 
@@ -122,6 +122,7 @@ class PhotoMakerLoader:
 
     RETURN_TYPES = ("PHOTOMAKER",)
     FUNCTION = "load_photomaker_model"
+    EXPENSIVE = True
 
     CATEGORY = "_for_testing/photomaker"
 
@@ -21,6 +21,7 @@ class UpscaleModelLoader:
                              }}
     RETURN_TYPES = ("UPSCALE_MODEL",)
     FUNCTION = "load_model"
+    EXPENSIVE = True
 
     CATEGORY = "loaders"
 
@@ -13,6 +13,7 @@ class ImageOnlyCheckpointLoader:
                              }}
     RETURN_TYPES = ("MODEL", "CLIP_VISION", "VAE")
     FUNCTION = "load_checkpoint"
+    EXPENSIVE = True
 
     CATEGORY = "loaders/video_models"
 
@@ -1,16 +1,84 @@
+import os
 import sys
-import copy
+import time
 import logging
 import threading
-import heapq
 import traceback
-import inspect
+import functools
+import concurrent.futures
+from enum import Enum
 from typing import List, Literal, NamedTuple, Optional
 
 import torch
 import nodes
+import folder_paths
+import latent_preview
 
 import comfy.model_management
+import comfy.model_cache
+from comfy_execution.caching import ClassicCache, LRUCache, CacheKeySetID, CacheKeySetInputSignature, IntermediateReleaser
+from comfy_execution.graph import ExecutionList, DependencyCycleError
+from comfy_execution.profiler import PromptProfiler
+import comfy_execution.workers
+from comfy_execution.prompt_queue import PendingQueue, QueueStore, HistoryIndex, get_history_keys, history_summary
+from comfy_execution.validation import ValidationContext, validation_cache
+from comfy_execution.spill import SpillTier
+
+class CacheType(Enum):
+    CLASSIC = 0
+    LRU = 1
+
+class IsChangedCache:
+    def __init__(self, prompt):
+        self.prompt = prompt
+        self.is_changed = {}
+
+    def get(self, node_id):
+        if node_id in self.is_changed:
+            return self.is_changed[node_id]
+
+        node = self.prompt[node_id]
+        class_type = node["class_type"]
+        class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
+        if not hasattr(class_def, "IS_CHANGED"):
+            self.is_changed[node_id] = False
+            return self.is_changed[node_id]
+
+        # Linked inputs are already part of the cache key through the upstream signature
+        input_data_all = get_input_data(node["inputs"], class_def, node_id)
+        try:
+            is_changed = map_node_over_list(class_def, input_data_all, "IS_CHANGED")
+        except Exception as e:
+            logging.warning("WARNING: {}".format(e))
+            is_changed = float("NaN")
+        self.is_changed[node_id] = is_changed
+        return self.is_changed[node_id]
+
+class CacheSet:
+    def __init__(self, lru_size=None, spill=None):
+        if lru_size is None or lru_size == 0:
+            self.init_classic_cache(spill)
+        else:
+            self.init_lru_cache(lru_size, spill)
+        self.all = [self.outputs, self.ui, self.objects]
+
+    def init_classic_cache(self, spill=None):
+        self.cache_type = CacheType.CLASSIC
+        self.outputs = ClassicCache(CacheKeySetInputSignature, spill=spill)
+        self.ui = ClassicCache(CacheKeySetInputSignature)
+        self.objects = ClassicCache(CacheKeySetID)
+
+    def init_lru_cache(self, cache_size, spill=None):
+        self.cache_type = CacheType.LRU
+        self.outputs = LRUCache(CacheKeySetInputSignature, max_size=cache_size, spill=spill)
+        self.ui = LRUCache(CacheKeySetInputSignature, max_size=cache_size)
+        self.objects = ClassicCache(CacheKeySetID)
+
+    def set_prompt(self, prompt):
+        is_changed_cache = IsChangedCache(prompt)
+        for cache in self.all:
+            cache.set_prompt(prompt, prompt.keys(), is_changed_cache)
+            cache.clean_unused()
 
 def get_input_data(inputs, class_def, unique_id, outputs={}, prompt={}, extra_data={}):
     valid_inputs = class_def.INPUT_TYPES()
@@ -20,10 +88,11 @@ def get_input_data(inputs, class_def, unique_id, outputs={}, prompt={}, extra_da
         if isinstance(input_data, list):
             input_unique_id = input_data[0]
             output_index = input_data[1]
-            if input_unique_id not in outputs:
+            cached_output = outputs.get(input_unique_id)
+            if cached_output is None:
                 input_data_all[x] = (None,)
                 continue
-            obj = outputs[input_unique_id][output_index]
+            obj = cached_output[output_index]
             input_data_all[x] = obj
         else:
             if ("required" in valid_inputs and x in valid_inputs["required"]) or ("optional" in valid_inputs and x in valid_inputs["optional"]):
@@ -40,6 +109,34 @@ def get_input_data(inputs, class_def, unique_id, outputs={}, prompt={}, extra_da
                 input_data_all[x] = [unique_id]
     return input_data_all
 
+def get_lazy_inputs(class_def):
+    # Only nodes that say which of them they need can have lazy inputs
+    if not hasattr(class_def, "check_lazy_status"):
+        return []
+    out = []
+    valid_inputs = class_def.INPUT_TYPES()
+    for section in ("required", "optional"):
+        for name, info in valid_inputs.get(section, {}).items():
+            if len(info) > 1 and isinstance(info[1], dict) and info[1].get("lazy", False) is True:
+                out.append(name)
+    return out
+
+def get_prompt_lazy_inputs(prompt):
+    def lazy_inputs(node_id):
+        return get_lazy_inputs(nodes.NODE_CLASS_MAPPINGS[prompt[node_id]["class_type"]])
+    return lazy_inputs
+
+def get_needed_lazy_nodes(obj, class_def, inputs, input_data_all, outputs):
+    """Asks the node which of its lazy inputs that weren't evaluated yet it needs, unevaluated inputs are passed as None."""
+    unevaluated = [x for x in get_lazy_inputs(class_def) if isinstance(inputs.get(x, None), list) and outputs.get(inputs[x][0]) is None]
+    if len(unevaluated) == 0:
+        return []
+    needed = set()
+    for result in map_node_over_list(obj, input_data_all, "check_lazy_status", allow_interrupt=True):
+        if result is not None:
+            needed.update(result)
+    return [inputs[x][0] for x in unevaluated if x in needed]
+
 def map_node_over_list(obj, input_data_all, func, allow_interrupt=False):
     # check if node wants the lists
     input_is_list = False
@@ -78,12 +175,15 @@ def get_output_data(obj, input_data_all):
     
     results = []
     uis = []
+    pending = []
     return_values = map_node_over_list(obj, input_data_all, obj.FUNCTION, allow_interrupt=True)
 
     for r in return_values:
         if isinstance(r, dict):
             if 'ui' in r:
                 uis.append(r['ui'])
+            if 'pending' in r:
+                pending += r['pending']
             if 'result' in r:
                 results.append(r['result'])
         else:
@@ -106,7 +206,24 @@ def get_output_data(obj, input_data_all):
     ui = dict()    
     if len(uis) > 0:
         ui = {k: [y for x in uis for y in x[k]] for k in uis[0].keys()}
-    return output, ui
+    return output, ui, pending
+
+def call_when_done(futures, callback):
+    futures = list(futures)
+    if len(futures) == 0:
+        callback()
+        return
+
+    remaining = [len(futures)]
+    lock = threading.Lock()
+    def done(future):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+        callback()
+    for future in futures:
+        future.add_done_callback(done)
 
 def format_value(x):
     if x is None:
@@ -116,44 +233,55 @@ def format_value(x):
     else:
         return str(x)
 
-def recursive_execute(server, prompt, outputs, current_item, extra_data, executed, prompt_id, outputs_ui, object_storage):
+def execute(server, prompt, caches, current_item, extra_data, executed, prompt_id, pending_writes, profiler=None, execution_list=None):
     unique_id = current_item
-    inputs = prompt[unique_id]['inputs']
     class_type = prompt[unique_id]['class_type']
-    class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
-    if unique_id in outputs:
+    if caches.outputs.get(unique_id) is not None:
+        if profiler is not None:
+            profiler.add_cached(unique_id, class_type)
         return (True, None, None)
 
-    for x in inputs:
-        input_data = inputs[x]
-
-        if isinstance(input_data, list):
-            input_unique_id = input_data[0]
-            output_index = input_data[1]
-            if input_unique_id not in outputs:
-                result = recursive_execute(server, prompt, outputs, input_unique_id, extra_data, executed, prompt_id, outputs_ui, object_storage)
-                if result[0] is not True:
-                    # Another node failed further upstream
-                    return result
+    if profiler is None:
+        return execute_node(server, prompt, caches, unique_id, extra_data, executed, prompt_id, pending_writes, execution_list)
+    with profiler.node(unique_id, class_type) as record:
+        result = execute_node(server, prompt, caches, unique_id, extra_data, executed, prompt_id, pending_writes, execution_list)
+        record["success"] = result[0] is True
+        if result[0] is True and unique_id not in executed:
+            record["waiting_for_lazy_inputs"] = True
+        return result
 
+def execute_node(server, prompt, caches, unique_id, extra_data, executed, prompt_id, pending_writes, execution_list=None):
+    inputs = prompt[unique_id]['inputs']
+    class_type = prompt[unique_id]['class_type']
+    class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
     input_data_all = None
     try:
-        input_data_all = get_input_data(inputs, class_def, unique_id, outputs, prompt, extra_data)
+        input_data_all = get_input_data(inputs, class_def, unique_id, caches.outputs, prompt, extra_data)
+        obj = caches.objects.get(unique_id)
+        if obj is None:
+            obj = class_def()
+            caches.objects.set(unique_id, obj)
+
+        if execution_list is not None:
+            needed = get_needed_lazy_nodes(obj, class_def, inputs, input_data_all, caches.outputs)
+            if execution_list.add_lazy_dependencies(unique_id, needed):
+                # Executed again once the lazy inputs it needs are
+                return (True, None, None)
+
         if server.client_id is not None:
             server.last_node_id = unique_id
             server.send_sync("executing", { "node": unique_id, "prompt_id": prompt_id }, server.client_id)
 
-        obj = object_storage.get((unique_id, class_type), None)
-        if obj is None:
-            obj = class_def()
-            object_storage[(unique_id, class_type)] = obj
-
-        output_data, output_ui = get_output_data(obj, input_data_all)
-        outputs[unique_id] = output_data
+        with latent_preview.node_previews():
+            output_data, output_ui, pending = get_output_data(obj, input_data_all)
+        caches.outputs.set(unique_id, output_data)
+        pending_writes += pending
         if len(output_ui) > 0:
-            outputs_ui[unique_id] = output_ui
+            caches.ui.set(unique_id, output_ui)
             if server.client_id is not None:
-                server.send_sync("executed", { "node": unique_id, "output": output_ui, "prompt_id": prompt_id }, server.client_id)
+                # Only tell the client about the files once they are written
+                message = { "node": unique_id, "output": output_ui, "prompt_id": prompt_id }
+                call_when_done(pending, functools.partial(server.send_sync, "executed", message, server.client_id))
     except comfy.model_management.InterruptProcessingException as iex:
         logging.info("Processing interrupted")
 
@@ -173,7 +301,8 @@ def recursive_execute(server, prompt, outputs, current_item, extra_data, execute
                 input_data_formatted[name] = [format_value(x) for x in inputs]
 
         output_data_formatted = {}
-        for node_id, node_outputs in outputs.items():
+        for node_id in caches.outputs.cached_node_ids():
+            node_outputs = caches.outputs.get(node_id)
             output_data_formatted[node_id] = [[format_value(x) for x in l] for l in node_outputs]
 
         logging.error(f"!!! Exception during processing!!! {ex}")
@@ -193,100 +322,150 @@ def recursive_execute(server, prompt, outputs, current_item, extra_data, execute
 
     return (True, None, None)
 
-def recursive_will_execute(prompt, outputs, current_item, memo={}):
-    unique_id = current_item
-
-    if unique_id in memo:
-        return memo[unique_id]
-
-    inputs = prompt[unique_id]['inputs']
-    will_execute = []
-    if unique_id in outputs:
-        return []
-
-    for x in inputs:
-        input_data = inputs[x]
-        if isinstance(input_data, list):
-            input_unique_id = input_data[0]
-            output_index = input_data[1]
-            if input_unique_id not in outputs:
-                will_execute += recursive_will_execute(prompt, outputs, input_unique_id, memo)
-
-    memo[unique_id] = will_execute + [unique_id]
-    return memo[unique_id]
-
-def recursive_output_delete_if_changed(prompt, old_prompt, outputs, current_item):
-    unique_id = current_item
-    inputs = prompt[unique_id]['inputs']
-    class_type = prompt[unique_id]['class_type']
-    class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
-
-    is_changed_old = ''
-    is_changed = ''
-    to_delete = False
-    if hasattr(class_def, 'IS_CHANGED'):
-        if unique_id in old_prompt and 'is_changed' in old_prompt[unique_id]:
-            is_changed_old = old_prompt[unique_id]['is_changed']
-        if 'is_changed' not in prompt[unique_id]:
-            input_data_all = get_input_data(inputs, class_def, unique_id, outputs)
-            if input_data_all is not None:
-                try:
-                    #is_changed = class_def.IS_CHANGED(**input_data_all)
-                    is_changed = map_node_over_list(class_def, input_data_all, "IS_CHANGED")
-                    prompt[unique_id]['is_changed'] = is_changed
-                except:
-                    to_delete = True
-        else:
-            is_changed = prompt[unique_id]['is_changed']
-
-    if unique_id not in outputs:
-        return True
-
-    if not to_delete:
-        if is_changed != is_changed_old:
-            to_delete = True
-        elif unique_id not in old_prompt:
-            to_delete = True
-        elif inputs == old_prompt[unique_id]['inputs']:
-            for x in inputs:
-                input_data = inputs[x]
-
-                if isinstance(input_data, list):
-                    input_unique_id = input_data[0]
-                    output_index = input_data[1]
-                    if input_unique_id in outputs:
-                        to_delete = recursive_output_delete_if_changed(prompt, old_prompt, outputs, input_unique_id)
-                    else:
-                        to_delete = True
-                    if to_delete:
-                        break
-        else:
-            to_delete = True
-
-    if to_delete:
-        d = outputs.pop(unique_id)
-        del d
-    return to_delete
+class PrefixedCache:
+    def __init__(self, cache, prefix):
+        self.cache = cache
+        self.prefix = prefix
+
+    def get(self, node_id):
+        return self.cache.get(self.prefix + node_id)
+
+    def set(self, node_id, value):
+        self.cache.set(self.prefix + node_id, value)
+
+    def cached_node_ids(self):
+        return [x[len(self.prefix):] for x in self.cache.cached_node_ids() if x.startswith(self.prefix)]
+
+class PrefixedCacheSet:
+    def __init__(self, caches, prefix):
+        self.outputs = PrefixedCache(caches.outputs, prefix)
+        self.ui = PrefixedCache(caches.ui, prefix)
+        self.objects = PrefixedCache(caches.objects, prefix)
+
+class BatchedPrompt:
+    def __init__(self, index, caches, prompt, prompt_id, extra_data={}, execute_outputs=[]):
+        self.prefix = "{}:".format(index)
+        self.caches = PrefixedCacheSet(caches, self.prefix)
+        self.prompt = prompt
+        self.prompt_id = prompt_id
+        self.extra_data = extra_data
+        self.execute_outputs = execute_outputs
+        self.client_id = extra_data.get("client_id", None)
+        self.executed = set()
+        self.status_messages = []
+        self.pending_writes = []
+        self.outputs_ui = {}
+        self.success = True
+        self.profiler = PromptProfiler()
+        self.profile = None
+
+def get_prompt_batch_key(prompt):
+    # Prompts with the same graph can be executed together so their batchable nodes share a run
+    batchable = False
+    key = []
+    for node_id in sorted(prompt.keys()):
+        class_type = prompt[node_id]["class_type"]
+        class_def = nodes.NODE_CLASS_MAPPINGS.get(class_type, None)
+        if class_def is not None and len(get_lazy_inputs(class_def)) > 0:
+            # Lazy inputs aren't supported in merged graphs
+            return None
+        if class_def is not None and hasattr(class_def, "BATCH_FUNCTION"):
+            batchable = True
+        links = []
+        for name, value in prompt[node_id]["inputs"].items():
+            if isinstance(value, list):
+                links.append((name, tuple(value)))
+        key.append((node_id, class_type, tuple(sorted(links))))
+    if not batchable:
+        return None
+    return tuple(key)
+
+def get_prompt_model_files(prompt, versions=None):
+    """Full paths of the files picked in the combo inputs of nodes that list a model folder."""
+    if versions is None:
+        versions = {}
+    out = []
+    for node in prompt.values():
+        if node.get("class_type", None) not in nodes.NODE_CLASS_MAPPINGS:
+            continue
+        try:
+            schema = validation_cache.get_schema(node["class_type"], versions)
+        except Exception:
+            continue
+        folders = [x[1] for x in schema.deps if x[0] == "folder"]
+        if len(folders) == 0:
+            continue
+        for name, value in node.get("inputs", {}).items():
+            if not isinstance(value, str) or name not in schema.choices:
+                continue
+            for folder in folders:
+                full_path = folder_paths.get_full_path(folder, value)
+                if full_path is not None:
+                    out.append(os.path.abspath(full_path))
+                    break
+    return out
+
+def get_upcoming_model_files(prompt_queue, max_prompts=8):
+    """Model files of the running prompts (0) and of the next queued ones (1, 2...), in the order they will be read."""
+    running, queued = prompt_queue.get_current_queue()
+    versions = {}
+    out = {}
+    for distance, items in [(0, running)] + [(i + 1, [x]) for i, x in enumerate(queued[:max_prompts])]:
+        for item in items:
+            for full_path in get_prompt_model_files(item[2], versions):
+                out.setdefault(full_path, distance)
+    return out
+
+def get_queued_model_files(prompt_queue, max_prompts=8):
+    """
+    The model files the next queued prompts will read, in the order they will be read,
+    and the ones the running prompts will read. Files of the models already loaded are
+    left out.
+    """
+    loaded = comfy.model_cache.get_loaded_files()
+    files = [(x, distance) for x, distance in get_upcoming_model_files(prompt_queue, max_prompts).items() if x not in loaded]
+    return [x for x, distance in files if distance > 0], [x for x, distance in files if distance == 0]
+
+def is_thread_safe(class_def):
+    return getattr(class_def, "THREAD_SAFE", False) is True
+
+def is_expensive(class_def):
+    return getattr(class_def, "EXPENSIVE", False) is True
 
 class PromptExecutor:
-    def __init__(self, server):
+    def __init__(self, server, lru_size=None, parallel_workers=0, release_intermediates=False, spill_ram_budget=0, spill_disk_budget=0):
+        self.lru_size = lru_size
         self.server = server
+        self.spill_ram_budget = spill_ram_budget
+        self.spill_disk_budget = spill_disk_budget
+        self.spill = None
+        # Outputs of nodes that aren't output nodes or EXPENSIVE are dropped once all their consumers ran
+        self.release_intermediates = release_intermediates
+        self.worker_pool = None
+        if parallel_workers > 0:
+            # Only nodes flagged THREAD_SAFE run here, everything else stays on the prompt worker thread
+            self.worker_pool = concurrent.futures.ThreadPoolExecutor(max_workers=parallel_workers, thread_name_prefix="node_worker")
         self.reset()
 
     def reset(self):
-        self.outputs = {}
-        self.object_storage = {}
+        if self.spill is not None:
+            self.spill.clear()
+        self.spill = None
+        if self.spill_ram_budget > 0:
+            self.spill = SpillTier(os.path.join(folder_paths.get_temp_directory(), "cache_spill"), self.spill_ram_budget, self.spill_disk_budget)
+        self.caches = CacheSet(self.lru_size, self.spill)
         self.outputs_ui = {}
         self.status_messages = []
+        self.pending_writes = []
         self.success = True
-        self.old_prompt = {}
+        self.profile = None
 
     def add_message(self, event, data, broadcast: bool):
         self.status_messages.append((event, data))
         if self.server.client_id is not None or broadcast:
             self.server.send_sync(event, data, self.server.client_id)
 
-    def handle_execution_error(self, prompt_id, prompt, current_outputs, executed, error, ex):
+    def handle_execution_error(self, prompt_id, prompt, executed, error, ex):
         node_id = error["node_id"]
         class_type = prompt[node_id]["class_type"]
 
@@ -314,18 +493,6 @@ class PromptExecutor:
                 "current_outputs": error["current_outputs"],
             }
             self.add_message("execution_error", mes, broadcast=False)
-        
-        # Next, remove the subsequent outputs since they will not be executed
-        to_delete = []
-        for o in self.outputs:
-            if (o not in current_outputs) and (o not in executed):
-                to_delete += [o]
-                if o in self.old_prompt:
-                    d = self.old_prompt.pop(o)
-                    del d
-        for o in to_delete:
-            d = self.outputs.pop(o)
-            del d
 
     def execute(self, prompt, prompt_id, extra_data={}, execute_outputs=[]):
         nodes.interrupt_processing(False)
@@ -336,89 +503,303 @@ class PromptExecutor:
             self.server.client_id = None
 
         self.status_messages = []
+        self.pending_writes = []
+        self.success = True
+        self.profiler = PromptProfiler()
         self.add_message("execution_start", { "prompt_id": prompt_id}, broadcast=False)
 
         with torch.inference_mode():
-            #delete cached outputs if nodes don't exist for them
-            to_delete = []
-            for o in self.outputs:
-                if o not in prompt:
-                    to_delete += [o]
-            for o in to_delete:
-                d = self.outputs.pop(o)
-                del d
-            to_delete = []
-            for o in self.object_storage:
-                if o[0] not in prompt:
-                    to_delete += [o]
-                else:
-                    p = prompt[o[0]]
-                    if o[1] != p['class_type']:
-                        to_delete += [o]
-            for o in to_delete:
-                d = self.object_storage.pop(o)
-                del d
-
-            for x in prompt:
-                recursive_output_delete_if_changed(prompt, self.old_prompt, self.outputs, x)
-
-            current_outputs = set(self.outputs.keys())
-            for x in list(self.outputs_ui.keys()):
-                if x not in current_outputs:
-                    d = self.outputs_ui.pop(x)
-                    del d
+            self.caches.set_prompt(prompt)
+            cached_nodes = self.caches.outputs.cached_node_ids()
+            for node_id in cached_nodes:
+                self.profiler.add_cached(node_id, prompt[node_id]["class_type"])
 
             comfy.model_management.cleanup_models(keep_clone_weights_loaded=True)
             self.add_message("execution_cached",
-                          { "nodes": list(current_outputs) , "prompt_id": prompt_id},
+                          { "nodes": cached_nodes, "prompt_id": prompt_id},
                           broadcast=False)
             executed = set()
-            output_node_id = None
-            to_execute = []
-
-            for node_id in list(execute_outputs):
-                to_execute += [(0, node_id)]
-
-            while len(to_execute) > 0:
-                #always execute the output that depends on the least amount of unexecuted nodes first
-                memo = {}
-                to_execute = sorted(list(map(lambda a: (len(recursive_will_execute(prompt, self.outputs, a[-1], memo)), a[-1]), to_execute)))
-                output_node_id = to_execute.pop(0)[-1]
-
-                # This call shouldn't raise anything if there's an error deep in
-                # the actual SD code, instead it will report the node where the
-                # error was raised
-                self.success, error, ex = recursive_execute(self.server, prompt, self.outputs, output_node_id, extra_data, executed, prompt_id, self.outputs_ui, self.object_storage)
-                if self.success is not True:
-                    self.handle_execution_error(prompt_id, prompt, current_outputs, executed, error, ex)
-                    break
+            execution_list = ExecutionList(prompt, self.caches.outputs, get_prompt_lazy_inputs(prompt))
+            try:
+                execution_list.add_outputs(execute_outputs)
+            except DependencyCycleError as ex:
+                self.success = False
+                error = {
+                    "node_id": ex.node_id,
+                    "exception_message": str(ex),
+                    "exception_type": full_type_name(type(ex)),
+                    "traceback": [],
+                    "current_inputs": {},
+                    "current_outputs": {},
+                }
+                self.handle_execution_error(prompt_id, prompt, executed, error, ex)
+
+            releaser = None
+            if self.release_intermediates:
+                keep = set(execute_outputs)
+                for node_id in prompt:
+                    class_def = nodes.NODE_CLASS_MAPPINGS[prompt[node_id]["class_type"]]
+                    if getattr(class_def, "OUTPUT_NODE", False) is True or is_expensive(class_def):
+                        keep.add(node_id)
+                releaser = IntermediateReleaser(prompt, execute_outputs, self.caches.outputs, keep)
+
+            if self.worker_pool is not None:
+                self.execute_parallel(prompt, prompt_id, extra_data, execution_list, executed, releaser)
+            else:
+                while self.success and not execution_list.is_empty():
+                    node_id = execution_list.stage_node_execution()
+
+                    # This call shouldn't raise anything if there's an error deep in
+                    # the actual SD code, instead it will report the node where the
+                    # error was raised
+                    self.success, error, ex = execute(self.server, prompt, self.caches, node_id, extra_data, executed, prompt_id, self.pending_writes, self.profiler, execution_list)
+                    if self.success is not True:
+                        self.handle_execution_error(prompt_id, prompt, executed, error, ex)
+                        break
+                    self.complete_node(execution_list, node_id, releaser)
 
-            for x in executed:
-                self.old_prompt[x] = copy.deepcopy(prompt[x])
+            self.outputs_ui = {}
+            for node_id in self.caches.ui.cached_node_ids():
+                self.outputs_ui[node_id] = self.caches.ui.get(node_id)
+            self.profile = self.profiler.get_profile()
             self.server.last_node_id = None
             if comfy.model_management.DISABLE_SMART_MEMORY:
                 comfy.model_management.unload_all_models()
 
+    def execute_batch(self, items):
+        """
+        Executes several prompts as one merged graph. Identical nodes are only run once
+        through the cache and ready nodes with a BATCH_FUNCTION are run together.
+        """
+        if len(items) == 1:
+            self.execute(*items[0])
+            batch = BatchedPrompt(0, self.caches, *items[0])
+            batch.status_messages = self.status_messages
+            batch.pending_writes = self.pending_writes
+            batch.outputs_ui = self.outputs_ui
+            batch.success = self.success
+            batch.profile = self.profile
+            return [batch]
+
+        nodes.interrupt_processing(False)
+        batches = [BatchedPrompt(i, self.caches, *item) for i, item in enumerate(items)]
+        merged = {}
+        for batch in batches:
+            for node_id, node in batch.prompt.items():
+                inputs = {}
+                for name, value in node["inputs"].items():
+                    if isinstance(value, list):
+                        value = [batch.prefix + value[0], value[1]]
+                    inputs[name] = value
+                merged[batch.prefix + node_id] = {"class_type": node["class_type"], "inputs": inputs}
+
+        with torch.inference_mode():
+            self.caches.set_prompt(merged)
+            execution_list = ExecutionList(merged, self.caches.outputs)
+            try:
+                execution_list.add_outputs([b.prefix + x for b in batches for x in b.execute_outputs])
+            except DependencyCycleError:
+                return [self.execute_batch([item])[0] for item in items]
+
+            for batch in batches:
+                self.switch_to(batch)
+                self.add_message("execution_start", { "prompt_id": batch.prompt_id}, broadcast=False)
+                self.add_message("execution_cached", { "nodes": batch.caches.outputs.cached_node_ids(), "prompt_id": batch.prompt_id}, broadcast=False)
+                for node_id in batch.caches.outputs.cached_node_ids():
+                    batch.profiler.add_cached(node_id, batch.prompt[node_id]["class_type"])
+            comfy.model_management.cleanup_models(keep_clone_weights_loaded=True)
 
+            while execution_list.has_ready_nodes():
+                ready = execution_list.get_ready_nodes()
+                to_execute = None
+                for merged_id in ready:
+                    batch, node_id = self.find_batch(batches, merged_id)
+                    if not batch.success:
+                        # Never completed, so nothing downstream of it runs either
+                        execution_list.stage_node_execution(merged_id)
+                        to_execute = []
+                        break
+                    class_def = nodes.NODE_CLASS_MAPPINGS[merged[merged_id]["class_type"]]
+                    if not hasattr(class_def, "BATCH_FUNCTION") or batch.caches.outputs.get(node_id) is not None:
+                        to_execute = [merged_id]
+                        break
+
+                if to_execute is None:
+                    # Only batchable nodes are left, run all of the same type together
+                    class_type = merged[ready[0]]["class_type"]
+                    to_execute = [x for x in ready if merged[x]["class_type"] == class_type]
 
-def validate_inputs(prompt, item, validated):
+                for merged_id in to_execute:
+                    execution_list.stage_node_execution(merged_id)
+                if len(to_execute) > 1:
+                    done = self.execute_batched_nodes(batches, to_execute)
+                else:
+                    done = []
+                    for merged_id in to_execute:
+                        if self.execute_batch_node(batches, merged_id):
+                            done.append(merged_id)
+                for merged_id in done:
+                    execution_list.complete_node_execution(merged_id)
+
+            for batch in batches:
+                for node_id in batch.caches.ui.cached_node_ids():
+                    batch.outputs_ui[node_id] = batch.caches.ui.get(node_id)
+                batch.profile = batch.profiler.get_profile()
+            self.server.last_node_id = None
+            if comfy.model_management.DISABLE_SMART_MEMORY:
+                comfy.model_management.unload_all_models()
+        return batches
+
+    def switch_to(self, batch):
+        self.server.client_id = batch.client_id
+        self.status_messages = batch.status_messages
+
+    def find_batch(self, batches, merged_id):
+        index, node_id = merged_id.split(":", 1)
+        return batches[int(index)], node_id
+
+    def execute_batch_node(self, batches, merged_id):
+        batch, node_id = self.find_batch(batches, merged_id)
+        self.switch_to(batch)
+        success, error, ex = execute(self.server, batch.prompt, batch.caches, node_id, batch.extra_data, batch.executed, batch.prompt_id, batch.pending_writes, batch.profiler)
+        if success is not True:
+            if isinstance(ex, comfy.model_management.InterruptProcessingException):
+                self.interrupt_batches(batches, node_id, ex)
+            else:
+                self.handle_execution_error(batch.prompt_id, batch.prompt, batch.executed, error, ex)
+                batch.success = False
+        return success
+
+    def interrupt_batches(self, batches, node_id, ex):
+        # An interrupt stops every prompt that is executed together
+        for batch in batches:
+            if batch.success and node_id in batch.prompt:
+                self.switch_to(batch)
+                self.handle_execution_error(batch.prompt_id, batch.prompt, batch.executed, { "node_id": node_id }, ex)
+            batch.success = False
+
+    def execute_batched_nodes(self, batches, merged_ids):
+        requests = []
+        try:
+            for merged_id in merged_ids:
+                batch, node_id = self.find_batch(batches, merged_id)
+                class_def = nodes.NODE_CLASS_MAPPINGS[batch.prompt[node_id]["class_type"]]
+                input_data_all = get_input_data(batch.prompt[node_id]["inputs"], class_def, node_id, batch.caches.outputs, batch.prompt, batch.extra_data)
+                if any(len(x) != 1 for x in input_data_all.values()):
+                    raise ValueError("list inputs can't be batched")
+                requests.append({k: v[0] for k, v in input_data_all.items()})
+
+            for merged_id in merged_ids:
+                batch, node_id = self.find_batch(batches, merged_id)
+                if batch.client_id is not None:
+                    self.server.last_node_id = node_id
+                    self.server.send_sync("executing", { "node": node_id, "prompt_id": batch.prompt_id }, batch.client_id)
+
+            batch, node_id = self.find_batch(batches, merged_ids[0])
+            obj = batch.caches.objects.get(node_id)
+            if obj is None:
+                obj = class_def()
+                batch.caches.objects.set(node_id, obj)
+            nodes.before_node_execution()
+            with batch.profiler.node(node_id, batch.prompt[node_id]["class_type"]) as record:
+                with latent_preview.node_previews():
+                    results = getattr(obj, class_def.BATCH_FUNCTION)(requests)
+                record["success"] = True
+                record["batch_size"] = len(requests)
+        except comfy.model_management.InterruptProcessingException as iex:
+            logging.info("Processing interrupted")
+            self.interrupt_batches(batches, node_id, iex)
+            return []
+        except Exception as e:
+            # Running them one by one reports the error on the right node
+            logging.warning("Batched execution of {} nodes failed, running them separately: {}".format(len(merged_ids), e))
+            return [x for x in merged_ids if self.execute_batch_node(batches, x)]
+
+        for merged_id, result in zip(merged_ids, results):
+            batch, node_id = self.find_batch(batches, merged_id)
+            if merged_id != merged_ids[0]:
+                batch.profiler.add_record(dict(record, node_id=node_id))
+            batch.caches.outputs.set(node_id, [[x] for x in result])
+            batch.executed.add(node_id)
+        return merged_ids
+
+    def complete_node(self, execution_list, node_id, releaser):
+        execution_list.complete_node_execution(node_id)
+        if releaser is not None and node_id in execution_list.completed:
+            releaser.node_executed(node_id)
+
+    def execute_parallel(self, prompt, prompt_id, extra_data, execution_list, executed, releaser=None):
+        worker = comfy_execution.workers.get_worker()
+        def execute_in_worker(node_id):
+            comfy_execution.workers.set_worker(worker)
+            with torch.inference_mode():
+                return execute(self.server, prompt, self.caches, node_id, extra_data, executed, prompt_id, self.pending_writes, self.profiler)
+
+        running = {}
+        failure = None
+        while True:
+            for future in [x for x in running if x.done()]:
+                node_id = running.pop(future)
+                result = future.result()
+                if result[0] is not True:
+                    if failure is None:
+                        failure = result
+                else:
+                    self.complete_node(execution_list, node_id, releaser)
+
+            node_id = None
+            if failure is None:
+                node_id = execution_list.stage_node_execution()
+            if node_id is None:
+                if len(running) == 0:
+                    break
+                concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                continue
+
+            class_def = nodes.NODE_CLASS_MAPPINGS[prompt[node_id]["class_type"]]
+            # Nodes with lazy inputs change the execution list so they stay on this thread
+            if is_thread_safe(class_def) and len(get_lazy_inputs(class_def)) == 0:
+                running[self.worker_pool.submit(execute_in_worker, node_id)] = node_id
+                continue
+
+            result = execute(self.server, prompt, self.caches, node_id, extra_data, executed, prompt_id, self.pending_writes, self.profiler, execution_list)
+            if result[0] is not True:
+                failure = result
+            else:
+                self.complete_node(execution_list, node_id, releaser)
+
+        if failure is not None:
+            self.success, error, ex = failure
+            self.handle_execution_error(prompt_id, prompt, executed, error, ex)
+
+
+
+def validate_inputs(prompt, item, validated, context=None):
     unique_id = item
     if unique_id in validated:
         return validated[unique_id]
+    if context is None:
+        context = ValidationContext(prompt, validation_cache)
 
     inputs = prompt[unique_id]['inputs']
     class_type = prompt[unique_id]['class_type']
-    obj_class = nodes.NODE_CLASS_MAPPINGS[class_type]
+    schema = context.get_schema(class_type)
+    obj_class = schema.obj_class
+
+    # The same sub-graph was already found valid
+    signature = context.get_signature(unique_id)
+    if signature is not None and context.cache.is_valid(signature):
+        context.cacheable[unique_id] = True
+        validated[unique_id] = (True, [], unique_id)
+        return validated[unique_id]
 
-    class_inputs = obj_class.INPUT_TYPES()
-    required_inputs = class_inputs['required']
+    required_inputs = schema.required
 
     errors = []
     valid = True
+    cacheable = signature is not None
 
-    validate_function_inputs = []
-    if hasattr(obj_class, "VALIDATE_INPUTS"):
-        validate_function_inputs = inspect.getfullargspec(obj_class.VALIDATE_INPUTS).args
+    validate_function_inputs = schema.validate_function_inputs
 
     for x in required_inputs:
         if x not in inputs:
@@ -471,7 +852,8 @@ def validate_inputs(prompt, item, validated):
                 errors.append(error)
                 continue
             try:
-                r = validate_inputs(prompt, o_id, validated)
+                r = validate_inputs(prompt, o_id, validated, context)
+                cacheable = cacheable and context.cacheable.get(o_id, False)
                 if r[0] is False:
                     # `r` will be set in `validated[o_id]` already
                     valid = False
@@ -497,6 +879,7 @@ def validate_inputs(prompt, item, validated):
                 continue
         else:
             try:
+                received = val
                 if type_input == "INT":
                     val = int(val)
                     inputs[x] = val
@@ -506,6 +889,9 @@ def validate_inputs(prompt, item, validated):
                 if type_input == "STRING":
                     val = str(val)
                     inputs[x] = val
+                if type(val) is not type(received) or val != received:
+                    # The signature was made from the value before the conversion
+                    cacheable = False
             except Exception as ex:
                 error = {
                     "type": "invalid_input_type",
@@ -550,8 +936,12 @@ def validate_inputs(prompt, item, validated):
                     continue
 
             if x not in validate_function_inputs:
-                if isinstance(type_input, list):
-                    if val not in type_input:
+                if isinstance(type_input, list) and not schema.is_choice(x, val):
+                    schema = context.rebuild_schema(class_type)
+                    cacheable = False
+                    info = schema.required.get(x, info)
+                    type_input = info[0]
+                    if isinstance(type_input, list) and (x not in schema.choices or not schema.is_choice(x, val)):
                         input_config = info
                         list_info = ""
 
@@ -607,9 +997,13 @@ def validate_inputs(prompt, item, validated):
 
     if len(errors) > 0 or valid is not True:
         ret = (False, errors, unique_id)
+        cacheable = False
     else:
         ret = (True, [], unique_id)
 
+    if cacheable:
+        context.cache.set_valid(signature)
+    context.cacheable[unique_id] = cacheable
     validated[unique_id] = ret
     return ret
 
@@ -625,7 +1019,7 @@ def validate_prompt(prompt):
         if 'class_type' not in prompt[x]:
             error = {
                 "type": "invalid_prompt",
-                "message": f"Cannot execute because a node is missing the class_type property.",
+                "message": "Cannot execute because a node is missing the class_type property.",
                 "details": f"Node ID '#{x}'",
                 "extra_info": {}
             }
@@ -658,11 +1052,12 @@ def validate_prompt(prompt):
     errors = []
     node_errors = {}
     validated = {}
+    context = ValidationContext(prompt, validation_cache)
     for o in outputs:
         valid = False
         reasons = []
         try:
-            m = validate_inputs(prompt, o, validated)
+            m = validate_inputs(prompt, o, validated, context)
             valid = m[0]
             reasons = m[1]
         except Exception as ex:
@@ -730,35 +1125,136 @@ def validate_prompt(prompt):
 MAXIMUM_HISTORY_SIZE = 10000
 
 class PromptQueue:
-    def __init__(self, server):
+    def __init__(self, server, store=None, fair_share=False):
         self.server = server
         self.mutex = threading.RLock()
         self.not_empty = threading.Condition(self.mutex)
         self.task_counter = 0
-        self.queue = []
+        self.queue = PendingQueue(fair_share)
         self.currently_running = {}
         self.history = {}
+        self.history_index = HistoryIndex()
         self.flags = {}
+        self.scheduler = None
+        self.worker_flags = {}
+        self.store = store if store is not None else QueueStore()
         server.prompt_queue = self
 
+        for prompt_id, entry in self.store.load_history(MAXIMUM_HISTORY_SIZE):
+            self.add_history(prompt_id, entry)
+        queued = self.store.load_queue()
+        for item in queued:
+            self.queue.push(item)
+        if len(queued) > 0:
+            logging.info("Restored {} queued prompts".format(len(queued)))
+            # New prompts go after the restored ones
+            server.number = max(server.number, int(max(x[0] for x in queued)) + 1)
+
     def put(self, item):
         with self.mutex:
-            heapq.heappush(self.queue, item)
+            self.store.add_queued(item)
+            self.queue.push(item)
             self.server.queue_updated()
-            self.not_empty.notify()
+            if self.scheduler is not None:
+                self.not_empty.notify_all()
+            else:
+                self.not_empty.notify()
+
+    def set_scheduler(self, scheduler):
+        """Shares the queue between several prompt workers, scheduler picks the one that runs each prompt."""
+        with self.mutex:
+            self.scheduler = scheduler
+            self.worker_flags = {w: {} for w in scheduler.workers}
 
-    def get(self, timeout=None):
+    def get(self, timeout=None, worker=None):
+        if worker is not None and self.scheduler is not None:
+            return self._get_scheduled(worker, timeout)
         with self.not_empty:
             while len(self.queue) == 0:
                 self.not_empty.wait(timeout=timeout)
                 if timeout is not None and len(self.queue) == 0:
                     return None
-            item = heapq.heappop(self.queue)
-            i = self.task_counter
-            self.currently_running[i] = copy.deepcopy(item)
-            self.task_counter += 1
+            item = self.queue.pop()
+            return self._start_task(item)
+
+    def _get_scheduled(self, worker, timeout=None):
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        with self.not_empty:
+            self.scheduler.set_idle(worker)
+            while True:
+                wait = None
+                item = self.queue.peek()
+                if item is not None:
+                    chosen, wait = self.scheduler.pick(item)
+                    if chosen is worker:
+                        self.queue.pop()
+                        self.scheduler.forget(item[1])
+                        self.scheduler.set_busy(worker)
+                        # The next prompt might be for one of the other idle workers
+                        self.not_empty.notify_all()
+                        return self._start_task(item)
+                    if chosen is not None:
+                        self.not_empty.notify_all()
+
+                if deadline is not None:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        return None
+                    wait = remaining if wait is None else min(wait, remaining)
+                self.not_empty.wait(timeout=wait)
+
+    def _start_task(self, item):
+        i = self.task_counter
+        self.currently_running[i] = item
+        self.task_counter += 1
+        self.server.queue_updated()
+        return (item, i)
+
+    def get_batch(self, batch_key, max_items, max_wait=0.0, timeout=None, worker=None):
+        """
+        Like get but also takes up to max_items - 1 queued prompts with the same
+        batch_key as the first one, waiting at most max_wait seconds for them to arrive.
+        """
+        first = self.get(timeout=timeout, worker=worker)
+        if first is None:
+            return None
+        key = batch_key(first[0][2])
+        if key is None or max_items <= 1:
+            return [first]
+
+        out = [first]
+        keys = {}
+        deadline = time.perf_counter() + max_wait
+        with self.not_empty:
+            while True:
+                for item in self.queue.get_items():
+                    if len(out) >= max_items:
+                        break
+                    if item[1] not in keys:
+                        keys[item[1]] = batch_key(item[2])
+                    if keys[item[1]] == key:
+                        self.queue.remove(item[1])
+                        if self.scheduler is not None:
+                            self.scheduler.forget(item[1])
+                        out.append(self._start_task(item))
+
+                remaining = deadline - time.perf_counter()
+                if len(out) >= max_items or remaining <= 0:
+                    break
+                self.not_empty.wait(timeout=remaining)
+        return out
+
+    def requeue(self, item_id):
+        """Puts a running prompt back in the queue, for prompts whose remote worker went away."""
+        with self.mutex:
+            item = self.currently_running.pop(item_id, None)
+            if item is None:
+                return False
+            self.store.add_queued(item)
+            self.queue.push(item)
             self.server.queue_updated()
-            return (item, i)
+            self.not_empty.notify_all()
+            return True
 
     class ExecutionStatus(NamedTuple):
         status_str: Literal['success', 'error']
@@ -766,21 +1262,26 @@ class PromptQueue:
         messages: List[str]
 
     def task_done(self, item_id, outputs,
-                  status: Optional['PromptQueue.ExecutionStatus']):
+                  status: Optional['PromptQueue.ExecutionStatus'], profile=None):
         with self.mutex:
             prompt = self.currently_running.pop(item_id)
             if len(self.history) > MAXIMUM_HISTORY_SIZE:
-                self.history.pop(next(iter(self.history)))
+                oldest = self.history_index.oldest()
+                self.remove_history(oldest)
+                self.store.remove_history([oldest])
 
             status_dict: Optional[dict] = None
             if status is not None:
-                status_dict = copy.deepcopy(status._asdict())
+                status_dict = status._asdict()
 
-            self.history[prompt[1]] = {
+            # The outputs are never modified after the prompt is done so they are kept by reference
+            self.add_history(prompt[1], {
                 "prompt": prompt,
-                "outputs": copy.deepcopy(outputs),
+                "outputs": dict(outputs),
                 'status': status_dict,
-            }
+                "profile": profile,
+            })
+            self.store.add_history(prompt[1], self.history[prompt[1]])
             self.server.queue_updated()
 
     def get_current_queue(self):
@@ -788,7 +1289,7 @@ class PromptQueue:
             out = []
             for x in self.currently_running.values():
                 out += [x]
-            return (out, copy.deepcopy(self.queue))
+            return (out, self.queue.get_items())
 
     def get_tasks_remaining(self):
         with self.mutex:
@@ -796,56 +1297,85 @@ class PromptQueue:
 
     def wipe_queue(self):
         with self.mutex:
-            self.queue = []
+            self.store.remove_queued(list(self.queue.items.keys()))
+            if self.scheduler is not None:
+                for prompt_id in self.queue.items:
+                    self.scheduler.forget(prompt_id)
+            self.queue.clear()
             self.server.queue_updated()
 
     def delete_queue_item(self, function):
         with self.mutex:
-            for x in range(len(self.queue)):
-                if function(self.queue[x]):
-                    if len(self.queue) == 1:
-                        self.wipe_queue()
-                    else:
-                        self.queue.pop(x)
-                        heapq.heapify(self.queue)
+            for item in self.queue.get_items():
+                if function(item):
+                    self.queue.remove(item[1])
+                    self.store.remove_queued([item[1]])
+                    if self.scheduler is not None:
+                        self.scheduler.forget(item[1])
                     self.server.queue_updated()
                     return True
         return False
 
-    def get_history(self, prompt_id=None, max_items=None, offset=-1):
+    def add_history(self, prompt_id, entry):
+        self.history.pop(prompt_id, None)
+        self.history[prompt_id] = entry
+        self.history_index.add(prompt_id, get_history_keys(entry))
+
+    def remove_history(self, prompt_id):
+        self.history.pop(prompt_id, None)
+        self.history_index.remove(prompt_id)
+
+    def get_history(self, prompt_id=None, max_items=None, offset=-1, before=None, filters=None, summary=False):
+        """
+        Without a prompt_id returns the newest max_items entries, or max_items entries
+        starting at offset. before (a prompt_id, for the next page) and filters (a dict
+        of status, client_id and node_type) go through the history index so only the
+        returned entries are touched. summary leaves out the prompts.
+        """
         with self.mutex:
             if prompt_id is None:
-                out = {}
-                i = 0
-                if offset < 0 and max_items is not None:
-                    offset = len(self.history) - max_items
-                for k in self.history:
-                    if i >= offset:
-                        out[k] = self.history[k]
-                        if max_items is not None and len(out) >= max_items:
-                            break
-                    i += 1
-                return out
+                if offset >= 0:
+                    if before is not None or filters:
+                        raise ValueError("offset can't be combined with before or filters")
+                    prompt_ids = self.history_index.slice(offset, max_items)
+                else:
+                    prompt_ids = self.history_index.page(max_items, before=before, filters=filters)
             elif prompt_id in self.history:
-                return {prompt_id: copy.deepcopy(self.history[prompt_id])}
+                prompt_ids = [prompt_id]
             else:
                 return {}
 
+            if summary:
+                return {x: history_summary(self.history[x]) for x in prompt_ids}
+            return {x: self.history[x] for x in prompt_ids}
+
     def wipe_history(self):
         with self.mutex:
             self.history = {}
+            self.history_index.clear()
+            self.store.clear_history()
 
     def delete_history_item(self, id_to_delete):
         with self.mutex:
-            self.history.pop(id_to_delete, None)
+            self.remove_history(id_to_delete)
+            self.store.remove_history([id_to_delete])
 
     def set_flag(self, name, data):
         with self.mutex:
             self.flags[name] = data
-            self.not_empty.notify()
+            # Every worker has to free its own device and caches
+            for flags in self.worker_flags.values():
+                flags[name] = data
+            self.not_empty.notify_all()
 
-    def get_flags(self, reset=True):
+    def get_flags(self, reset=True, worker=None):
         with self.mutex:
+            if worker is not None and worker in self.worker_flags:
+                ret = self.worker_flags[worker]
+                if reset:
+                    self.worker_flags[worker] = {}
+                    return ret
+                return ret.copy()
             if reset:
                 ret = self.flags
                 self.flags = {}
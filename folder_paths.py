@@ -1,6 +1,9 @@
 import os
+import json
 import time
 import logging
+import threading
+import contextlib
 
 supported_pt_extensions = set(['.ckpt', '.pt', '.bin', '.pth', '.safetensors', '.pkl'])
 
@@ -41,6 +44,13 @@ user_directory = os.path.join(os.path.dirname(os.path.realpath(__file__)), "user
 
 filename_list_cache = {}
 
+folder_indexes = {}
+folder_index_lock = threading.RLock()
+model_index_save_lock = threading.Lock()
+model_index_file = None
+model_index_rescan_interval = 1.0
+dependency_tracker = threading.local()
+
 if not os.path.exists(input_directory):
     try:
         os.makedirs(input_directory)
@@ -171,12 +181,222 @@ def filter_files_extensions(files, extensions):
 
 
 
+class FolderIndex:
+    """
+    Listing of everything under a model folder. Each directory is kept with its
+    mtime and entries so a rescan only has to stat the directories and list the
+    ones that changed again instead of walking the whole tree.
+    """
+    def __init__(self, path, dirs=None, excluded_dir_names=(".git",)):
+        self.path = path
+        self.excluded_dir_names = excluded_dir_names
+        self.dirs = dirs if dirs is not None else {} #relative dir -> [mtime_ns, files, subdirs]
+        self.checked = None
+        self.version = 0
+        self.files = None #(dirs, files) so a listing built while dirs was replaced isn't kept
+        # Only held by the refresh of this folder, the other folders are listed meanwhile
+        self.lock = threading.Lock()
+
+    def scan_dir(self, rel):
+        full = os.path.join(self.path, rel)
+        mtime = os.stat(full).st_mtime_ns
+        files = []
+        subdirs = []
+        with os.scandir(full) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if not is_dir:
+                    files.append(entry.name)
+                elif entry.name not in self.excluded_dir_names:
+                    subdirs.append(entry.name)
+        return [mtime, files, subdirs]
+
+    def remove_dir(self, dirs, rel):
+        prefix = os.path.join(rel, "")
+        for k in [k for k in dirs if k == rel or k.startswith(prefix)]:
+            del dirs[k]
+
+    def refresh(self):
+        # The changes are made to a copy that replaces dirs at the end, readers never
+        # see a listing that is half updated
+        if not os.path.isdir(self.path):
+            changed = len(self.dirs) > 0
+            dirs = {}
+        else:
+            dirs = dict(self.dirs)
+            changed = False
+            pending = []
+            if "" not in dirs:
+                pending.append("")
+            for rel, entry in list(dirs.items()):
+                try:
+                    if os.stat(os.path.join(self.path, rel)).st_mtime_ns != entry[0]:
+                        pending.append(rel)
+                except OSError:
+                    self.remove_dir(dirs, rel)
+                    changed = True
+            changed = changed or len(pending) > 0
+            while len(pending) > 0:
+                rel = pending.pop()
+                old = dirs.get(rel, None)
+                try:
+                    entry = self.scan_dir(rel)
+                except OSError:
+                    logging.warning("Warning: Unable to access {}. Skipping this path.".format(os.path.join(self.path, rel)))
+                    self.remove_dir(dirs, rel)
+                    continue
+                dirs[rel] = entry
+                if old is not None:
+                    for d in set(old[2]) - set(entry[2]):
+                        self.remove_dir(dirs, os.path.join(rel, d))
+                for d in entry[2]:
+                    child = os.path.join(rel, d)
+                    if child not in dirs:
+                        pending.append(child)
+        if changed:
+            logging.debug("model folder {} changed, {} directories".format(self.path, len(dirs)))
+            self.dirs = dirs
+            self.version += 1
+        return changed
+
+    def get_files(self):
+        dirs = self.dirs
+        cached = self.files
+        if cached is not None and cached[0] is dirs:
+            return cached[1]
+        files = {}
+        for rel, entry in dirs.items():
+            for f in entry[1]:
+                files[os.path.join(rel, f)] = None
+        self.files = (dirs, files)
+        return files
+
+def get_folder_index(path):
+    with folder_index_lock:
+        index = folder_indexes.get(path, None)
+        if index is None:
+            index = FolderIndex(path)
+            folder_indexes[path] = index
+    with index.lock:
+        now = time.monotonic()
+        if index.checked is None or now - index.checked >= model_index_rescan_interval:
+            changed = index.refresh()
+            index.checked = now
+        else:
+            changed = False
+    if changed and model_index_file is not None and path in get_model_folder_paths():
+        save_model_index()
+    return index
+
+def get_model_folder_paths():
+    # Only the model folders are persisted, input and temp change with every upload
+    return set(x for paths, extensions in folder_names_and_paths.values() for x in paths)
+
+def save_model_index():
+    model_folders = get_model_folder_paths()
+    with folder_index_lock:
+        data = {"version": 1, "folders": {k: v.dirs for k, v in folder_indexes.items() if k in model_folders}}
+    with model_index_save_lock:
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(model_index_file)), exist_ok=True)
+            temp_file = "{}.{}.tmp".format(model_index_file, os.getpid())
+            with open(temp_file, "w") as f:
+                json.dump(data, f)
+            os.replace(temp_file, model_index_file)
+        except OSError as e:
+            logging.warning("Failed to save the model index to {}: {}".format(model_index_file, e))
+
+def set_model_index(index_file=None, rescan_interval=1.0):
+    """Persists the model folder listings to index_file and only checks the folders for changes every rescan_interval seconds."""
+    global model_index_file
+    global model_index_rescan_interval
+    model_index_rescan_interval = rescan_interval
+    model_index_file = index_file
+    if index_file is None or not os.path.isfile(index_file):
+        return
+    try:
+        with open(index_file) as f:
+            data = json.load(f)
+        if data.get("version", None) != 1:
+            return
+        with folder_index_lock:
+            for path, dirs in data["folders"].items():
+                if path not in folder_indexes:
+                    folder_indexes[path] = FolderIndex(path, dirs)
+    except Exception as e:
+        logging.warning("Failed to load the model index from {}: {}".format(index_file, e))
+
+def mark_folder_changed(path):
+    """Makes the next listing of the folders containing path check them for changes right away."""
+    path = os.path.abspath(path)
+    with folder_index_lock:
+        for x, index in folder_indexes.items():
+            x = os.path.abspath(x)
+            if path == x or path.startswith(os.path.join(x, "")):
+                index.checked = None
+
+@contextlib.contextmanager
+def track_dependencies():
+    """Records the folder listings read in this thread, get_dependency_version tells if one of them changed since."""
+    old = getattr(dependency_tracker, "deps", None)
+    deps = {}
+    dependency_tracker.deps = deps
+    try:
+        yield deps
+    finally:
+        dependency_tracker.deps = old
+        if old is not None:
+            old.update(deps)
+
+def add_dependency(key, version):
+    deps = getattr(dependency_tracker, "deps", None)
+    if deps is not None:
+        deps[key] = version
+
+def get_dependency_version(key):
+    kind, name = key
+    if kind == "folder":
+        if name not in folder_names_and_paths:
+            return None
+        return get_index_key(name)
+    return get_folder_index(name).version
+
+def dependencies_changed(deps, versions=None):
+    """versions can be shared between calls to only check each dependency once."""
+    if versions is None:
+        versions = {}
+    for key, version in deps.items():
+        if key not in versions:
+            try:
+                versions[key] = get_dependency_version(key)
+            except Exception:
+                versions[key] = None
+        if versions[key] != version:
+            return True
+    return False
+
+def get_folder_files(path):
+    """The files under path relative to it."""
+    index = get_folder_index(path)
+    add_dependency(("files", path), index.version)
+    return list(index.get_files())
+
 def get_full_path(folder_name, filename):
     global folder_names_and_paths
     if folder_name not in folder_names_and_paths:
         return None
     folders = folder_names_and_paths[folder_name]
     filename = os.path.relpath(os.path.join("/", filename), "/")
+    for x in folders[0]:
+        if filename in get_folder_index(x).get_files():
+            full_path = os.path.join(x, filename)
+            if os.path.isfile(full_path):
+                return full_path
+
+    # Not indexed yet, the file might have been added since the last rescan
     for x in folders[0]:
         full_path = os.path.join(x, filename)
         if os.path.isfile(full_path):
@@ -186,17 +406,19 @@ def get_full_path(folder_name, filename):
 
     return None
 
+def get_index_key(folder_name):
+    folders = folder_names_and_paths[folder_name]
+    return (tuple((x, get_folder_index(x).version) for x in folders[0]), tuple(sorted(folders[1])))
+
 def get_filename_list_(folder_name):
     global folder_names_and_paths
     output_list = set()
     folders = folder_names_and_paths[folder_name]
-    output_folders = {}
+    key = get_index_key(folder_name)
     for x in folders[0]:
-        files, folders_all = recursive_search(x, excluded_dir_names=[".git"])
-        output_list.update(filter_files_extensions(files, folders[1]))
-        output_folders = {**output_folders, **folders_all}
+        output_list.update(filter_files_extensions(get_folder_index(x).get_files(), folders[1]))
 
-    return (sorted(list(output_list)), output_folders, time.perf_counter())
+    return (sorted(list(output_list)), key, time.perf_counter())
 
 def cached_filename_list_(folder_name):
     global filename_list_cache
@@ -204,19 +426,8 @@ def cached_filename_list_(folder_name):
     if folder_name not in filename_list_cache:
         return None
     out = filename_list_cache[folder_name]
-
-    for x in out[1]:
-        time_modified = out[1][x]
-        folder = x
-        if os.path.getmtime(folder) != time_modified:
-            return None
-
-    folders = folder_names_and_paths[folder_name]
-    for x in folders[0]:
-        if os.path.isdir(x):
-            if x not in out[1]:
-                return None
-
+    if out[1] != get_index_key(folder_name):
+        return None
     return out
 
 def get_filename_list(folder_name):
@@ -225,6 +436,7 @@ def get_filename_list(folder_name):
         out = get_filename_list_(folder_name)
         global filename_list_cache
         filename_list_cache[folder_name] = out
+    add_dependency(("folder", folder_name), out[1])
     return list(out[0])
 
 def get_save_image_path(filename_prefix, output_dir, image_width=0, image_height=0):
@@ -0,0 +1,131 @@
+import os
+import threading
+import logging
+import concurrent.futures
+
+import numpy as np
+from PIL import Image
+
+from comfy.cli_args import args
+
+class ImageWriter:
+    """
+    Converts, encodes and writes images on a pool of background threads. At most
+    max_pending images can be waiting at the same time, submitting more blocks
+    until one of them is written.
+    """
+    def __init__(self, threads=2, max_pending=16):
+        self.threads = threads
+        self.pool = None
+        if threads > 0:
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix="image_writer")
+        self.slots = threading.BoundedSemaphore(max(max_pending, 1))
+        self.mutex = threading.Lock()
+        self.pending = set()
+
+    def save_png(self, image, path, pnginfo=None, compress_level=4):
+        if self.pool is None:
+            future = concurrent.futures.Future()
+            try:
+                write_png(image, path, pnginfo, compress_level)
+                future.set_result(path)
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        self.slots.acquire()
+        try:
+            future = self.pool.submit(write_png, image, path, pnginfo, compress_level)
+        except:
+            self.slots.release()
+            raise
+        with self.mutex:
+            self.pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self.mutex:
+            self.pending.discard(future)
+        self.slots.release()
+        if future.exception() is not None:
+            logging.error("Failed to save image: {}".format(future.exception()))
+
+    def flush(self, timeout=None):
+        with self.mutex:
+            pending = list(self.pending)
+        concurrent.futures.wait(pending, timeout=timeout)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+
+def write_png(image, path, pnginfo=None, compress_level=4):
+    i = 255. * image.cpu().numpy()
+    img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
+    # Only show up under the final name once the data hit the disk
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        img.save(f, format="PNG", pnginfo=pnginfo, compress_level=compress_level)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    return path
+
+#(folder, filename) -> [next counter, reservations whose files aren't written yet]
+reserved_counters = {}
+reserved_counters_lock = threading.Lock()
+
+def get_counter_key(full_output_folder, filename):
+    return (os.path.normcase(os.path.abspath(full_output_folder)), os.path.normcase(filename))
+
+def reserve_counter(full_output_folder, filename, counter, count):
+    # Files that are still being written aren't on disk yet, so the counter
+    # from folder_paths.get_save_image_path can't be trusted on its own.
+    key = get_counter_key(full_output_folder, filename)
+    with reserved_counters_lock:
+        reserved = reserved_counters.setdefault(key, [0, 0])
+        counter = max(counter, reserved[0])
+        reserved[0] = counter + count
+        reserved[1] += 1
+    return counter
+
+def release_counter(full_output_folder, filename, futures):
+    """Forgets a reservation once its files are written, get_save_image_path sees them from then on."""
+    key = get_counter_key(full_output_folder, filename)
+    remaining = [len(futures)]
+    def release(future=None):
+        with reserved_counters_lock:
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+            reserved = reserved_counters.get(key, None)
+            if reserved is None:
+                return
+            reserved[1] -= 1
+            if reserved[1] <= 0:
+                del reserved_counters[key]
+    if len(futures) == 0:
+        remaining[0] = 1
+        release()
+        return
+    for future in futures:
+        future.add_done_callback(release)
+
+writer = None
+writer_lock = threading.Lock()
+
+def get_writer():
+    global writer
+    with writer_lock:
+        if writer is None:
+            writer = ImageWriter(threads=args.save_image_threads, max_pending=args.save_image_queue_size)
+        return writer
+
+def shutdown():
+    global writer
+    with writer_lock:
+        if writer is not None:
+            writer.flush()
+            writer.shutdown()
+            writer = None
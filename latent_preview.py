@@ -1,10 +1,17 @@
 import torch
-from PIL import Image
+from PIL import Image, ImageOps
 import struct
+import time
+import functools
+import threading
+import contextlib
+from io import BytesIO
+from collections import OrderedDict
 import numpy as np
 from comfy.cli_args import args, LatentPreviewMethod
 from comfy.taesd.taesd import TAESD
 import comfy.model_management
+import comfy_execution.workers
 import folder_paths
 import comfy.utils
 import logging
@@ -45,6 +52,10 @@ class Latent2RGBPreviewer(LatentPreviewer):
         return preview_to_image(latent_image)
 
 
+#previewers are kept loaded per latent format and device instead of being loaded again for every sampler
+previewers = {}
+previewers_lock = threading.Lock()
+
 def get_previewer(device, latent_format):
     previewer = None
     method = args.preview_method
@@ -62,33 +73,134 @@ def get_previewer(device, latent_format):
         if method == LatentPreviewMethod.Auto:
             method = LatentPreviewMethod.Latent2RGB
 
-        if method == LatentPreviewMethod.TAESD:
-            if taesd_decoder_path:
-                taesd = TAESD(None, taesd_decoder_path).to(device)
-                previewer = TAESDPreviewerImpl(taesd)
-            else:
-                logging.warning("Warning: TAESD previews enabled, but could not find models/vae_approx/{}".format(latent_format.taesd_decoder_name))
-
-        if previewer is None:
-            if latent_format.latent_rgb_factors is not None:
-                previewer = Latent2RGBPreviewer(latent_format.latent_rgb_factors)
+        key = (method, str(device), type(latent_format), taesd_decoder_path)
+        with previewers_lock:
+            if key in previewers:
+                return previewers[key]
+
+            if method == LatentPreviewMethod.TAESD:
+                if taesd_decoder_path:
+                    taesd = TAESD(None, taesd_decoder_path).to(device)
+                    previewer = TAESDPreviewerImpl(taesd)
+                else:
+                    logging.warning("Warning: TAESD previews enabled, but could not find models/vae_approx/{}".format(latent_format.taesd_decoder_name))
+
+            if previewer is None:
+                if latent_format.latent_rgb_factors is not None:
+                    previewer = Latent2RGBPreviewer(latent_format.latent_rgb_factors)
+            previewers[key] = previewer
     return previewer
 
+def clear_previewers():
+    # The TAESD decoders aren't in the loaded models, they are dropped with them
+    with previewers_lock:
+        previewers.clear()
+
+comfy.model_management.unload_all_callbacks.append(clear_previewers)
+
+def encode_preview_image(image_type, image, max_size):
+    """The bytes of a PREVIEW_IMAGE message."""
+    if max_size is not None:
+        image = ImageOps.contain(image, (max_size, max_size), Image.Resampling.BILINEAR)
+    out = BytesIO()
+    out.write(struct.pack(">I", 2 if image_type == "PNG" else 1))
+    image.save(out, format=image_type, quality=95, compress_level=1)
+    return out.getvalue()
+
+class PreviewWorker:
+    """
+    Decodes and encodes the previews on its own thread so the samplers don't wait
+    for them. Only the latest frame of each sampler is kept, the ones that weren't
+    sent yet when a newer one comes are dropped.
+    """
+    def __init__(self):
+        self.pending = OrderedDict()
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def submit(self, stream, job):
+        with self.cond:
+            self.pending.pop(stream, None)
+            self.pending[stream] = job
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="preview_worker", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while len(self.pending) == 0:
+                    self.cond.wait()
+                stream, job = self.pending.popitem(last=False)
+            try:
+                job()
+            except Exception as e:
+                logging.warning("Failed to send a preview: {}".format(e))
+
+preview_worker = PreviewWorker()
+
+class PreviewStream:
+    """
+    The previews of one sampler. They go to the client and prompt that started it
+    and aren't sent anymore once the node that runs it is done, even if it failed.
+    """
+    def __init__(self, send):
+        self.send = send
+        self.closed = False
+
+current = threading.local()
+
+@contextlib.contextmanager
+def node_previews():
+    """Closes the preview streams of the samplers started in this block on this thread."""
+    old = getattr(current, "streams", None)
+    streams = []
+    current.streams = streams
+    try:
+        yield
+    finally:
+        current.streams = old
+        for stream in streams:
+            stream.closed = True
+
+def send_preview(previewer, preview_format, x0, pbar, worker, stream):
+    if stream.closed or pbar.current >= pbar.total:
+        # The sampler is done, the preview is stale
+        return
+    comfy_execution.workers.set_worker(worker)
+    with torch.no_grad():
+        preview_image = previewer.decode_latent_to_preview_image(preview_format, x0)
+    if not stream.closed:
+        stream.send(encode_preview_image(*preview_image))
+
 def prepare_callback(model, steps, x0_output_dict=None):
     preview_format = "JPEG"
     if preview_format not in ["JPEG", "PNG"]:
         preview_format = "JPEG"
 
-    previewer = get_previewer(model.load_device, model.model.latent_format)
+    previewer = None
+    stream = None
+    if comfy.utils.PREVIEW_HOOK is not None:
+        previewer = get_previewer(model.load_device, model.model.latent_format)
+        stream = PreviewStream(comfy.utils.PREVIEW_HOOK())
+        streams = getattr(current, "streams", None)
+        if streams is not None:
+            streams.append(stream)
 
     pbar = comfy.utils.ProgressBar(steps)
+    worker = comfy_execution.workers.get_worker()
+    min_interval = 1.0 / args.preview_max_fps if args.preview_max_fps > 0 else 0.0
+    last_preview = [None]
     def callback(step, x0, x, total_steps):
         if x0_output_dict is not None:
             x0_output_dict["x0"] = x0
 
-        preview_bytes = None
+        pbar.update_absolute(step + 1, total_steps, None)
         if previewer:
-            preview_bytes = previewer.decode_latent_to_preview_image(preview_format, x0)
-        pbar.update_absolute(step + 1, total_steps, preview_bytes)
+            now = time.perf_counter()
+            if last_preview[0] is None or now - last_preview[0] >= min_interval:
+                last_preview[0] = now
+                preview_worker.submit(stream, functools.partial(send_preview, previewer, preview_format, x0[:1].detach().clone(), pbar, worker, stream))
     return callback
 
@@ -50,7 +50,9 @@ execute_prestartup_script()
 import asyncio
 import itertools
 import shutil
+import socket
 import threading
+import functools
 import gc
 
 from comfy.cli_args import args
@@ -74,10 +76,18 @@ import comfy.utils
 import yaml
 
 import execution
+import comfy_execution.prompt_queue
+import comfy_execution.workers
+import comfy_execution.remote
 import server
+import image_writer
 from server import BinaryEventTypes
 from nodes import init_custom_nodes
 import comfy.model_management
+import comfy.model_cache
+import comfy.model_prefetch
+import comfy.model_eviction
+import comfy.file_fingerprint
 
 def cuda_malloc_warning():
     device = comfy.model_management.get_torch_device()
@@ -90,8 +100,30 @@ def cuda_malloc_warning():
         if cuda_malloc_warning:
             logging.warning("\nWARNING: this card most likely does not support cuda-malloc, if you get \"CUDA error\" please run ComfyUI with: --disable-cuda-malloc\n")
 
-def prompt_worker(q, server):
-    e = execution.PromptExecutor(server)
+def prompt_done(q, item_id, prompt_id, outputs_ui, status_messages, success, execution_start_time, pending_writes, profile=None):
+    # Runs once the images of the prompt are written, possibly while the next prompt runs
+    for f in pending_writes:
+        if f.exception() is not None:
+            success = False
+            status_messages.append(("execution_error", { "prompt_id": prompt_id, "exception_message": str(f.exception()), "exception_type": type(f.exception()).__name__ }))
+
+    q.task_done(item_id,
+                outputs_ui,
+                status=execution.PromptQueue.ExecutionStatus(
+                    status_str='success' if success else 'error',
+                    completed=success,
+                    messages=status_messages),
+                profile=profile)
+
+    execution_time = time.perf_counter() - execution_start_time
+    logging.info("Prompt executed in {:.2f} seconds".format(execution_time))
+
+def prompt_worker(q, server, worker=None):
+    if worker is not None:
+        comfy_execution.workers.set_worker(worker)
+        server = worker.server
+    e = execution.PromptExecutor(server, lru_size=args.cache_lru, parallel_workers=args.parallel_node_workers, release_intermediates=args.release_intermediates,
+                                 spill_ram_budget=int(args.cache_spill_ram * (1024 ** 3)), spill_disk_budget=int(args.cache_spill_disk * (1024 ** 3)))
     last_gc_collect = 0
     need_gc = False
     gc_collect_interval = 10.0
@@ -101,33 +133,53 @@ def prompt_worker(q, server):
         if need_gc:
             timeout = max(gc_collect_interval - (current_time - last_gc_collect), 0.0)
 
-        queue_item = q.get(timeout=timeout)
-        if queue_item is not None:
-            item, item_id = queue_item
+        if args.batch_prompts > 1:
+            queue_items = q.get_batch(execution.get_prompt_batch_key, args.batch_prompts, args.batch_wait, timeout=timeout, worker=worker)
+        else:
+            queue_items = q.get(timeout=timeout, worker=worker)
+            if queue_items is not None:
+                queue_items = [queue_items]
+
+        if queue_items is not None:
+            # The prompts that are left in the queue changed
+            comfy.model_prefetch.update()
+            if comfy.model_management.eviction_policy.use_lookahead and isinstance(q, execution.PromptQueue):
+                comfy.model_eviction.set_upcoming_files(execution.get_upcoming_model_files(q))
+
+        if queue_items is not None and len(queue_items) > 1:
+            execution_start_time = time.perf_counter()
+            server.last_prompt_id = queue_items[0][0][1]
+            runs = e.execute_batch([(item[2], item[1], item[3], item[4]) for item, item_id in queue_items])
+            need_gc = True
+            for (item, item_id), run in zip(queue_items, runs):
+                if run.client_id is not None:
+                    server.send_sync("executing", { "node": None, "prompt_id": run.prompt_id }, run.client_id)
+                execution.call_when_done(run.pending_writes, functools.partial(prompt_done, q, item_id, run.prompt_id, run.outputs_ui, run.status_messages, run.success,
+                                                                               execution_start_time, run.pending_writes, run.profile))
+            current_time = time.perf_counter()
+        elif queue_items is not None:
+            item, item_id = queue_items[0]
             execution_start_time = time.perf_counter()
             prompt_id = item[1]
             server.last_prompt_id = prompt_id
 
             e.execute(item[2], prompt_id, item[3], item[4])
             need_gc = True
-            q.task_done(item_id,
-                        e.outputs_ui,
-                        status=execution.PromptQueue.ExecutionStatus(
-                            status_str='success' if e.success else 'error',
-                            completed=e.success,
-                            messages=e.status_messages))
             if server.client_id is not None:
                 server.send_sync("executing", { "node": None, "prompt_id": prompt_id }, server.client_id)
-
+            # The next prompt can start while the images of this one are still being written,
+            # only its history entry waits for them
+            execution.call_when_done(e.pending_writes, functools.partial(prompt_done, q, item_id, prompt_id, e.outputs_ui, e.status_messages, e.success,
+                                                                         execution_start_time, e.pending_writes, e.profile))
             current_time = time.perf_counter()
-            execution_time = current_time - execution_start_time
-            logging.info("Prompt executed in {:.2f} seconds".format(execution_time))
 
-        flags = q.get_flags()
+        flags = q.get_flags(worker=worker)
         free_memory = flags.get("free_memory", False)
 
         if flags.get("unload_models", free_memory):
             comfy.model_management.unload_all_models()
+            comfy.model_cache.clear()
+            comfy.model_prefetch.clear()
             need_gc = True
             last_gc_collect = 0
 
@@ -152,13 +204,24 @@ async def run(server, address='', port=8188, verbose=True, call_on_start=None):
 def hijack_progress(server):
     def hook(value, total, preview_image):
         comfy.model_management.throw_exception_if_processing_interrupted()
-        progress = {"value": value, "max": total, "prompt_id": server.last_prompt_id, "node": server.last_node_id}
+        worker_server = comfy_execution.workers.get_server(server)
+        progress = {"value": value, "max": total, "prompt_id": worker_server.last_prompt_id, "node": worker_server.last_node_id}
 
-        server.send_sync("progress", progress, server.client_id)
+        worker_server.send_sync("progress", progress, worker_server.client_id)
         if preview_image is not None:
-            server.send_sync(BinaryEventTypes.UNENCODED_PREVIEW_IMAGE, preview_image, server.client_id)
+            worker_server.send_sync(BinaryEventTypes.UNENCODED_PREVIEW_IMAGE, preview_image, worker_server.client_id)
     comfy.utils.set_progress_bar_global_hook(hook)
 
+    def preview_hook():
+        # The previews are sent after the sampler moved on, they go where it was started
+        worker_server = comfy_execution.workers.get_server(server)
+        client_id = worker_server.client_id
+        prompt_id = worker_server.last_prompt_id
+        def send_preview(preview_bytes):
+            worker_server.send_sync(BinaryEventTypes.PREVIEW_IMAGE, preview_bytes, client_id, prompt_id=prompt_id)
+        return send_preview
+    comfy.utils.set_preview_global_hook(preview_hook)
+
 
 def cleanup_temp():
     temp_dir = folder_paths.get_temp_directory()
@@ -194,6 +257,12 @@ if __name__ == "__main__":
         folder_paths.set_temp_directory(temp_dir)
     cleanup_temp()
 
+    model_index_file = args.model_index_file
+    if model_index_file is None:
+        model_index_file = os.path.join(folder_paths.user_directory, "model_index.json")
+    folder_paths.set_model_index(model_index_file, args.model_index_rescan_interval)
+    comfy.model_cache.set_disk_tier(os.path.join(folder_paths.get_temp_directory(), "model_cache"), int(args.model_cache_disk * (1024 ** 3)))
+
     if args.windows_standalone_build:
         try:
             import new_updater
@@ -204,7 +273,10 @@ if __name__ == "__main__":
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     server = server.PromptServer(loop)
-    q = execution.PromptQueue(server)
+    queue_store = None
+    if args.queue_database is not None:
+        queue_store = comfy_execution.prompt_queue.SQLiteQueueStore(args.queue_database)
+    q = execution.PromptQueue(server, store=queue_store, fair_share=args.queue_fair_share)
 
     extra_model_paths_config_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "extra_model_paths.yaml")
     if os.path.isfile(extra_model_paths_config_path):
@@ -221,7 +293,41 @@ if __name__ == "__main__":
     server.add_routes()
     hijack_progress(server)
 
-    threading.Thread(target=prompt_worker, daemon=True, args=(q, server,)).start()
+    remote_worker = None
+    if args.enable_remote_workers or args.remote_worker == "loopback":
+        server.remote_workers = comfy_execution.remote.LeaseManager(q, server, lease_timeout=args.remote_worker_lease_timeout)
+        server.remote_workers.start()
+        if args.enable_remote_workers and args.remote_worker_token is None:
+            logging.warning("--enable-remote-workers without --remote-worker-token, remote workers can't connect")
+    if args.remote_worker is not None:
+        worker_id = args.remote_worker_id
+        if worker_id is None:
+            worker_id = "{}-{}".format(socket.gethostname(), os.getpid())
+        if args.remote_worker == "loopback":
+            coordinator = comfy_execution.remote.LoopbackCoordinator(server.remote_workers, worker_id)
+        else:
+            coordinator = comfy_execution.remote.HTTPCoordinator(args.remote_worker, worker_id, token=args.remote_worker_token)
+        remote_worker = comfy_execution.remote.RemoteWorker(coordinator, heartbeat_interval=args.remote_worker_lease_timeout / 4, on_interrupt=comfy.model_management.interrupt_current_processing)
+        remote_worker.start()
+        worker = comfy_execution.workers.Worker(0, comfy.model_management.get_torch_device())
+        worker.server = comfy_execution.remote.RemoteServer(server, remote_worker)
+        logging.info("Running prompts leased from {} as worker {}".format(args.remote_worker, worker_id))
+        threading.Thread(target=prompt_worker, name="remote_worker", daemon=True, args=(remote_worker, server, worker)).start()
+    elif args.enable_remote_workers and args.coordinator_only:
+        logging.info("Not executing prompts locally, waiting for remote workers")
+    elif args.worker_devices is not None:
+        workers = [comfy_execution.workers.Worker(i, device, server) for i, device in enumerate(comfy_execution.workers.parse_devices(args.worker_devices))]
+        q.set_scheduler(comfy_execution.prompt_queue.AffinityScheduler(workers, comfy_execution.workers.get_resident_models, max_wait=args.worker_affinity_wait))
+        for worker in workers:
+            logging.info("Starting {} on {}".format(worker.name, worker.device))
+            threading.Thread(target=prompt_worker, name=worker.name, daemon=True, args=(q, server, worker)).start()
+    else:
+        threading.Thread(target=prompt_worker, daemon=True, args=(q, server,)).start()
+
+    if args.prefetch_models_ram > 0 and remote_worker is None and not (args.enable_remote_workers and args.coordinator_only):
+        prefetcher = comfy.model_prefetch.ModelPrefetcher(int(args.prefetch_models_ram * (1024 ** 3)), lambda: execution.get_queued_model_files(q))
+        comfy.model_prefetch.set_prefetcher(prefetcher)
+        prefetcher.start()
 
     if args.output_directory:
         output_dir = os.path.abspath(args.output_directory)
@@ -238,6 +344,9 @@ if __name__ == "__main__":
         logging.info(f"Setting input directory to: {input_dir}")
         folder_paths.set_input_directory(input_dir)
 
+    if args.watch_input_directory:
+        comfy.file_fingerprint.watch(folder_paths.get_input_directory())
+
     if args.quick_test_for_ci:
         exit(0)
 
@@ -251,8 +360,13 @@ if __name__ == "__main__":
         call_on_start = startup_server
 
     try:
-        loop.run_until_complete(run(server, address=args.listen, port=args.port, verbose=not args.dont_print_server, call_on_start=call_on_start))
+        if remote_worker is not None and args.remote_worker != "loopback":
+            # Headless, the messages of the prompts go to the coordinator
+            loop.run_until_complete(server.publish_loop())
+        else:
+            loop.run_until_complete(run(server, address=args.listen, port=args.port, verbose=not args.dont_print_server, call_on_start=call_on_start))
     except KeyboardInterrupt:
         logging.info("\nStopped server")
 
+    image_writer.shutdown()
     cleanup_temp()
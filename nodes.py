@@ -3,7 +3,6 @@ import torch
 import os
 import sys
 import json
-import hashlib
 import traceback
 import math
 import time
@@ -24,16 +23,20 @@ import comfy.sample
 import comfy.sd
 import comfy.utils
 import comfy.controlnet
+import comfy.conds
 
 import comfy.clip_vision
 
 import comfy.model_management
+import comfy.model_cache
+import comfy.file_fingerprint
 from comfy.cli_args import args
 
 import importlib
 
 import folder_paths
 import latent_preview
+import image_writer
 import node_helpers
 
 def before_node_execution():
@@ -454,7 +457,7 @@ class LoadLatent:
     @classmethod
     def INPUT_TYPES(s):
         input_dir = folder_paths.get_input_directory()
-        files = [f for f in os.listdir(input_dir) if os.path.isfile(os.path.join(input_dir, f)) and f.endswith(".latent")]
+        files = [f for f in folder_paths.get_folder_files(input_dir) if os.path.dirname(f) == "" and f.endswith(".latent")]
         return {"required": {"latent": [sorted(files), ]}, }
 
     CATEGORY = "_for_testing"
@@ -474,10 +477,7 @@ class LoadLatent:
     @classmethod
     def IS_CHANGED(s, latent):
         image_path = folder_paths.get_annotated_filepath(latent)
-        m = hashlib.sha256()
-        with open(image_path, 'rb') as f:
-            m.update(f.read())
-        return m.digest().hex()
+        return comfy.file_fingerprint.get_fingerprint(image_path)
 
     @classmethod
     def VALIDATE_INPUTS(s, latent):
@@ -493,13 +493,15 @@ class CheckpointLoader:
                               "ckpt_name": (folder_paths.get_filename_list("checkpoints"), )}}
     RETURN_TYPES = ("MODEL", "CLIP", "VAE")
     FUNCTION = "load_checkpoint"
+    EXPENSIVE = True
 
     CATEGORY = "advanced/loaders"
 
     def load_checkpoint(self, config_name, ckpt_name):
         config_path = folder_paths.get_full_path("configs", config_name)
         ckpt_path = folder_paths.get_full_path("checkpoints", ckpt_name)
-        return comfy.sd.load_checkpoint(config_path, ckpt_path, output_vae=True, output_clip=True, embedding_directory=folder_paths.get_folder_paths("embeddings"))
+        embedding_directory = folder_paths.get_folder_paths("embeddings")
+        return comfy.model_cache.load("checkpoint_config", [config_path, ckpt_path], lambda: comfy.sd.load_checkpoint(config_path, ckpt_path, output_vae=True, output_clip=True, embedding_directory=embedding_directory), tuple(embedding_directory))
 
 class CheckpointLoaderSimple:
     @classmethod
@@ -508,27 +510,29 @@ class CheckpointLoaderSimple:
                              }}
     RETURN_TYPES = ("MODEL", "CLIP", "VAE")
     FUNCTION = "load_checkpoint"
+    EXPENSIVE = True
 
     CATEGORY = "loaders"
 
     def load_checkpoint(self, ckpt_name):
         ckpt_path = folder_paths.get_full_path("checkpoints", ckpt_name)
-        out = comfy.sd.load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, embedding_directory=folder_paths.get_folder_paths("embeddings"))
-        return out[:3]
+        embedding_directory = folder_paths.get_folder_paths("embeddings")
+        out = comfy.model_cache.load("checkpoint", [ckpt_path], lambda: comfy.sd.load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, embedding_directory=embedding_directory)[:3], tuple(embedding_directory))
+        return out
 
 class DiffusersLoader:
     @classmethod
     def INPUT_TYPES(cls):
         paths = []
         for search_path in folder_paths.get_folder_paths("diffusers"):
-            if os.path.exists(search_path):
-                for root, subdir, files in os.walk(search_path, followlinks=True):
-                    if "model_index.json" in files:
-                        paths.append(os.path.relpath(root, start=search_path))
+            for f in folder_paths.get_folder_files(search_path):
+                if os.path.basename(f) == "model_index.json":
+                    paths.append(os.path.dirname(f) or ".")
 
         return {"required": {"model_path": (paths,), }}
     RETURN_TYPES = ("MODEL", "CLIP", "VAE")
     FUNCTION = "load_checkpoint"
+    EXPENSIVE = True
 
     CATEGORY = "advanced/loaders/deprecated"
 
@@ -550,12 +554,14 @@ class unCLIPCheckpointLoader:
                              }}
     RETURN_TYPES = ("MODEL", "CLIP", "VAE", "CLIP_VISION")
     FUNCTION = "load_checkpoint"
+    EXPENSIVE = True
 
     CATEGORY = "loaders"
 
     def load_checkpoint(self, ckpt_name, output_vae=True, output_clip=True):
         ckpt_path = folder_paths.get_full_path("checkpoints", ckpt_name)
-        out = comfy.sd.load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, output_clipvision=True, embedding_directory=folder_paths.get_folder_paths("embeddings"))
+        embedding_directory = folder_paths.get_folder_paths("embeddings")
+        out = comfy.model_cache.load("checkpoint_clipvision", [ckpt_path], lambda: comfy.sd.load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, output_clipvision=True, embedding_directory=embedding_directory), tuple(embedding_directory))
         return out
 
 class CLIPSetLastLayer:
@@ -588,6 +594,7 @@ class LoraLoader:
                               }}
     RETURN_TYPES = ("MODEL", "CLIP")
     FUNCTION = "load_lora"
+    EXPENSIVE = True
 
     CATEGORY = "loaders"
 
@@ -677,17 +684,17 @@ class VAELoader:
         return {"required": { "vae_name": (s.vae_list(), )}}
     RETURN_TYPES = ("VAE",)
     FUNCTION = "load_vae"
+    EXPENSIVE = True
 
     CATEGORY = "loaders"
 
     #TODO: scale factor?
     def load_vae(self, vae_name):
         if vae_name in ["taesd", "taesdxl"]:
-            sd = self.load_taesd(vae_name)
+            vae = comfy.sd.VAE(sd=self.load_taesd(vae_name))
         else:
             vae_path = folder_paths.get_full_path("vae", vae_name)
-            sd = comfy.utils.load_torch_file(vae_path)
-        vae = comfy.sd.VAE(sd=sd)
+            vae = comfy.model_cache.load("vae", [vae_path], lambda: comfy.sd.VAE(sd=comfy.utils.load_torch_file(vae_path)))
         return (vae,)
 
 class ControlNetLoader:
@@ -697,12 +704,13 @@ class ControlNetLoader:
 
     RETURN_TYPES = ("CONTROL_NET",)
     FUNCTION = "load_controlnet"
+    EXPENSIVE = True
 
     CATEGORY = "loaders"
 
     def load_controlnet(self, control_net_name):
         controlnet_path = folder_paths.get_full_path("controlnet", control_net_name)
-        controlnet = comfy.controlnet.load_controlnet(controlnet_path)
+        controlnet = comfy.model_cache.load("controlnet", [controlnet_path], lambda: comfy.controlnet.load_controlnet(controlnet_path))
         return (controlnet,)
 
 class DiffControlNetLoader:
@@ -713,6 +721,7 @@ class DiffControlNetLoader:
 
     RETURN_TYPES = ("CONTROL_NET",)
     FUNCTION = "load_controlnet"
+    EXPENSIVE = True
 
     CATEGORY = "loaders"
 
@@ -806,12 +815,13 @@ class UNETLoader:
                              }}
     RETURN_TYPES = ("MODEL",)
     FUNCTION = "load_unet"
+    EXPENSIVE = True
 
     CATEGORY = "advanced/loaders"
 
     def load_unet(self, unet_name):
         unet_path = folder_paths.get_full_path("unet", unet_name)
-        model = comfy.sd.load_unet(unet_path)
+        model = comfy.model_cache.load("unet", [unet_path], lambda: comfy.sd.load_unet(unet_path))
         return (model,)
 
 class CLIPLoader:
@@ -822,6 +832,7 @@ class CLIPLoader:
                              }}
     RETURN_TYPES = ("CLIP",)
     FUNCTION = "load_clip"
+    EXPENSIVE = True
 
     CATEGORY = "advanced/loaders"
 
@@ -831,7 +842,8 @@ class CLIPLoader:
             clip_type = comfy.sd.CLIPType.STABLE_CASCADE
 
         clip_path = folder_paths.get_full_path("clip", clip_name)
-        clip = comfy.sd.load_clip(ckpt_paths=[clip_path], embedding_directory=folder_paths.get_folder_paths("embeddings"), clip_type=clip_type)
+        embedding_directory = folder_paths.get_folder_paths("embeddings")
+        clip = comfy.model_cache.load("clip", [clip_path], lambda: comfy.sd.load_clip(ckpt_paths=[clip_path], embedding_directory=embedding_directory, clip_type=clip_type), (clip_type.name, tuple(embedding_directory)))
         return (clip,)
 
 class DualCLIPLoader:
@@ -841,13 +853,15 @@ class DualCLIPLoader:
                              }}
     RETURN_TYPES = ("CLIP",)
     FUNCTION = "load_clip"
+    EXPENSIVE = True
 
     CATEGORY = "advanced/loaders"
 
     def load_clip(self, clip_name1, clip_name2):
         clip_path1 = folder_paths.get_full_path("clip", clip_name1)
         clip_path2 = folder_paths.get_full_path("clip", clip_name2)
-        clip = comfy.sd.load_clip(ckpt_paths=[clip_path1, clip_path2], embedding_directory=folder_paths.get_folder_paths("embeddings"))
+        embedding_directory = folder_paths.get_folder_paths("embeddings")
+        clip = comfy.model_cache.load("clip", [clip_path1, clip_path2], lambda: comfy.sd.load_clip(ckpt_paths=[clip_path1, clip_path2], embedding_directory=embedding_directory), tuple(embedding_directory))
         return (clip,)
 
 class CLIPVisionLoader:
@@ -857,6 +871,7 @@ class CLIPVisionLoader:
                              }}
     RETURN_TYPES = ("CLIP_VISION",)
     FUNCTION = "load_clip"
+    EXPENSIVE = True
 
     CATEGORY = "loaders"
 
@@ -887,6 +902,7 @@ class StyleModelLoader:
 
     RETURN_TYPES = ("STYLE_MODEL",)
     FUNCTION = "load_style_model"
+    EXPENSIVE = True
 
     CATEGORY = "loaders"
 
@@ -952,6 +968,7 @@ class GLIGENLoader:
 
     RETURN_TYPES = ("GLIGEN",)
     FUNCTION = "load_gligen"
+    EXPENSIVE = True
 
     CATEGORY = "loaders"
 
@@ -1320,6 +1337,52 @@ def common_ksampler(model, seed, steps, cfg, sampler_name, scheduler, positive,
     out["samples"] = samples
     return (out, )
 
+def conditioning_batch_key(conditioning):
+    if len(conditioning) != 1:
+        return None
+    cond, options = conditioning[0]
+    key = [tuple(cond.shape[2:]), cond.dtype]
+    for k in sorted(options):
+        v = options[k]
+        if k == "pooled_output":
+            key.append((k, None if v is None else (tuple(v.shape[1:]), v.dtype)))
+        elif v is None or isinstance(v, (int, float, str, bool)):
+            key.append((k, v))
+        else:
+            return None
+    return tuple(key)
+
+def batch_conditioning(conditionings, batch_sizes):
+    conds = [comfy.conds.CONDCrossAttn(comfy.utils.repeat_to_batch_size(c[0][0], b)) for c, b in zip(conditionings, batch_sizes)]
+    options = conditionings[0][0][1].copy()
+    if options.get("pooled_output", None) is not None:
+        options["pooled_output"] = torch.cat([comfy.utils.repeat_to_batch_size(c[0][1]["pooled_output"], b) for c, b in zip(conditionings, batch_sizes)])
+    return [[conds[0].concat(conds[1:]), options]]
+
+def common_ksampler_batch(model, seeds, steps, cfg, sampler_name, scheduler, positives, negatives, latents, denoise=1.0):
+    latent_images = []
+    noises = []
+    for seed, latent in zip(seeds, latents):
+        latent_image = comfy.sample.fix_empty_latent_channels(model, latent["samples"])
+        batch_inds = latent["batch_index"] if "batch_index" in latent else None
+        latent_images.append(latent_image)
+        noises.append(comfy.sample.prepare_noise(latent_image, seed, batch_inds))
+
+    batch_sizes = [x.shape[0] for x in latent_images]
+    positive = batch_conditioning(positives, batch_sizes)
+    negative = batch_conditioning(negatives, batch_sizes)
+
+    callback = latent_preview.prepare_callback(model, steps)
+    disable_pbar = not comfy.utils.PROGRESS_BAR_ENABLED
+    samples = comfy.sample.sample(model, torch.cat(noises), steps, cfg, sampler_name, scheduler, positive, negative, torch.cat(latent_images),
+                                  denoise=denoise, callback=callback, disable_pbar=disable_pbar, seed=seeds[0])
+    out = []
+    for latent, s in zip(latents, torch.split(samples, batch_sizes)):
+        o = latent.copy()
+        o["samples"] = s
+        out.append((o, ))
+    return out
+
 class KSampler:
     @classmethod
     def INPUT_TYPES(s):
@@ -1339,12 +1402,46 @@ class KSampler:
 
     RETURN_TYPES = ("LATENT",)
     FUNCTION = "sample"
+    EXPENSIVE = True
+    BATCH_FUNCTION = "sample_batch"
 
     CATEGORY = "sampling"
 
     def sample(self, model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=1.0):
         return common_ksampler(model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=denoise)
 
+    # Samplers that give every image of a batch the same result as sampling it alone. The ones
+    # adding noise during sampling or, like dpm_adaptive, picking steps from the error of the
+    # whole batch don't, new samplers are only batched once they are known to be safe.
+    BATCH_SAMPLERS = frozenset(["euler", "heun", "heunpp2", "dpm_2", "lms", "dpm_fast", "dpmpp_2m", "ddim", "uni_pc", "uni_pc_bh2"])
+
+    def sample_batch(self, requests):
+        groups = {}
+        for i, r in enumerate(requests):
+            key = None
+            if r["sampler_name"] in self.BATCH_SAMPLERS and "noise_mask" not in r["latent_image"]:
+                positive = conditioning_batch_key(r["positive"])
+                negative = conditioning_batch_key(r["negative"])
+                samples = r["latent_image"]["samples"]
+                if positive is not None and negative is not None:
+                    key = (id(r["model"]), r["steps"], r["cfg"], r["sampler_name"], r["scheduler"], r.get("denoise", 1.0), tuple(samples.shape[1:]), samples.dtype, positive, negative)
+            if key is None:
+                key = ("single", i)
+            groups.setdefault(key, []).append(i)
+
+        out = [None] * len(requests)
+        for indexes in groups.values():
+            group = [requests[i] for i in indexes]
+            if len(group) == 1:
+                results = [self.sample(**group[0])]
+            else:
+                first = group[0]
+                results = common_ksampler_batch(first["model"], [r["seed"] for r in group], first["steps"], first["cfg"], first["sampler_name"], first["scheduler"],
+                                                [r["positive"] for r in group], [r["negative"] for r in group], [r["latent_image"] for r in group], denoise=first.get("denoise", 1.0))
+            for i, r in zip(indexes, results):
+                out[i] = r
+        return out
+
 class KSamplerAdvanced:
     @classmethod
     def INPUT_TYPES(s):
@@ -1367,6 +1464,7 @@ class KSamplerAdvanced:
 
     RETURN_TYPES = ("LATENT",)
     FUNCTION = "sample"
+    EXPENSIVE = True
 
     CATEGORY = "sampling"
 
@@ -1396,6 +1494,7 @@ class SaveImage:
 
     RETURN_TYPES = ()
     FUNCTION = "save_images"
+    THREAD_SAFE = True
 
     OUTPUT_NODE = True
 
@@ -1404,22 +1503,23 @@ class SaveImage:
     def save_images(self, images, filename_prefix="ComfyUI", prompt=None, extra_pnginfo=None):
         filename_prefix += self.prefix_append
         full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, self.output_dir, images[0].shape[1], images[0].shape[0])
+        counter = image_writer.reserve_counter(full_output_folder, filename, counter, len(images))
+        metadata = None
+        if not args.disable_metadata:
+            metadata = PngInfo()
+            if prompt is not None:
+                metadata.add_text("prompt", json.dumps(prompt))
+            if extra_pnginfo is not None:
+                for x in extra_pnginfo:
+                    metadata.add_text(x, json.dumps(extra_pnginfo[x]))
+
+        writer = image_writer.get_writer()
         results = list()
+        pending = list()
         for (batch_number, image) in enumerate(images):
-            i = 255. * image.cpu().numpy()
-            img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
-            metadata = None
-            if not args.disable_metadata:
-                metadata = PngInfo()
-                if prompt is not None:
-                    metadata.add_text("prompt", json.dumps(prompt))
-                if extra_pnginfo is not None:
-                    for x in extra_pnginfo:
-                        metadata.add_text(x, json.dumps(extra_pnginfo[x]))
-
             filename_with_batch_num = filename.replace("%batch_num%", str(batch_number))
             file = f"{filename_with_batch_num}_{counter:05}_.png"
-            img.save(os.path.join(full_output_folder, file), pnginfo=metadata, compress_level=self.compress_level)
+            pending.append(writer.save_png(image, os.path.join(full_output_folder, file), metadata, self.compress_level))
             results.append({
                 "filename": file,
                 "subfolder": subfolder,
@@ -1427,7 +1527,8 @@ class SaveImage:
             })
             counter += 1
 
-        return { "ui": { "images": results } }
+        image_writer.release_counter(full_output_folder, filename, pending)
+        return { "ui": { "images": results }, "pending": pending }
 
 class PreviewImage(SaveImage):
     def __init__(self):
@@ -1447,7 +1548,7 @@ class LoadImage:
     @classmethod
     def INPUT_TYPES(s):
         input_dir = folder_paths.get_input_directory()
-        files = [f for f in os.listdir(input_dir) if os.path.isfile(os.path.join(input_dir, f))]
+        files = [f for f in folder_paths.get_folder_files(input_dir) if os.path.dirname(f) == ""]
         return {"required":
                     {"image": (sorted(files), {"image_upload": True})},
                 }
@@ -1456,6 +1557,7 @@ class LoadImage:
 
     RETURN_TYPES = ("IMAGE", "MASK")
     FUNCTION = "load_image"
+    THREAD_SAFE = True
     def load_image(self, image):
         image_path = folder_paths.get_annotated_filepath(image)
         
@@ -1503,10 +1605,7 @@ class LoadImage:
     @classmethod
     def IS_CHANGED(s, image):
         image_path = folder_paths.get_annotated_filepath(image)
-        m = hashlib.sha256()
-        with open(image_path, 'rb') as f:
-            m.update(f.read())
-        return m.digest().hex()
+        return comfy.file_fingerprint.get_fingerprint(image_path)
 
     @classmethod
     def VALIDATE_INPUTS(s, image):
@@ -1520,7 +1619,7 @@ class LoadImageMask:
     @classmethod
     def INPUT_TYPES(s):
         input_dir = folder_paths.get_input_directory()
-        files = [f for f in os.listdir(input_dir) if os.path.isfile(os.path.join(input_dir, f))]
+        files = [f for f in folder_paths.get_folder_files(input_dir) if os.path.dirname(f) == ""]
         return {"required":
                     {"image": (sorted(files), {"image_upload": True}),
                      "channel": (s._color_channels, ), }
@@ -1530,6 +1629,7 @@ class LoadImageMask:
 
     RETURN_TYPES = ("MASK",)
     FUNCTION = "load_image"
+    THREAD_SAFE = True
     def load_image(self, image, channel):
         image_path = folder_paths.get_annotated_filepath(image)
         i = node_helpers.pillow(Image.open, image_path)
@@ -1552,10 +1652,7 @@ class LoadImageMask:
     @classmethod
     def IS_CHANGED(s, image, channel):
         image_path = folder_paths.get_annotated_filepath(image)
-        m = hashlib.sha256()
-        with open(image_path, 'rb') as f:
-            m.update(f.read())
-        return m.digest().hex()
+        return comfy.file_fingerprint.get_fingerprint(image_path)
 
     @classmethod
     def VALIDATE_INPUTS(s, image):
@@ -1576,6 +1673,7 @@ class ImageScale:
                               "crop": (s.crop_methods,)}}
     RETURN_TYPES = ("IMAGE",)
     FUNCTION = "upscale"
+    THREAD_SAFE = True
 
     CATEGORY = "image/upscaling"
 
@@ -1603,6 +1701,7 @@ class ImageScaleBy:
                               "scale_by": ("FLOAT", {"default": 1.0, "min": 0.01, "max": 8.0, "step": 0.01}),}}
     RETURN_TYPES = ("IMAGE",)
     FUNCTION = "upscale"
+    THREAD_SAFE = True
 
     CATEGORY = "image/upscaling"
 
@@ -1622,6 +1721,7 @@ class ImageInvert:
 
     RETURN_TYPES = ("IMAGE",)
     FUNCTION = "invert"
+    THREAD_SAFE = True
 
     CATEGORY = "image"
 
@@ -1637,6 +1737,7 @@ class ImageBatch:
 
     RETURN_TYPES = ("IMAGE",)
     FUNCTION = "batch"
+    THREAD_SAFE = True
 
     CATEGORY = "image"
 
@@ -1659,6 +1760,7 @@ class EmptyImage:
                               }}
     RETURN_TYPES = ("IMAGE",)
     FUNCTION = "generate"
+    THREAD_SAFE = True
 
     CATEGORY = "image"
 
@@ -1685,6 +1787,7 @@ class ImagePadForOutpaint:
 
     RETURN_TYPES = ("IMAGE", "MASK")
     FUNCTION = "expand_image"
+    THREAD_SAFE = True
 
     CATEGORY = "image"
 
@@ -1,11 +1,15 @@
 import os
 import sys
 import asyncio
+import math
+import concurrent.futures
 import traceback
 
 import nodes
 import folder_paths
 import execution
+import comfy_execution.profiler
+import comfy_execution.remote
 import uuid
 import urllib
 import json
@@ -24,8 +28,12 @@ import mimetypes
 from comfy.cli_args import args
 import comfy.utils
 import comfy.model_management
+import comfy.model_cache
+import comfy.model_prefetch
+import comfy.file_fingerprint
 
 from app.user_manager import UserManager
+from app.object_info import ObjectInfoCache
 
 class BinaryEventTypes:
     PREVIEW_IMAGE = 1
@@ -37,6 +45,18 @@ async def send_socket_catch_exception(function, message):
     except (aiohttp.ClientError, aiohttp.ClientPayloadError, ConnectionResetError) as err:
         logging.warning("send error: {}".format(err))
 
+def parse_priority(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, (int, str)):
+        try:
+            return int(value)
+        except ValueError:
+            return None
+    return None
+
 @web.middleware
 async def cache_control(request: web.Request, handler):
     response: web.Response = await handler(request)
@@ -61,6 +81,25 @@ def create_cors_middleware(allowed_origin: str):
 
     return cors_middleware
 
+def create_remote_worker_middleware(token):
+    @web.middleware
+    async def remote_worker_middleware(request: web.Request, handler):
+        # Checked before the handlers read the body so unknown clients can't upload anything
+        if request.path.startswith("/worker/") and not comfy_execution.remote.check_token(token, request.headers.get(comfy_execution.remote.TOKEN_HEADER, None)):
+            return web.json_response({"error": "invalid remote worker token"}, status=403)
+        return await handler(request)
+
+    return remote_worker_middleware
+
+MAX_LEASE_WAIT = 30.0
+
+def get_model_stats():
+    return {
+        "model_cache": comfy.model_cache.get_stats(),
+        "model_prefetch": comfy.model_prefetch.get_stats(),
+        "model_eviction": comfy.model_management.get_eviction_stats(),
+    }
+
 class PromptServer():
     def __init__(self, loop):
         PromptServer.instance = self
@@ -69,13 +108,18 @@ class PromptServer():
         mimetypes.types_map['.js'] = 'application/javascript; charset=utf-8'
 
         self.user_manager = UserManager()
+        self.object_info = ObjectInfoCache()
+        # Validation runs off the event loop so big prompts don't stall the other clients
+        self.validation_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="prompt_validation")
+        # Lease long-polls block a thread for up to MAX_LEASE_WAIT, keep them off the default executor
+        self.lease_executor = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="worker_lease")
         self.supports = ["custom_nodes_from_web"]
         self.prompt_queue = None
         self.loop = loop
         self.messages = asyncio.Queue()
         self.number = 0
 
-        middlewares = [cache_control]
+        middlewares = [cache_control, create_remote_worker_middleware(args.remote_worker_token)]
         if args.enable_cors_header:
             middlewares.append(create_cors_middleware(args.enable_cors_header))
 
@@ -87,7 +131,9 @@ class PromptServer():
         routes = web.RouteTableDef()
         self.routes = routes
         self.last_node_id = None
+        self.last_prompt_id = None
         self.client_id = None
+        self.remote_workers = None
 
         self.on_prompt_handlers = []
 
@@ -192,6 +238,8 @@ class PromptServer():
                 else:
                     with open(filepath, "wb") as f:
                         f.write(image.file.read())
+                comfy.file_fingerprint.invalidate(filepath)
+                folder_paths.mark_folder_changed(filepath)
 
                 return web.json_response({"name" : filename, "subfolder": subfolder, "type": image_upload_type})
             else:
@@ -379,65 +427,76 @@ class PromptServer():
                         "torch_vram_total": torch_vram_total,
                         "torch_vram_free": torch_vram_free,
                     }
-                ]
+                ],
+                "file_fingerprints": comfy.file_fingerprint.file_fingerprints.get_stats(),
             }
+            # These take the locks of the model cache and the prefetcher, keep the event loop out of them
+            system_stats.update(await self.loop.run_in_executor(None, get_model_stats))
             return web.json_response(system_stats)
 
         @routes.get("/prompt")
         async def get_prompt(request):
             return web.json_response(self.get_queue_info())
 
-        def node_info(node_class):
-            obj_class = nodes.NODE_CLASS_MAPPINGS[node_class]
-            info = {}
-            info['input'] = obj_class.INPUT_TYPES()
-            info['output'] = obj_class.RETURN_TYPES
-            info['output_is_list'] = obj_class.OUTPUT_IS_LIST if hasattr(obj_class, 'OUTPUT_IS_LIST') else [False] * len(obj_class.RETURN_TYPES)
-            info['output_name'] = obj_class.RETURN_NAMES if hasattr(obj_class, 'RETURN_NAMES') else info['output']
-            info['name'] = node_class
-            info['display_name'] = nodes.NODE_DISPLAY_NAME_MAPPINGS[node_class] if node_class in nodes.NODE_DISPLAY_NAME_MAPPINGS.keys() else node_class
-            info['description'] = obj_class.DESCRIPTION if hasattr(obj_class,'DESCRIPTION') else ''
-            info['category'] = 'sd'
-            if hasattr(obj_class, 'OUTPUT_NODE') and obj_class.OUTPUT_NODE == True:
-                info['output_node'] = True
-            else:
-                info['output_node'] = False
-
-            if hasattr(obj_class, 'CATEGORY'):
-                info['category'] = obj_class.CATEGORY
-            return info
-
+        # The info of the nodes is cached and only generated again when the folders their
+        # INPUT_TYPES listed through folder_paths changed. Custom nodes that read the disk
+        # some other way keep their old lists until a request with refresh=true.
+        # Checking the folders stats the disk so it runs off the event loop.
         @routes.get("/object_info")
         async def get_object_info(request):
-            out = {}
-            for x in nodes.NODE_CLASS_MAPPINGS:
-                try:
-                    out[x] = node_info(x)
-                except Exception as e:
-                    logging.error(f"[ERROR] An error occurred while retrieving information for the '{x}' node.")
-                    logging.error(traceback.format_exc())
-            return web.json_response(out)
+            query = request.rel_url.query
+            refresh = query.get("refresh", "false").lower() in ("1", "true")
+            if refresh:
+                execution.validation_cache.clear()
+            await self.loop.run_in_executor(None, self.object_info.update, refresh)
+            etag = self.object_info.get_etag()
+            if "since" in query:
+                return web.json_response(self.object_info.get_delta(query["since"]), headers={"ETag": etag})
+            if request.headers.get("If-None-Match", None) == etag:
+                return web.Response(status=304, headers={"ETag": etag})
+            body = await self.loop.run_in_executor(None, self.object_info.get_body)
+            return web.Response(body=body, content_type="application/json", headers={"ETag": etag})
 
         @routes.get("/object_info/{node_class}")
         async def get_object_info_node(request):
             node_class = request.match_info.get("node_class", None)
             out = {}
             if (node_class is not None) and (node_class in nodes.NODE_CLASS_MAPPINGS):
-                out[node_class] = node_info(node_class)
+                await self.loop.run_in_executor(None, self.object_info.update)
+                info = self.object_info.get_node(node_class)
+                if info is not None:
+                    out[node_class] = info
             return web.json_response(out)
 
         @routes.get("/history")
         async def get_history(request):
-            max_items = request.rel_url.query.get("max_items", None)
+            query = request.rel_url.query
+            max_items = query.get("max_items", None)
             if max_items is not None:
                 max_items = int(max_items)
-            return web.json_response(self.prompt_queue.get_history(max_items=max_items))
+            offset = int(query.get("offset", -1))
+            filters = {k: query[k] for k in ("status", "client_id", "node_type") if k in query}
+            summary = query.get("summary", "false").lower() in ("1", "true")
+            try:
+                history = self.prompt_queue.get_history(max_items=max_items, offset=offset, before=query.get("before", None), filters=filters, summary=summary)
+            except (KeyError, ValueError) as e:
+                return web.json_response({"error": "invalid history query: {}".format(e)}, status=400)
+            return web.json_response(history)
 
         @routes.get("/history/{prompt_id}")
         async def get_history(request):
             prompt_id = request.match_info.get("prompt_id", None)
             return web.json_response(self.prompt_queue.get_history(prompt_id=prompt_id))
 
+        @routes.get("/history/{prompt_id}/trace")
+        async def get_history_trace(request):
+            prompt_id = request.match_info.get("prompt_id", None)
+            history = self.prompt_queue.get_history(prompt_id=prompt_id)
+            if prompt_id not in history or history[prompt_id].get("profile") is None:
+                return web.Response(status=404)
+            return web.json_response(comfy_execution.profiler.to_chrome_trace(prompt_id, history[prompt_id]["profile"]),
+                                     headers={"Content-Disposition": "attachment; filename=\"{}.trace.json\"".format(prompt_id)})
+
         @routes.get("/queue")
         async def get_queue(request):
             queue_info = {}
@@ -454,6 +513,18 @@ class PromptServer():
             json_data =  await request.json()
             json_data = self.trigger_on_prompt(json_data)
 
+            priority = None
+            if "priority" in json_data:
+                priority = parse_priority(json_data["priority"])
+                if priority is None:
+                    error = {
+                        "type": "invalid_priority",
+                        "message": "Priority must be an integer",
+                        "details": repr(json_data["priority"]),
+                        "extra_info": {}
+                    }
+                    return web.json_response({"error": error, "node_errors": []}, status=400)
+
             if "number" in json_data:
                 number = float(json_data['number'])
             else:
@@ -466,13 +537,15 @@ class PromptServer():
 
             if "prompt" in json_data:
                 prompt = json_data["prompt"]
-                valid = execution.validate_prompt(prompt)
+                valid = await self.loop.run_in_executor(self.validation_executor, execution.validate_prompt, prompt)
                 extra_data = {}
                 if "extra_data" in json_data:
                     extra_data = json_data["extra_data"]
 
                 if "client_id" in json_data:
                     extra_data["client_id"] = json_data["client_id"]
+                if priority is not None:
+                    extra_data["priority"] = priority
                 if valid[0]:
                     prompt_id = str(uuid.uuid4())
                     outputs_to_execute = valid[2]
@@ -502,8 +575,71 @@ class PromptServer():
         @routes.post("/interrupt")
         async def post_interrupt(request):
             nodes.interrupt_processing()
+            if self.remote_workers is not None:
+                self.remote_workers.interrupt()
             return web.Response(status=200)
 
+        async def remote_worker_call(request, name, *args, executor=None):
+            if self.remote_workers is None:
+                return web.Response(status=404)
+            function = getattr(self.remote_workers, name)
+            worker_id = request.rel_url.query.get("worker_id", None)
+            if worker_id is None:
+                return web.json_response({"error": "no worker_id"}, status=400)
+            try:
+                out = await self.loop.run_in_executor(executor, function, worker_id, *args)
+            except comfy_execution.remote.LeaseLost as e:
+                return web.json_response({"error": "lease lost: {}".format(e)}, status=409)
+            except ValueError as e:
+                return web.json_response({"error": str(e)}, status=400)
+            if out is None:
+                return web.Response(status=204)
+            return web.json_response(out)
+
+        @routes.post("/worker/lease")
+        async def post_worker_lease(request):
+            json_data = await request.json()
+            try:
+                wait = float(json_data.get("wait", 0.0))
+            except (TypeError, ValueError):
+                wait = math.nan
+            if math.isnan(wait):
+                return web.json_response({"error": "wait must be a number"}, status=400)
+            wait = min(max(wait, 0.0), MAX_LEASE_WAIT)
+            response = await remote_worker_call(request, "lease", wait, executor=self.lease_executor)
+            if response.status == 200 and (request.transport is None or request.transport.is_closing()):
+                # The worker went away while waiting, don't wait for the lease to time out
+                self.remote_workers.release(request.rel_url.query["worker_id"], json.loads(response.body)["prompt_id"])
+                return web.Response(status=204)
+            return response
+
+        @routes.post("/worker/heartbeat")
+        async def post_worker_heartbeat(request):
+            json_data = await request.json()
+            return await remote_worker_call(request, "heartbeat", json_data.get("prompt_ids", []))
+
+        @routes.post("/worker/events")
+        async def post_worker_events(request):
+            json_data = await request.json()
+            return await remote_worker_call(request, "send_events", json_data["prompt_id"], json_data["events"])
+
+        @routes.post("/worker/upload")
+        async def post_worker_upload(request):
+            query = request.rel_url.query
+            data = await request.read()
+            return await remote_worker_call(request, "store_file", query["prompt_id"], query["type"], query.get("subfolder", ""), query["filename"], data)
+
+        @routes.post("/worker/complete")
+        async def post_worker_complete(request):
+            json_data = await request.json()
+            return await remote_worker_call(request, "complete", json_data["prompt_id"], json_data["outputs"], json_data["status"], json_data.get("profile", None))
+
+        @routes.get("/worker/status")
+        async def get_worker_status(request):
+            if self.remote_workers is None:
+                return web.Response(status=404)
+            return web.json_response(self.remote_workers.get_stats())
+
         @routes.post("/free")
         async def post_free(request):
             json_data = await request.json()
@@ -609,7 +745,8 @@ class PromptServer():
         elif sid in self.sockets:
             await send_socket_catch_exception(self.sockets[sid].send_json, message)
 
-    def send_sync(self, event, data, sid=None):
+    def send_sync(self, event, data, sid=None, prompt_id=None):
+        # prompt_id is only used by the remote workers, the messages go to clients here
         self.loop.call_soon_threadsafe(
             self.messages.put_nowait, (event, data, sid))
 
@@ -0,0 +1,44 @@
+"""
+Microbenchmark for the execution planner on synthetic graphs.
+
+    python -m tests.execution.benchmark_graph
+"""
+import random
+import time
+
+from comfy_execution.graph import ExecutionList
+
+def chain_prompt(size):
+    prompt = {"0": {"class_type": "Test", "inputs": {}}}
+    for i in range(1, size):
+        prompt[str(i)] = {"class_type": "Test", "inputs": {"x": [str(i - 1), 0]}}
+    return prompt, [str(size - 1)]
+
+def random_dag_prompt(size, outputs=16, seed=0):
+    rng = random.Random(seed)
+    prompt = {}
+    for i in range(size):
+        inputs = {}
+        if i > 0:
+            for j in range(rng.randint(1, 3)):
+                inputs["x{}".format(j)] = [str(rng.randrange(max(0, i - 50), i)), 0]
+        prompt[str(i)] = {"class_type": "Test", "inputs": inputs}
+    return prompt, [str(size - 1 - i) for i in range(outputs)]
+
+def run(prompt, outputs):
+    start = time.perf_counter()
+    execution_list = ExecutionList(prompt, {})
+    execution_list.add_outputs(outputs)
+    count = 0
+    while not execution_list.is_empty():
+        node_id = execution_list.stage_node_execution()
+        execution_list.complete_node_execution(node_id)
+        count += 1
+    return time.perf_counter() - start, count
+
+if __name__ == "__main__":
+    for name, builder in [("chain", chain_prompt), ("random dag", random_dag_prompt)]:
+        for size in [1000, 2000, 5000, 10000]:
+            prompt, outputs = builder(size)
+            elapsed, count = run(prompt, outputs)
+            print("{:>10} {:>6} nodes: {:8.2f} ms ({:.2f} us/node, {} executed)".format(name, size, elapsed * 1000, elapsed * 1e6 / size, count))
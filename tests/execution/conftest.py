@@ -0,0 +1,4 @@
+from comfy.cli_args import args
+
+# The tests that import nodes don't need a GPU
+args.cpu = True
@@ -0,0 +1,114 @@
+import pytest
+
+import nodes
+import execution
+from comfy_execution.caching import LRUCache, CacheKeySetInputSignature
+
+class FakeServer:
+    def __init__(self):
+        self.client_id = None
+        self.last_node_id = None
+
+    def send_sync(self, event, data, sid=None, prompt_id=None):
+        pass
+
+class TValue:
+    calls = []
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"value": ("INT", {"default": 0})}, "optional": {"a": ("INT",), "b": ("INT",)}}
+    RETURN_TYPES = ("INT",)
+    FUNCTION = "run"
+
+    def run(self, value, a=None, b=None):
+        TValue.calls.append(value)
+        return (value + (a or 0) + (b or 0),)
+
+class TExpensive(TValue):
+    EXPENSIVE = True
+
+class TSwitch:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"select": ("BOOLEAN", {"default": True}), "on_true": ("INT", {"lazy": True}), "on_false": ("INT", {"lazy": True})}}
+    RETURN_TYPES = ("INT",)
+    FUNCTION = "run"
+
+    def check_lazy_status(self, select, on_true=None, on_false=None):
+        return ["on_true"] if select else ["on_false"]
+
+    def run(self, select, on_true=None, on_false=None):
+        return (on_true if select else on_false,)
+
+class TOut:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"x": ("INT",)}}
+    RETURN_TYPES = ()
+    OUTPUT_NODE = True
+    FUNCTION = "run"
+
+    def run(self, x):
+        return {"ui": {"x": [x]}}
+
+def value(v, a=None, b=None, class_type="TValue"):
+    inputs = {"value": v}
+    if a is not None:
+        inputs["a"] = [a, 0]
+    if b is not None:
+        inputs["b"] = [b, 0]
+    return {"class_type": class_type, "inputs": inputs}
+
+@pytest.fixture
+def executor(monkeypatch):
+    for x in (TValue, TExpensive, TSwitch, TOut):
+        monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, x.__name__, x)
+    TValue.calls = []
+    return execution.PromptExecutor(FakeServer(), release_intermediates=True)
+
+def test_shared_key(executor):
+    # 4 and 5 are the same node so they share a cache key, 5 is read after 4's only consumer ran
+    prompt = {"1": value(1, class_type="TExpensive"), "2": value(2, "1"), "3": value(3, "1"), "4": value(4, "2"), "5": value(4, "2"),
+              "6": value(0, "4"), "7": value(0, "6", "5"), "8": value(0, "7", "3"), "9": {"class_type": "TOut", "inputs": {"x": ["8", 0]}}}
+    executor.execute(prompt, "p0", {}, ["9"])
+    assert executor.success
+    assert executor.outputs_ui["9"] == {"x": [18]}
+    assert sorted(TValue.calls) == [0, 0, 0, 1, 2, 3, 4]
+    # Only the expensive node and the output are left
+    assert sorted(executor.caches.outputs.cached_node_ids()) == ["1", "9"]
+
+    TValue.calls = []
+    executor.execute(prompt, "p1", {}, ["9"])
+    assert executor.outputs_ui["9"] == {"x": [18]}
+    assert 1 not in TValue.calls
+
+def test_lazy_input_not_requested(executor):
+    prompt = {"1": value(1), "2": value(10, "1"), "3": value(100), "4": value(1000, "3"),
+              "5": {"class_type": "TSwitch", "inputs": {"select": True, "on_true": ["2", 0], "on_false": ["4", 0]}},
+              "6": {"class_type": "TOut", "inputs": {"x": ["5", 0]}}}
+    executor.execute(prompt, "p0", {}, ["6"])
+    assert executor.success
+    assert executor.outputs_ui["6"] == {"x": [11]}
+    assert sorted(TValue.calls) == [1, 10]
+    assert sorted(executor.caches.outputs.cached_node_ids()) == ["6"]
+
+    prompt["5"]["inputs"]["select"] = False
+    executor.execute(prompt, "p1", {}, ["6"])
+    assert executor.success
+    assert executor.outputs_ui["6"] == {"x": [1100]}
+
+def test_volatile_keys_dropped(executor):
+    cache = LRUCache(CacheKeySetInputSignature, max_size=2)
+    volatile = {"1": value(1), "2": value(2)}
+    other = {"3": value(3)}
+    is_changed = {"2": float("nan")}
+    for i, prompt in enumerate((other, volatile, other, volatile)):
+        cache.set_prompt(prompt, prompt.keys(), is_changed)
+        cache.clean_unused()
+        # The result of the volatile node can't be hit again so it's the one dropped
+        if i >= 2:
+            assert cache.get(next(iter(prompt))) is not None
+        for node_id in prompt:
+            cache.set(node_id, [node_id])
+    assert len(cache) == 3
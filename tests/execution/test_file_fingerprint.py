@@ -0,0 +1,43 @@
+import os
+import hashlib
+
+from comfy.file_fingerprint import FileFingerprints, RACY_NS
+
+def write(path, data, age=10):
+    with open(path, "wb") as f:
+        f.write(data)
+    mtime = os.stat(path).st_mtime_ns - age * RACY_NS
+    os.utime(path, ns=(mtime, mtime))
+
+def test_fingerprint_cached(tmp_path):
+    path = str(tmp_path / "a.png")
+    write(path, b"first")
+    fingerprints = FileFingerprints()
+    assert fingerprints.get(path) == hashlib.sha256(b"first").hexdigest()
+    assert fingerprints.get(path) == hashlib.sha256(b"first").hexdigest()
+    assert (fingerprints.hits, fingerprints.misses) == (1, 1)
+
+    write(path, b"second", age=5)
+    assert fingerprints.get(path) == hashlib.sha256(b"second").hexdigest()
+    assert fingerprints.misses == 2
+
+def test_fingerprint_racy(tmp_path):
+    # A file modified right before it was hashed is hashed again next time
+    path = str(tmp_path / "a.png")
+    write(path, b"first", age=0)
+    fingerprints = FileFingerprints()
+    fingerprints.get(path)
+    fingerprints.get(path)
+    assert fingerprints.misses == 2
+
+def test_fingerprint_invalidate(tmp_path):
+    path = str(tmp_path / "a.png")
+    write(path, b"first")
+    fingerprints = FileFingerprints(max_entries=1)
+    fingerprints.get(path)
+    fingerprints.invalidate(path)
+    fingerprints.get(path)
+    assert fingerprints.misses == 2
+    write(str(tmp_path / "b.png"), b"other")
+    fingerprints.get(str(tmp_path / "b.png"))
+    assert list(fingerprints.entries.keys()) == [str(tmp_path / "b.png")]
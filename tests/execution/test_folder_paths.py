@@ -0,0 +1,58 @@
+import os
+import json
+
+import folder_paths
+
+def touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"0")
+
+def set_folder(monkeypatch, tmp_path, index_file=None):
+    monkeypatch.setattr(folder_paths, "folder_indexes", {})
+    monkeypatch.setattr(folder_paths, "filename_list_cache", {})
+    monkeypatch.setattr(folder_paths, "model_index_file", None)
+    monkeypatch.setattr(folder_paths, "model_index_rescan_interval", 1.0)
+    monkeypatch.setitem(folder_paths.folder_names_and_paths, "test_models", ([str(tmp_path / "a"), str(tmp_path / "b")], {".safetensors"}))
+    folder_paths.set_model_index(index_file, 0.0)
+
+def test_model_index(monkeypatch, tmp_path):
+    touch(str(tmp_path / "a" / "x.safetensors"))
+    touch(str(tmp_path / "a" / "sub" / "y.safetensors"))
+    touch(str(tmp_path / "a" / ".git" / "z.safetensors"))
+    touch(str(tmp_path / "b" / "x.safetensors"))
+    touch(str(tmp_path / "b" / "notes.txt"))
+    set_folder(monkeypatch, tmp_path)
+    assert folder_paths.get_filename_list("test_models") == [os.path.join("sub", "y.safetensors"), "x.safetensors"]
+    assert folder_paths.get_full_path("test_models", "x.safetensors") == str(tmp_path / "a" / "x.safetensors")
+    assert folder_paths.get_full_path("test_models", "notes.txt") == str(tmp_path / "b" / "notes.txt")
+    assert folder_paths.get_full_path("test_models", "missing.safetensors") is None
+
+    touch(str(tmp_path / "b" / "sub2" / "deep" / "w.safetensors"))
+    os.remove(str(tmp_path / "a" / "sub" / "y.safetensors"))
+    os.rmdir(str(tmp_path / "a" / "sub"))
+    assert folder_paths.get_filename_list("test_models") == [os.path.join("sub2", "deep", "w.safetensors"), "x.safetensors"]
+    assert os.path.join("sub", "y.safetensors") not in folder_paths.folder_indexes[str(tmp_path / "a")].get_files()
+
+def test_model_index_file(monkeypatch, tmp_path):
+    touch(str(tmp_path / "a" / "sub" / "x.safetensors"))
+    index_file = str(tmp_path / "index.json")
+    set_folder(monkeypatch, tmp_path, index_file)
+    assert folder_paths.get_filename_list("test_models") == [os.path.join("sub", "x.safetensors")]
+
+    set_folder(monkeypatch, tmp_path, index_file)
+    index = folder_paths.folder_indexes[str(tmp_path / "a")]
+    assert index.refresh() == False
+    touch(str(tmp_path / "a" / "sub" / "y.safetensors"))
+    assert folder_paths.get_filename_list("test_models") == [os.path.join("sub", "x.safetensors"), os.path.join("sub", "y.safetensors")]
+
+def test_model_index_file_skips_input(monkeypatch, tmp_path):
+    touch(str(tmp_path / "a" / "x.safetensors"))
+    touch(str(tmp_path / "input" / "image.png"))
+    index_file = str(tmp_path / "index.json")
+    set_folder(monkeypatch, tmp_path, index_file)
+    assert folder_paths.get_folder_files(str(tmp_path / "input")) == ["image.png"]
+    assert not os.path.exists(index_file)
+    folder_paths.get_filename_list("test_models")
+    with open(index_file) as f:
+        assert sorted(json.load(f)["folders"].keys()) == [str(tmp_path / "a")]
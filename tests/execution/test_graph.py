@@ -0,0 +1,128 @@
+import random
+import sys
+
+import pytest
+
+from comfy_execution.graph import ExecutionList, DependencyCycleError
+
+def make_node(*links, value=0):
+    inputs = {"value": value}
+    for i, link in enumerate(links):
+        inputs["input_{}".format(i)] = [link, 0]
+    return {"class_type": "Test", "inputs": inputs}
+
+def random_prompt(seed, size=60):
+    rng = random.Random(seed)
+    prompt = {}
+    for i in range(size):
+        links = [str(rng.randrange(i)) for _ in range(rng.randint(0, 3))] if i > 0 else []
+        prompt[str(i)] = make_node(*links, value=i)
+    outputs = rng.sample(sorted(prompt.keys()), 4)
+    return prompt, outputs
+
+def recursive_order(prompt, outputs, cached):
+    # Reference implementation of the order the old recursive executor used
+    executed = []
+    done = set(cached)
+
+    def will_execute(node_id, seen):
+        if node_id in done or node_id in seen:
+            return
+        seen.add(node_id)
+        for input_data in prompt[node_id]["inputs"].values():
+            if isinstance(input_data, list):
+                will_execute(input_data[0], seen)
+
+    def run(node_id):
+        if node_id in done:
+            return
+        for input_data in prompt[node_id]["inputs"].values():
+            if isinstance(input_data, list) and input_data[0] not in done:
+                run(input_data[0])
+        done.add(node_id)
+        executed.append(node_id)
+
+    to_execute = list(outputs)
+    while len(to_execute) > 0:
+        counts = []
+        for o in to_execute:
+            seen = set()
+            will_execute(o, seen)
+            counts.append((len(seen), o))
+        to_execute = [x[1] for x in sorted(counts)]
+        run(to_execute.pop(0))
+    return executed
+
+def run_execution_list(prompt, outputs, cached):
+    cache = {x: [[None]] for x in cached}
+    execution_list = ExecutionList(prompt, cache)
+    execution_list.add_outputs(outputs)
+    order = []
+    while not execution_list.is_empty():
+        node_id = execution_list.stage_node_execution()
+        order.append(node_id)
+        execution_list.complete_node_execution(node_id)
+    return order
+
+@pytest.mark.parametrize("seed", range(20))
+def test_matches_recursive_order(seed):
+    prompt, outputs = random_prompt(seed)
+    cached = set(random.Random(seed).sample(sorted(prompt.keys()), 10))
+    assert run_execution_list(prompt, outputs, cached) == recursive_order(prompt, outputs, cached)
+
+def test_cached_nodes_are_skipped():
+    prompt = {"1": make_node(), "2": make_node("1"), "3": make_node("2")}
+    assert run_execution_list(prompt, ["3"], {"2"}) == ["3"]
+    assert run_execution_list(prompt, ["3"], {"3"}) == []
+
+def test_long_chain_does_not_recurse():
+    size = sys.getrecursionlimit() * 5
+    prompt = {"0": make_node()}
+    for i in range(1, size):
+        prompt[str(i)] = make_node(str(i - 1))
+    order = run_execution_list(prompt, [str(size - 1)], set())
+    assert order == [str(i) for i in range(size)]
+
+def test_dependency_cycle():
+    prompt = {"1": make_node("3"), "2": make_node("1"), "3": make_node("2"), "4": make_node("3")}
+    execution_list = ExecutionList(prompt, {})
+    with pytest.raises(DependencyCycleError):
+        execution_list.add_outputs(["4"])
+
+def test_nodes_only_ready_after_dependencies():
+    prompt = {"1": make_node(), "2": make_node(), "3": make_node("1", "2")}
+    execution_list = ExecutionList(prompt, {})
+    execution_list.add_outputs(["3"])
+    first = execution_list.stage_node_execution()
+    second = execution_list.stage_node_execution()
+    assert {first, second} == {"1", "2"}
+    assert execution_list.stage_node_execution() is None
+    execution_list.complete_node_execution(first)
+    assert execution_list.stage_node_execution() is None
+    execution_list.complete_node_execution(second)
+    assert execution_list.stage_node_execution() == "3"
+
+def test_lazy_dependencies():
+    # 5 switches between the 2 and 4 branches, 6 is computed either way
+    prompt = {"1": make_node(), "2": make_node("1"), "3": make_node(), "4": make_node("3"),
+              "5": make_node("2", "4"), "6": make_node(), "7": make_node("5", "6")}
+    execution_list = ExecutionList(prompt, {}, lambda node_id: ["input_0", "input_1"] if node_id == "5" else [])
+    execution_list.add_outputs(["7"])
+    order = []
+    while not execution_list.is_empty():
+        node_id = execution_list.stage_node_execution()
+        order.append(node_id)
+        if node_id == "5" and execution_list.add_lazy_dependencies("5", ["4"]):
+            continue
+        # Asking again for inputs that were executed doesn't wait
+        assert node_id != "5" or not execution_list.add_lazy_dependencies("5", ["4"])
+        execution_list.complete_node_execution(node_id)
+    assert order == ["5", "3", "4", "5", "6", "7"]
+
+def test_lazy_dependency_cycle():
+    prompt = {"1": make_node("2"), "2": make_node("1")}
+    execution_list = ExecutionList(prompt, {}, lambda node_id: ["input_0"] if node_id == "1" else [])
+    execution_list.add_outputs(["1"])
+    assert execution_list.stage_node_execution() == "1"
+    with pytest.raises(DependencyCycleError):
+        execution_list.add_lazy_dependencies("1", ["2"])
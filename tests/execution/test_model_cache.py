@@ -0,0 +1,75 @@
+import os
+
+import torch
+
+import comfy.model_patcher
+from comfy.model_cache import ModelCache, spill_module, get_data_ptrs
+
+def make_module(value):
+    module = torch.nn.Sequential(torch.nn.Linear(16, 16), torch.nn.Linear(16, 16))
+    module[1].weight = module[0].weight
+    torch.nn.init.constant_(module[0].bias, value)
+    return module
+
+def test_spill_module(tmp_path):
+    module = make_module(1.0)
+    x = torch.randn(2, 16)
+    expected = module(x)
+    path = str(tmp_path / "m.pt")
+    ptrs = spill_module(module, path)
+    assert os.path.exists(path)
+    assert ptrs == get_data_ptrs(module)
+    assert module[1].weight is module[0].weight
+    assert torch.equal(module(x), expected)
+
+def test_disk_tier(tmp_path):
+    files = []
+    for i in range(2):
+        files.append(str(tmp_path / "m{}.safetensors".format(i)))
+        with open(files[-1], "wb") as f:
+            f.write(b"0")
+    loads = []
+    def load_function(i):
+        def load():
+            loads.append(i)
+            return comfy.model_patcher.ModelPatcher(make_module(float(i)), load_device=torch.device("cpu"), offload_device=torch.device("cpu"))
+        return load
+
+    directory = str(tmp_path / "cache")
+    cache = ModelCache(ram_budget=0, disk_budget=1024 ** 3, directory=directory)
+    cache.load("test", [files[0]], load_function(0))
+    cache.flush()
+    # The model that was just loaded isn't written, the next one pushes it out
+    assert not os.path.exists(directory)
+    cache.load("test", [files[1]], load_function(1))
+    cache.flush()
+    assert [x["tier"] for x in cache.get_stats()["models"]] == ["ram", "disk"]
+    assert len(os.listdir(directory)) == 1
+
+    value = cache.load("test", [files[0]], load_function(0))
+    assert loads == [0, 1]
+    assert cache.get_stats()["disk_hits"] == 1
+    assert torch.equal(value.model[0].bias, torch.zeros(16))
+    assert value.model[1].weight is value.model[0].weight
+
+    cache.flush()
+    cache.clear()
+    assert os.listdir(directory) == []
+
+def test_pending_deletes(tmp_path, monkeypatch):
+    path = str(tmp_path / "m.pt")
+    with open(path, "wb") as f:
+        f.write(b"0")
+    cache = ModelCache(ram_budget=1024 ** 3)
+    remove = os.remove
+    def mapped(path):
+        raise PermissionError("still mapped")
+    # Like Windows while a clone still maps the file
+    monkeypatch.setattr(os, "remove", mapped)
+    cache.delete_file(path)
+    cache.clear()
+    assert cache.pending_deletes == [path] and os.path.exists(path)
+
+    monkeypatch.setattr(os, "remove", remove)
+    cache.clear()
+    assert cache.pending_deletes == [] and not os.path.exists(path)
@@ -0,0 +1,36 @@
+from comfy.model_eviction import Candidate, ModelStats, EvictionCounters, get_policy
+
+def candidate(index, size, uses=0, last_used=0.0, seconds_per_byte=None, distance=None, refcount=2):
+    stats = ModelStats()
+    stats.uses = uses
+    stats.last_used = last_used
+    stats.seconds_per_byte = seconds_per_byte
+    return Candidate(index, size, refcount, stats, distance)
+
+def order(policy, candidates, now=100.0):
+    return [x.index for x in get_policy(policy).order(candidates, EvictionCounters(), now)]
+
+def test_policies():
+    candidates = [candidate(0, 100, uses=5, last_used=10.0), candidate(1, 200, uses=1, last_used=50.0), candidate(2, 50, uses=3, last_used=90.0, refcount=3)]
+    assert order("default", candidates) == [0, 1, 2]
+    assert order("lru", candidates) == [0, 1, 2]
+    assert order("lfu", candidates) == [1, 2, 0]
+
+def test_cost_policy():
+    # The slow to load unet stays over the controlnet that loads fast
+    unet = candidate(0, 1000, uses=2, last_used=90.0, seconds_per_byte=0.01)
+    controlnet = candidate(1, 500, uses=2, last_used=90.0, seconds_per_byte=0.001)
+    assert order("cost", [unet, controlnet]) == [1, 0]
+    # At the same rate the size doesn't matter, the least used go first
+    big = candidate(0, 1000, uses=5, last_used=90.0, seconds_per_byte=0.01)
+    small = candidate(1, 10, uses=1, last_used=90.0, seconds_per_byte=0.01)
+    assert order("cost", [big, small]) == [1, 0]
+    # Models that were never timed use the measured rate of all the loads
+    counters = EvictionCounters()
+    counters.record_load(ModelStats(), 1000, 5.0)
+    assert counters.get_seconds_per_byte() == 0.005
+
+def test_lookahead():
+    candidates = [candidate(0, 100, distance=2), candidate(1, 100, distance=1), candidate(2, 100, last_used=99.0), candidate(3, 100, distance=0)]
+    assert order("lru", candidates) == [2, 0, 1, 3]
+    assert order("default", candidates) == [0, 1, 2, 3]
@@ -0,0 +1,45 @@
+import os
+import torch
+import safetensors.torch
+
+from comfy.model_prefetch import ModelPrefetcher
+
+def write(path, size):
+    safetensors.torch.save_file({"w": torch.ones(size // 4)}, path)
+    return path
+
+def test_prefetch_budget(tmp_path):
+    a = write(str(tmp_path / "a.safetensors"), 4096)
+    b = write(str(tmp_path / "b.safetensors"), 4096)
+    c = write(str(tmp_path / "c.safetensors"), 1024)
+    prefetcher = ModelPrefetcher(os.path.getsize(a) + os.path.getsize(c), None)
+    prefetcher.prefetch([a, b, c, str(tmp_path / "d.ckpt")])
+    # b doesn't fit once a is staged, c still does
+    assert list(prefetcher.staged.keys()) == [a, c]
+
+    sd = prefetcher.take(a)
+    assert torch.equal(sd["w"], torch.ones(1024))
+    assert prefetcher.take(a) is None
+    assert prefetcher.take(b) is None
+
+    prefetcher.prefetch([b])
+    assert list(prefetcher.staged.keys()) == [b]
+
+def test_prefetch_changed_file(tmp_path):
+    a = write(str(tmp_path / "a.safetensors"), 4096)
+    prefetcher = ModelPrefetcher(1024 * 1024, None)
+    prefetcher.prefetch([a])
+    write(a, 2048)
+    assert prefetcher.take(a) is None
+
+def test_prefetch_keeps_running(tmp_path):
+    a = write(str(tmp_path / "a.safetensors"), 4096)
+    b = write(str(tmp_path / "b.safetensors"), 4096)
+    prefetcher = ModelPrefetcher(1024 * 1024, None)
+    prefetcher.prefetch([a, b])
+    # The prompt that needs a started running, b isn't wanted anymore
+    prefetcher.prefetch([], keep=[a])
+    assert list(prefetcher.staged.keys()) == [a]
+    assert torch.equal(prefetcher.take(a)["w"], torch.ones(1024))
+    prefetcher.prefetch([], keep=[b])
+    assert len(prefetcher.staged) == 0
@@ -0,0 +1,32 @@
+import concurrent.futures
+import time
+
+import execution
+import main
+
+class FakeQueue:
+    def __init__(self):
+        self.done = []
+
+    def task_done(self, item_id, outputs, status, profile=None):
+        self.done.append((item_id, outputs, status))
+
+def test_failed_write():
+    q = FakeQueue()
+    ok = concurrent.futures.Future()
+    failed = concurrent.futures.Future()
+    execution.call_when_done([ok, failed], lambda: main.prompt_done(q, 3, "p0", {"9": {}}, [], True, time.perf_counter(), [ok, failed]))
+    ok.set_result(None)
+    assert q.done == []
+    failed.set_exception(OSError("disk full"))
+
+    item_id, outputs, status = q.done[0]
+    assert item_id == 3
+    assert outputs == {"9": {}}
+    assert status.status_str == "error"
+    assert not status.completed
+    event, data = status.messages[-1]
+    assert event == "execution_error"
+    assert data["prompt_id"] == "p0"
+    assert data["exception_message"] == "disk full"
+    assert data["exception_type"] == "OSError"
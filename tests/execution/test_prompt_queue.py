@@ -0,0 +1,146 @@
+import heapq
+import random
+
+from comfy_execution.prompt_queue import PendingQueue, SQLiteQueueStore, HistoryIndex, AffinityScheduler, get_history_keys
+
+def make_item(number, prompt_id, client=None, priority=None):
+    extra_data = {}
+    if client is not None:
+        extra_data["client_id"] = client
+    if priority is not None:
+        extra_data["priority"] = priority
+    return (number, prompt_id, {}, extra_data, [])
+
+def drain(queue):
+    out = []
+    while len(queue) > 0:
+        out.append(queue.pop()[1])
+    return out
+
+def test_same_order_as_heap():
+    rng = random.Random(0)
+    queue = PendingQueue()
+    heap = []
+    for i in range(200):
+        number = rng.randint(-50, 50)
+        item = make_item(number, "p{}".format(i), client=rng.choice(["a", "b"]))
+        queue.push(item)
+        heapq.heappush(heap, item)
+    assert drain(queue) == [heapq.heappop(heap)[1] for _ in range(len(heap))]
+
+def test_priority_first():
+    queue = PendingQueue()
+    queue.push(make_item(0, "low", priority=-1))
+    queue.push(make_item(1, "normal"))
+    queue.push(make_item(2, "high", priority=5))
+    queue.push(make_item(-1, "front"))
+    assert drain(queue) == ["high", "front", "normal", "low"]
+
+def test_fair_share_round_robin():
+    queue = PendingQueue(fair_share=True)
+    for i in range(4):
+        queue.push(make_item(i, "a{}".format(i), client="a"))
+    for i in range(2):
+        queue.push(make_item(10 + i, "b{}".format(i), client="b"))
+    assert drain(queue) == ["a0", "b0", "a1", "b1", "a2", "a3"]
+
+def test_fair_share_idle_client_doesnt_catch_up():
+    queue = PendingQueue(fair_share=True)
+    for i in range(6):
+        queue.push(make_item(i, "a{}".format(i), client="a"))
+    assert [queue.pop()[1] for _ in range(4)] == ["a0", "a1", "a2", "a3"]
+    queue.push(make_item(10, "b0", client="b"))
+    queue.push(make_item(11, "b1", client="b"))
+    assert drain(queue) == ["b0", "a4", "b1", "a5"]
+
+def test_remove():
+    queue = PendingQueue(fair_share=True)
+    for i in range(5):
+        queue.push(make_item(i, "p{}".format(i), client="a"))
+    assert queue.remove("p0")[1] == "p0"
+    assert queue.remove("p3")[1] == "p3"
+    assert queue.remove("missing") is None
+    assert [x[1] for x in queue.get_items()] == ["p1", "p2", "p4"]
+    assert drain(queue) == ["p1", "p2", "p4"]
+
+def test_sqlite_store(tmp_path):
+    path = str(tmp_path / "queue.db")
+    store = SQLiteQueueStore(path)
+    store.add_queued(make_item(0, "a"))
+    store.add_queued(make_item(1, "b", client="c"))
+    store.add_queued(make_item(2, "c"))
+    store.remove_queued(["c"])
+    store.add_history("a", {"prompt": make_item(0, "a"), "outputs": {"9": {"images": []}}, "status": None})
+
+    store = SQLiteQueueStore(path)
+    assert store.load_queue() == [make_item(1, "b", client="c")]
+    assert store.load_history(10) == [("a", {"prompt": list(make_item(0, "a")), "outputs": {"9": {"images": []}}, "status": None})]
+    store.clear_history()
+    assert store.load_history(10) == []
+
+def make_history(prompt_id, client, status, node_type):
+    prompt = {"1": {"class_type": node_type, "inputs": {}}}
+    return {"prompt": (0, prompt_id, prompt, {"client_id": client}, ["1"]), "outputs": {}, "status": {"status_str": status, "completed": True, "messages": []}}
+
+def test_history_index():
+    index = HistoryIndex()
+    for i in range(10):
+        entry = make_history("p{}".format(i), "a" if i % 2 == 0 else "b", "error" if i % 3 == 0 else "success", "SaveImage")
+        index.add("p{}".format(i), get_history_keys(entry))
+    assert index.page(3) == ["p7", "p8", "p9"]
+    assert index.page(3, before="p7") == ["p4", "p5", "p6"]
+    assert index.page(2, filters={"client_id": "a"}) == ["p6", "p8"]
+    assert index.page(None, filters={"client_id": "a", "status": "error"}) == ["p0", "p6"]
+    assert index.page(None, filters={"node_type": "PreviewImage"}) == []
+
+    index.remove("p8")
+    index.remove("p0")
+    assert index.oldest() == "p1"
+    assert index.page(2, filters={"client_id": "a"}) == ["p4", "p6"]
+    assert index.slice(0, 3) == ["p1", "p2", "p3"]
+    assert index.slice(6) == ["p7", "p9"]
+    assert index.dead == 2
+    index.add("p1", get_history_keys(make_history("p1", "b", "success", "SaveImage")))
+    assert index.page(2) == ["p9", "p1"]
+    assert index.oldest() == "p2"
+
+class FakeWorker:
+    def __init__(self, index, device):
+        self.index = index
+        self.device = device
+
+def make_checkpoint_item(prompt_id, ckpt_name):
+    prompt = {"1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": ckpt_name}}}
+    return (0, prompt_id, prompt, {}, ["1"])
+
+def test_affinity_scheduler():
+    workers = [FakeWorker(0, "fake:0"), FakeWorker(1, "fake:1")]
+    resident = {"fake:0": [(("/models/checkpoints/a.safetensors",), 100)], "fake:1": [(("/models/checkpoints/sd/b.safetensors",), 200)]}
+    scheduler = AffinityScheduler(workers, lambda device: resident[device], max_wait=60.0)
+    scheduler.set_idle(workers[0])
+    scheduler.set_idle(workers[1])
+    assert scheduler.pick(make_checkpoint_item("p0", "a.safetensors")) == (workers[0], None)
+    assert scheduler.pick(make_checkpoint_item("p1", "sd/b.safetensors")) == (workers[1], None)
+    assert scheduler.pick(make_checkpoint_item("p2", "c.safetensors")) == (workers[0], None)
+
+    # Waits for the busy worker that has the checkpoint, until max_wait runs out
+    scheduler.set_busy(workers[1])
+    worker, wait = scheduler.pick(make_checkpoint_item("p3", "sd/b.safetensors"))
+    assert worker is None and 0 < wait <= 60.0
+    scheduler.max_wait = 0.0
+    assert scheduler.pick(make_checkpoint_item("p3", "sd/b.safetensors")) == (workers[0], None)
+    scheduler.forget("p3")
+    assert "p3" not in scheduler.waiting_since
+
+def test_peek():
+    queue = PendingQueue(fair_share=True)
+    assert queue.peek() is None
+    queue.push(make_item(0, "a0", client="a"))
+    queue.push(make_item(1, "a1", client="a"))
+    queue.push(make_item(2, "b0", client="b"))
+    out = []
+    while len(queue) > 0:
+        head = queue.peek()
+        assert queue.pop() is head
+        out.append(head[1])
+    assert out == ["a0", "b0", "a1"]
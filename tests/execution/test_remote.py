@@ -0,0 +1,88 @@
+import time
+from typing import NamedTuple
+
+import pytest
+
+from comfy_execution.remote import LeaseManager, LeaseLost, LoopbackCoordinator, RemoteServer, RemoteWorker, check_token
+
+class FakeQueue:
+    class ExecutionStatus(NamedTuple):
+        status_str: str
+        completed: bool
+        messages: list
+
+    def __init__(self, items):
+        self.items = list(items)
+        self.running = {}
+        self.done = {}
+        self.counter = 0
+
+    def get(self, timeout=None):
+        if len(self.items) == 0:
+            return None
+        item = self.items.pop(0)
+        self.running[self.counter] = item
+        self.counter += 1
+        return (item, self.counter - 1)
+
+    def requeue(self, item_id):
+        self.items.insert(0, self.running.pop(item_id))
+
+    def task_done(self, item_id, outputs, status, profile=None):
+        self.done[self.running.pop(item_id)[1]] = (outputs, status)
+
+class FakeServer:
+    def __init__(self):
+        self.messages = []
+
+    def send_sync(self, event, data, sid=None):
+        self.messages.append((event, data, sid))
+
+def test_lease_complete():
+    queue = FakeQueue([(0, "p0", {}, {"client_id": "c"}, [])])
+    server = FakeServer()
+    manager = LeaseManager(queue, server, lease_timeout=60.0)
+    worker = LoopbackCoordinator(manager, "w")
+    lease = worker.lease(0.0)
+    assert lease["prompt_id"] == "p0"
+    assert worker.lease(0.0) is None
+
+    worker.send_events("p0", [("executing", {"node": "1"}, False), ("execution_interrupted", {}, True)])
+    assert server.messages == [("executing", {"node": "1"}, "c"), ("execution_interrupted", {}, None)]
+    with pytest.raises(LeaseLost):
+        LoopbackCoordinator(manager, "other").complete("p0", {}, None)
+    worker.complete("p0", {"1": {"images": []}}, {"status_str": "success", "completed": True, "messages": []})
+    assert queue.done["p0"][1].status_str == "success"
+    # Messages sent after completing still reach the client
+    worker.send_events("p0", [("executing", {"node": None}, False)])
+    assert server.messages[-1] == ("executing", {"node": None}, "c")
+
+def test_lease_expires():
+    queue = FakeQueue([(0, "p0", {}, {}, []), (1, "p1", {}, {}, [])])
+    manager = LeaseManager(queue, FakeServer(), lease_timeout=0.05)
+    worker = LoopbackCoordinator(manager, "w")
+    worker.lease(0.0)
+    worker.lease(0.0)
+    time.sleep(0.03)
+    assert worker.heartbeat(["p1"]) == {"lost": [], "interrupt": False}
+    time.sleep(0.03)
+    manager.expire()
+    assert [x[1] for x in queue.items] == ["p0"]
+    manager.interrupt()
+    assert worker.heartbeat(["p0", "p1"]) == {"lost": ["p0"], "interrupt": True}
+
+def test_events_follow_their_prompt():
+    worker = RemoteWorker(None)
+    server = RemoteServer(FakeServer(), worker)
+    server.last_prompt_id = "p1"
+    # Sent once p1 started, like the outputs that finish writing late
+    server.send_sync("executed", {"node": "9", "output": {}, "prompt_id": "p0"}, "c")
+    server.send_sync("executing", {"node": "1"}, "c")
+    events = [worker.outbox.get_nowait() for i in range(2)]
+    assert [(x[0], x[1], x[2][0]) for x in events] == [("event", "p0", "executed"), ("event", "p1", "executing")]
+
+def test_check_token():
+    assert check_token("secret", "secret")
+    assert not check_token("secret", "other")
+    assert not check_token("secret", None)
+    assert not check_token(None, None)
@@ -0,0 +1,61 @@
+import os
+import torch
+
+from comfy_execution.spill import SpillTier, SpilledOutput, get_tensor_size
+
+def output(value):
+    return [[torch.full((SpillTier.MIN_SIZE // 4,), float(value))]]
+
+def test_tensor_size():
+    assert get_tensor_size([[torch.zeros(4)], [{"samples": torch.zeros(2, 2)}]]) == 32
+    assert get_tensor_size([[object()]]) is None
+    assert get_tensor_size({1: torch.zeros(4)}) is None
+
+def test_spill_and_load(tmp_path):
+    store = {}
+    spill = SpillTier(str(tmp_path), SpillTier.MIN_SIZE * 2, SpillTier.MIN_SIZE * 10)
+    for i in range(4):
+        store[i] = output(i)
+        spill.stored(store, i, store[i])
+    assert isinstance(store[0], SpilledOutput) and isinstance(store[1], SpilledOutput)
+    assert not isinstance(store[2], SpilledOutput)
+    assert len(os.listdir(spill.directory)) == 2
+
+    value = spill.load(0, store[0])
+    assert torch.equal(value[0][0], output(0)[0][0])
+
+    spill.removed(1)
+    assert len(os.listdir(spill.directory)) == 1
+    spill.clear()
+    assert not os.path.exists(spill.directory)
+
+def test_evict(tmp_path):
+    store = {}
+    spill = SpillTier(str(tmp_path), 0, SpillTier.MIN_SIZE)
+    for i in range(4):
+        store[i] = output(i)
+        spill.stored(store, i, store[i])
+    spill.evict(store, {0})
+    assert sorted(store.keys()) == [0, 3]
+    assert spill.get_stats()["spilled"] == 1
+
+def test_pending_deletes(tmp_path, monkeypatch):
+    store = {}
+    spill = SpillTier(str(tmp_path), 0, SpillTier.MIN_SIZE * 10)
+    for i in range(2):
+        store[i] = output(i)
+        spill.stored(store, i, store[i])
+    remove = os.remove
+    def mapped(path):
+        raise PermissionError("still mapped")
+    monkeypatch.setattr(os, "remove", mapped)
+    spill.removed(0)
+    assert len(spill.pending_deletes) == 1
+    spill.clear()
+    assert os.path.exists(spill.directory)
+
+    monkeypatch.setattr(os, "remove", remove)
+    spill.evict(store, set())
+    assert spill.pending_deletes == []
+    spill.clear()
+    assert not os.path.exists(spill.directory)
@@ -0,0 +1,102 @@
+import nodes
+import execution
+import folder_paths
+from comfy_execution.validation import ValidationCache, ValidationContext
+
+from .test_folder_paths import touch, set_folder
+
+class TLoader:
+    calls = 0
+
+    @classmethod
+    def INPUT_TYPES(s):
+        s.calls += 1
+        return {"required": {"name": (folder_paths.get_filename_list("test_models"),)}}
+    RETURN_TYPES = ("TEST",)
+    FUNCTION = "run"
+
+class TChoice:
+    choices = ["a"]
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"choice": (list(s.choices),), "value": ("INT", {"default": 0}), "test": ("TEST",)}}
+    RETURN_TYPES = ("TEST",)
+    FUNCTION = "run"
+
+class TChecked:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"test": ("TEST",)}}
+    @classmethod
+    def VALIDATE_INPUTS(s, test):
+        return True
+    RETURN_TYPES = ("TEST",)
+    FUNCTION = "run"
+
+def make_prompt(name, choice="a", value=1):
+    return {
+        "1": {"class_type": "TLoader", "inputs": {"name": name}},
+        "2": {"class_type": "TChoice", "inputs": {"choice": choice, "value": value, "test": ["1", 0]}},
+        "3": {"class_type": "TChecked", "inputs": {"test": ["2", 0]}},
+    }
+
+def validate(prompt, cache, node_id="2"):
+    context = ValidationContext(prompt, cache)
+    return execution.validate_inputs(prompt, node_id, {}, context)[0], context
+
+def setup(monkeypatch, tmp_path):
+    touch(str(tmp_path / "a" / "x.safetensors"))
+    set_folder(monkeypatch, tmp_path)
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "TLoader", TLoader)
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "TChoice", TChoice)
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "TChecked", TChecked)
+    monkeypatch.setattr(TLoader, "calls", 0)
+    monkeypatch.setattr(TChoice, "choices", ["a"])
+    return ValidationCache()
+
+def test_cache_hit(monkeypatch, tmp_path):
+    cache = setup(monkeypatch, tmp_path)
+    prompt = make_prompt("x.safetensors")
+    valid, context = validate(prompt, cache)
+    assert valid
+    signature = context.get_signature("2")
+    assert cache.is_valid(signature)
+    valid, context = validate(make_prompt("x.safetensors"), cache)
+    assert valid and context.cacheable["2"]
+    assert TLoader.calls == 1
+    assert not validate(make_prompt("y.safetensors"), cache)[0]
+
+def test_folder_change(monkeypatch, tmp_path):
+    cache = setup(monkeypatch, tmp_path)
+    valid, context = validate(make_prompt("x.safetensors"), cache)
+    signature = context.get_signature("2")
+    touch(str(tmp_path / "a" / "y.safetensors"))
+    valid, context = validate(make_prompt("y.safetensors"), cache)
+    assert valid
+    assert TLoader.calls == 2
+    # The schema was made again so the old signatures don't match
+    assert ValidationContext(make_prompt("x.safetensors"), cache).get_signature("2") != signature
+
+def test_list_not_from_folder(monkeypatch, tmp_path):
+    cache = setup(monkeypatch, tmp_path)
+    assert validate(make_prompt("x.safetensors"), cache)[0]
+    TChoice.choices = ["a", "b"]
+    valid, context = validate(make_prompt("x.safetensors", choice="b"), cache)
+    assert valid and not context.cacheable["2"]
+    assert not validate(make_prompt("x.safetensors", choice="c"), cache)[0]
+
+def test_not_cached(monkeypatch, tmp_path):
+    cache = setup(monkeypatch, tmp_path)
+    prompt = make_prompt("x.safetensors")
+    valid, context = validate(prompt, cache, "3")
+    assert valid
+    assert context.get_signature("3") is None
+    assert not context.cacheable["3"]
+
+    # The value is converted to an int, the signature of the string isn't valid
+    prompt = make_prompt("x.safetensors", value="1")
+    valid, context = validate(prompt, cache)
+    assert valid and prompt["2"]["inputs"]["value"] == 1
+    assert not context.cacheable["2"]
+    assert not cache.is_valid(ValidationContext(make_prompt("x.safetensors", value="1"), cache).get_signature("2"))
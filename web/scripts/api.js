@@ -183,10 +183,11 @@ class ComfyApi extends EventTarget {
 
 	/**
 	 * Loads node object definitions for the graph
+	 * @param {boolean} refresh Regenerate the definitions of all the nodes instead of using the cached ones
 	 * @returns The node definitions
 	 */
-	async getNodeDefs() {
-		const resp = await this.fetchApi("/object_info", { cache: "no-store" });
+	async getNodeDefs(refresh = false) {
+		const resp = await this.fetchApi(refresh ? "/object_info?refresh=true" : "/object_info", { cache: "no-store" });
 		return await resp.json();
 	}
 